@@ -0,0 +1,366 @@
+"""
+Benchmarks on synthetic corpora of RTF fragments, to compare performance between commits.
+
+    python3 -m bench --files 1000 --out before.json
+    python3 -m bench --files 1000 --compare before.json
+
+The corpus is generated from a seed, so the same arguments give the same files on any machine.
+Each benchmark runs on a fresh copy of it in a temporary directory: caches start cold, and the
+real SOURCE_DIR and SORTING_DIR are never touched.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime
+from pathlib import Path
+
+import prune as P
+import sift
+import sort as S
+from common import Config as C
+from common import (compare_to_rtf, cprintif, ensure_tokenizer_data, iter_files,
+                    mp_context, read_rtf, tokenize)
+from registry import cluster_registry, reset_cluster_registry
+from state import reset_state_store
+
+BENCH_MSG_COLOR = 'light_blue'
+GOOD_MSG_COLOR = 'light_green'
+DANGER_MSG_COLOR = 'light_red'
+
+_RTF_HEADER = ('{\\rtf1\\ansi\\ansicpg1252\\cocoartf1671\\cocoasubrtf600\n'
+               '{\\fonttbl\\f0\\fswiss\\fcharset0 Helvetica;}\n'
+               '{\\colortbl;\\red255\\green255\\blue255;}\n'
+               '\\pard\\tx720\\tx1440\\pardirnatural\\partightenfactor0\n\\f0\\fs24 \\cf0 ')
+_SYLLABLES = ('ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'to', 'vi', 'an', 'el', 'is', 'or', 'th', 'st', 'ch', 'ea')
+_UNICODE_STEMS = ('Fichier perdu ', 'Tagebuch Über ', 'Дневник ', '日記 ', 'Café notes ')
+
+
+@dataclass
+class CorpusSpec():
+    """What the generated corpus looks like. Rates are the fraction of files with that trait."""
+    files: int = 1000
+    seed: int = 1
+    docs: float = 0.2  # Distinct documents, per file. Every file is a version of one of them.
+    duplicate_rate: float = 0.1  # Byte-identical copy of an earlier file
+    truncate_rate: float = 0.3  # Cut off at a random byte, like a scraped fragment
+    prefix_rate: float = 0.2  # An early draft: the start of the document, properly closed
+    binary_rate: float = 0.05  # Carries an embedded image (\pict hex, or a \bin payload)
+    unicode_name_rate: float = 0.05
+    min_words: int = 100
+    max_words: int = 1500
+
+
+# Corpus generation
+#------------------
+def _vocabulary(rng: random.Random, size: int = 5000) -> list[str]:
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choices(_SYLLABLES, k=rng.randint(1, 4))))
+    return sorted(words)
+
+
+def _document(rng: random.Random, vocab: list[str], weights: list[float], words: int) -> list[str]:
+    """Paragraphs of sentence-like text, about words long."""
+    paragraphs, sentences = [], []
+    total = 0
+    while total < words:
+        sentence = rng.choices(vocab, weights, k=rng.randint(4, 20))
+        sentence[0] = sentence[0].capitalize()
+        if rng.random() < 0.3:
+            sentence[rng.randrange(len(sentence))] += ','
+        if rng.random() < 0.1:
+            sentence[-1] += "n't"
+        sentences.append(' '.join(sentence) + rng.choice('...!?'))
+        total += len(sentence)
+        if rng.random() < 0.2:
+            paragraphs.append(' '.join(sentences))
+            sentences = []
+    paragraphs.append(' '.join(sentences))
+    return paragraphs
+
+
+def _binary_group(rng: random.Random) -> bytes:
+    size = rng.randint(2_000, 200_000)
+    if rng.random() < 0.5:
+        return b'{\\pict\\pngblip\\picw100\\pich100 ' + rng.randbytes(size // 2).hex().encode() + b'}'
+    return b'{\\*\\shppict{\\pict\\wmetafile8\\bin' + str(size).encode() + b' ' + rng.randbytes(size) + b'}}'
+
+
+def _to_rtf(paragraphs: list[str]) -> bytes:
+    return (_RTF_HEADER + '\\\n'.join(paragraphs) + '}').encode('cp1252', 'replace')
+
+
+def make_corpus(spec: CorpusSpec, dest: Path) -> Path:
+    """Write spec.files RTF fragments into dest. Returns dest."""
+    rng = random.Random(spec.seed)
+    vocab = _vocabulary(rng)
+    weights = [1 / rank for rank in range(1, len(vocab) + 1)]  # Zipf, like natural language
+    docs = [_document(rng, vocab, weights, rng.randint(spec.min_words, spec.max_words))
+            for _ in range(max(1, int(spec.files * spec.docs)))]
+
+    dest.mkdir(parents=True, exist_ok=True)
+    written: list[bytes] = []
+    for i in range(spec.files):
+        if written and rng.random() < spec.duplicate_rate:
+            data = rng.choice(written)
+        else:
+            paragraphs = list(rng.choice(docs))
+            if rng.random() < spec.prefix_rate:
+                paragraphs = paragraphs[:rng.randint(1, len(paragraphs))]
+            if rng.random() < spec.binary_rate:
+                at = rng.randint(0, len(paragraphs))
+                data = _to_rtf(paragraphs[:at]) + _binary_group(rng) + _to_rtf(paragraphs[at:])
+            else:
+                data = _to_rtf(paragraphs)
+            if rng.random() < spec.truncate_rate:
+                data = data[:rng.randint(len(data) // 4, len(data))]
+            written.append(data)
+
+        stem = rng.choice(_UNICODE_STEMS) if rng.random() < spec.unicode_name_rate else 'File Name Lost '
+        (dest / f'{stem}({i}).rtf').write_bytes(data)
+    return dest
+
+
+# Benchmarks
+#-----------
+def _workspace(corpus: Path, root: Path) -> None:
+    """Point Config at a fresh copy of the corpus under root."""
+    shutil.rmtree(root, ignore_errors=True)
+    (root / 'app').mkdir(parents=True)
+    shutil.copytree(corpus, root / 'files')
+    C.set_app_dir(root / 'app')
+    C.SORTING_DIR.mkdir()
+    reset_cluster_registry()
+    reset_state_store()
+
+
+def bench_read_rtf(corpus: Path, root: Path, workers: int) -> t.Iterator[t.Optional[int]]:
+    _workspace(corpus, root)
+    files = list(iter_files(C.SOURCE_DIR))
+    yield
+    for f in files:
+        read_rtf(f)
+    yield len(files)
+
+
+def bench_tokenize(corpus: Path, root: Path, workers: int) -> t.Iterator[t.Optional[int]]:
+    _workspace(corpus, root)
+    texts = [read_rtf(f) for f in iter_files(C.SOURCE_DIR)]
+    yield
+    for text in texts:
+        tokenize(text)
+    yield len(texts)
+
+
+def bench_compare_to_rtf(corpus: Path, root: Path, workers: int) -> t.Iterator[t.Optional[int]]:
+    # Without the token cache, so this times the prefix check and the full parse behind it
+    _workspace(corpus, root)
+    C.set_token_cache(False)
+    files = sorted(iter_files(C.SOURCE_DIR))
+    rng = random.Random(0)
+    pairs = [(tokenize(read_rtf(f)), rng.choice(files)) for f in files]
+    yield
+    for tokens, other in pairs:
+        compare_to_rtf(tokens, other)
+    C.set_token_cache(True)
+    yield len(pairs)
+
+
+def bench_run_single(corpus: Path, root: Path, workers: int) -> t.Iterator[t.Optional[int]]:
+    _workspace(corpus, root)
+    count = len(list(iter_files(C.SOURCE_DIR)))
+    yield
+    S.run_single()
+    yield count
+
+
+def bench_run_multi(corpus: Path, root: Path, workers: int) -> t.Iterator[t.Optional[int]]:
+    _workspace(corpus, root)
+    count = len(list(iter_files(C.SOURCE_DIR)))
+    yield
+    S.run_multi(workers)
+    yield count
+
+
+def bench_prune(corpus: Path, root: Path, workers: int) -> t.Iterator[t.Optional[int]]:
+    _workspace(corpus, root)
+    S.run_single()
+    count = sum(c.members for c in cluster_registry().clusters())
+    C.set_match_ratio_threshold(95)
+    yield
+    P.prune_similar_files(workers)
+    yield count
+
+
+def bench_sift(corpus: Path, root: Path, workers: int) -> t.Iterator[t.Optional[int]]:
+    _workspace(corpus, root)
+    count = len(list(iter_files(C.SOURCE_DIR)))
+    yield
+    sift.sift(mp=workers > 1)
+    yield count
+
+
+def bench_cold_start(corpus: Path, root: Path, workers: int) -> t.Iterator[t.Optional[int]]:
+    # A new interpreter, from nothing to its first token set: what a container or a spawned worker pays
+    code = f'import sift; from common import Config, tokenize; Config.set_tokenizer({C.TOKENIZER!r}); tokenize("Ready.")'
+    yield
+    subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).parent, check=True)
+    yield 1
+
+
+def _init_worker(mp_cfg_file: Path) -> None:
+    C.load(mp_cfg_file)
+
+
+def _first_tokens(_: int) -> int:
+    tokenize('Ready.')
+    return os.getpid()
+
+
+def bench_pool_start(corpus: Path, root: Path, workers: int) -> t.Iterator[t.Optional[int]]:
+    # Starting a pool of workers and stopping it again, as each sort and prune of a sift step does
+    with tempfile.NamedTemporaryFile('wb') as f:
+        config_file = C.dump(f)
+        yield
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context('sort'), initializer=_init_worker,
+                                 initargs=(config_file,)) as pool:
+            list(pool.map(_first_tokens, range(workers)))
+    yield workers
+
+
+BENCHMARKS: dict[str, t.Callable[[Path, Path, int], t.Generator]] = {
+    'read_rtf': bench_read_rtf,
+    'tokenize': bench_tokenize,
+    'compare_to_rtf': bench_compare_to_rtf,
+    'run_single': bench_run_single,
+    'run_multi': bench_run_multi,
+    'prune': bench_prune,
+    'sift': bench_sift,
+    'cold_start': bench_cold_start,
+    'pool_start': bench_pool_start,
+}
+
+
+def run_benchmark(name: str, corpus: Path, root: Path, workers: int, repeat: int) -> dict:
+    """
+    Time one benchmark, best of repeat. Benchmarks are generators: everything before the first
+    yield is setup and isn't timed. The second yield gives the number of files handled.
+    """
+    times = []
+    for _ in range(repeat):
+        threshold = C.MATCH_RATIO_THRESHOLD
+        steps = BENCHMARKS[name](corpus, root / name, workers)
+        next(steps)
+        start = time.perf_counter()
+        items = next(steps)
+        times.append(time.perf_counter() - start)
+        C.set_match_ratio_threshold(threshold)
+    shutil.rmtree(root / name, ignore_errors=True)
+    secs = min(times)
+    return {'secs': secs, 'runs': times, 'files': items, 'files_per_sec': items / secs if secs else None}
+
+
+def _commit() -> t.Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old: dict, new: dict, tolerance: float) -> bool:
+    """Print how new compares to old. Returns False if any benchmark got slower by more than tolerance."""
+    for key, what in (('corpus', 'corpora'), ('config', 'configs')):
+        if old.get(key) != new.get(key):
+            cprintif(f'Warning: the two runs used different {what}. Times may not be comparable.', DANGER_MSG_COLOR)
+
+    ok = True
+    cprintif(f'Compared to {old["meta"].get("commit")} ({old["meta"].get("created")}):', BENCH_MSG_COLOR)
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if before is None:
+            cprintif(f'  {name:<16} {result["secs"]:9.3f}s  (new)')
+            continue
+        ratio = result['secs'] / before['secs'] if before['secs'] else float('inf')
+        color = None
+        if ratio > 1 + tolerance:
+            color = DANGER_MSG_COLOR
+            ok = False
+        elif ratio < 1 - tolerance:
+            color = GOOD_MSG_COLOR
+        cprintif(f'  {name:<16} {before["secs"]:9.3f}s -> {result["secs"]:9.3f}s  ({ratio:.2f}x)', color)
+    return ok
+
+
+def _parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='bench', description=__doc__.strip().splitlines()[0])
+    for f in fields(CorpusSpec):
+        parser.add_argument(f'--{f.name.replace("_", "-")}', type=type(f.default), default=f.default)
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=max(1, mp.cpu_count() - 1))
+    parser.add_argument('--start-method', choices=mp.get_all_start_methods(), help='How pools start their workers')
+    parser.add_argument('--tokenizer', default=C.TOKENIZER)
+    parser.add_argument('--backend', default=C.SIMILARITY_BACKEND)
+    parser.add_argument('--lsh', action='store_true')
+    parser.add_argument('--virtual', action='store_true', help='Sort into the manifest instead of moving files')
+    parser.add_argument('--out', type=Path, help='Write results to this JSON file')
+    parser.add_argument('--compare', type=Path, help='JSON results of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Slowdown that counts as a regression')
+    parser.add_argument('--keep', type=Path, help='Generate the corpus here and keep it')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = _parse_args(sys.argv[1:])
+
+    C.set_run_quiet(True)
+    C.set_tokenizer(args.tokenizer)
+    ensure_tokenizer_data()
+    C.set_mp_start_method(args.start_method)
+    C.set_similarity_backend(args.backend)
+    C.set_lsh(args.lsh)
+    C.set_virtual_sort(args.virtual)
+    spec = CorpusSpec(**{f.name: getattr(args, f.name) for f in fields(CorpusSpec)})
+
+    with tempfile.TemporaryDirectory(prefix='journal_bench_') as tmp:
+        corpus = args.keep or Path(tmp) / 'corpus'
+        start = time.perf_counter()
+        make_corpus(spec, corpus)
+        C.set_run_quiet(False)
+        cprintif(f'Generated {spec.files} files in {time.perf_counter() - start:.1f}s', BENCH_MSG_COLOR)
+
+        results = {}
+        for name in args.only:
+            C.set_run_quiet(True)
+            results[name] = run_benchmark(name, corpus, Path(tmp) / 'runs', args.workers, args.repeat)
+            C.set_run_quiet(False)
+            cprintif(f'  {name:<16} {results[name]["secs"]:9.3f}s  {results[name]["files_per_sec"] or 0:10.1f} files/s')
+
+    report = {
+        'meta': {'commit': _commit(), 'created': datetime.now().isoformat(timespec='seconds'),
+                 'python': platform.python_version(), 'platform': platform.platform(),
+                 'cpus': mp.cpu_count(), 'workers': args.workers, 'repeat': args.repeat},
+        'corpus': asdict(spec),
+        'config': {'tokenizer': C.TOKENIZER, 'similarity_backend': C.SIMILARITY_BACKEND, 'lsh': C.LSH_ENABLED,
+                   'virtual_sort': C.VIRTUAL_SORT, 'token_cache': C.TOKEN_CACHE_ENABLED, 'dedup': C.DEDUP_ENABLED,
+                   'mp_start_method': mp.get_start_method() if C.MP_START_METHOD is None else C.MP_START_METHOD},
+        'results': results,
+    }
+    if args.out:
+        args.out.write_text(json.dumps(report, indent=2))
+        cprintif(f'Wrote {args.out}', BENCH_MSG_COLOR)
+    if args.compare:
+        if not compare_results(json.loads(args.compare.read_text()), report, args.tolerance):
+            exit(1)
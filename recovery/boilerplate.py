@@ -0,0 +1,194 @@
+"""
+A library of known boilerplate, to keep out of the clusters: license agreements, disclaimers,
+install scripts and the like. They turn up among the fragments by the thousand and cost sort and
+prune time for nothing. Each signature is the token set of one piece of boilerplate, kept in
+STATE_DIR. A file whose tokens are nearly all in one signature goes to QUARANTINE_DIR instead of
+being sorted.
+
+    python3 -m boilerplate list
+    python3 -m boilerplate add NAME PATH...   Files, or dirs of them, like a folder in SORTING_DIR.
+                                              Adds to NAME if it's already there.
+    python3 -m boilerplate remove NAME
+"""
+import json
+import os
+import sqlite3
+import sys
+import typing as t
+from pathlib import Path
+
+from common import Config as C
+from common import cprintif, file_tokens, iter_files
+
+BOILERPLATE_MSG_COLOR = 'light_blue'
+WARN_MSG_COLOR = 'light_yellow'
+DANGER_MSG_COLOR = 'light_red'
+
+
+class BoilerplateLibrary():
+    """
+    Signatures of known boilerplate, stored in SQLite. match() names the one a token set is (nearly)
+    all made of.
+
+    The measure is the share of the file's tokens that are in the signature, rather than
+    pseudo_jaccard_similarity(). That way a journal entry that quotes a copyright line doesn't
+    match the line. Every file is checked before it's sorted, so the signatures are held in memory,
+    biggest first, and a file is only intersected with those big enough to hold threshold% of it.
+    """
+
+    def __init__(self, db_path: Path, threshold: float = 90, min_tokens: int = 20):
+        self.db_path = db_path
+        self.threshold = threshold
+        self.min_tokens = min_tokens
+        self._conn: t.Optional[sqlite3.Connection] = None
+        self._conn_pid: t.Optional[int] = None
+        self._signatures: t.Optional[list[tuple[str, frozenset]]] = None  # Biggest first. Read on first use.
+
+        self.checked = 0
+        self.matched = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # A connection inherited across fork() isn't safe to use. Open a fresh one per process.
+        if self._conn is None or self._conn_pid != os.getpid():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            conn.execute('CREATE TABLE IF NOT EXISTS signatures (name TEXT PRIMARY KEY, tokens TEXT, source TEXT)')
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    # The library
+    #------------
+    def signatures(self) -> dict[str, frozenset]:
+        """Every signature, by name. For copying the library to another process."""
+        if self._signatures is None:
+            rows = []
+            if self.db_path.exists():  # Don't create it just to find it empty
+                rows = [(name, frozenset(json.loads(tokens)))
+                        for name, tokens in self._db().execute('SELECT name, tokens FROM signatures')]
+            self.load(dict(rows))
+        return dict(self._signatures)
+
+    def load(self, signatures: dict[str, frozenset]) -> None:
+        """Take on signatures() from another process, instead of reading the library."""
+        self._signatures = sorted(signatures.items(), key=lambda _: (-len(_[1]), _[0]))
+
+    def reload(self) -> None:
+        """Read the library again on next use, to pick up signatures added since."""
+        self._signatures = None
+
+    def describe(self) -> list[tuple[str, int, str]]:
+        """(name, number of tokens, where it came from) of each signature, by name."""
+        if not self.db_path.exists():
+            return []
+        rows = self._db().execute('SELECT name, tokens, source FROM signatures ORDER BY name')
+        return [(name, len(json.loads(tokens)), source) for name, tokens, source in rows]
+
+    def add(self, name: str, tokens: t.Collection[str], source: str) -> int:
+        """Add tokens to the signature called name, creating it if need be. Returns its size."""
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT tokens, source FROM signatures WHERE name = ?', (name,)).fetchone()
+            if row is not None:
+                tokens = set(tokens) | set(json.loads(row[0]))
+                source = f'{row[1]}; {source}'
+            db.execute('INSERT OR REPLACE INTO signatures VALUES (?, ?, ?)', (name, json.dumps(sorted(tokens)), source))
+        self.reload()
+        return len(tokens)
+
+    def remove(self, name: str) -> bool:
+        db = self._db()
+        with db:
+            removed = db.execute('DELETE FROM signatures WHERE name = ?', (name,)).rowcount
+        self.reload()
+        return bool(removed)
+
+    # Queries
+    #--------
+    def match(self, tokens: t.Collection[str]) -> t.Optional[str]:
+        """Name of the signature holding at least threshold% of tokens, or None. Too few tokens never match."""
+        size = len(tokens)
+        if size < self.min_tokens:
+            return None
+        if self._signatures is None:
+            self.signatures()
+        self.checked += 1
+        for name, signature in self._signatures:
+            if 100 * (len(signature) / size) < self.threshold:
+                break  # This one and the rest are too small to hold enough of tokens
+            if 100 * (len(signature.intersection(tokens)) / size) >= self.threshold:
+                self.matched += 1
+                return name
+        return None
+
+    # Reporting
+    #----------
+    def counters(self) -> dict[str, int]:
+        return {'checked': self.checked, 'matched': self.matched}
+
+    def reset_counters(self) -> None:
+        self.checked = self.matched = 0
+
+    @staticmethod
+    def summary(counters: dict[str, int], signature_count: int) -> str:
+        return (f'Boilerplate: {counters["matched"]} of {counters["checked"]} files quarantined '
+                f'by {signature_count} signatures')
+
+
+def signature_tokens(paths: t.Iterable[Path]) -> tuple[set[str], int]:
+    """Every token of the files in paths (files, or dirs of them), and how many files were read."""
+    tokens, count = set(), 0
+    for path in paths:
+        for file in sorted(iter_files(path)) if path.is_dir() else [path]:
+            try:
+                tokens |= file_tokens(file).tokens
+                count += 1
+            except Exception as e:
+                cprintif(f'  Skipping {file.name}: {e}', WARN_MSG_COLOR)
+    return tokens, count
+
+
+# Common instances
+#-----------------
+_library: t.Optional[BoilerplateLibrary] = None
+
+
+def boilerplate_library() -> BoilerplateLibrary:
+    """The library for the current config. Created on first use in each process."""
+    global _library
+    db_path = C.STATE_DIR / 'boilerplate.sqlite3'
+    if _library is None or _library.db_path != db_path:
+        _library = BoilerplateLibrary(db_path)
+    _library.threshold, _library.min_tokens = C.BOILERPLATE_THRESHOLD, C.BOILERPLATE_MIN_TOKENS
+    return _library
+
+
+if __name__ == '__main__':
+    C.set_app_dir(Path(__file__).parent.parent.resolve())
+    C.set_run_quiet(False)
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'list'
+    library = boilerplate_library()
+    if command == 'list':
+        signatures = library.describe()
+        for name, size, source in signatures:
+            cprintif(f'  {name}: {size} tokens, from {source}')
+        cprintif(f'{len(signatures)} signatures in {library.db_path}', BOILERPLATE_MSG_COLOR)
+    elif command == 'add' and len(sys.argv) > 3:
+        name, paths = sys.argv[2], [Path(p).resolve() for p in sys.argv[3:]]
+        tokens, count = signature_tokens(paths)
+        if not tokens:
+            cprintif(f'No tokens found in {", ".join(map(str, paths))}', DANGER_MSG_COLOR)
+            exit(1)
+        size = library.add(name, tokens, ', '.join(str(p) for p in paths))
+        cprintif(f'{name}: {size} tokens, after adding {count} files', BOILERPLATE_MSG_COLOR)
+        cprintif('Files already sorted stay where they are. Sorting quarantines them from now on.', WARN_MSG_COLOR)
+    elif command == 'remove' and len(sys.argv) > 2:
+        if not library.remove(sys.argv[2]):
+            cprintif(f'No signature called {sys.argv[2]!r}', DANGER_MSG_COLOR)
+            exit(1)
+        cprintif(f'Removed {sys.argv[2]}', BOILERPLATE_MSG_COLOR)
+    else:
+        cprintif('Use list, add NAME PATH... or remove NAME.', DANGER_MSG_COLOR)
+        exit(1)
@@ -1,13 +1,21 @@
 import functools
 import inspect
+import itertools
+import math
+import multiprocessing
+import os
 import re
 import typing as t
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import nltk
-from striprtf.striprtf.striprtf.striprtf import rtf_to_text
+from lsh import LSHIndex
+from metrics import metrics
+from prefetch import Prefetcher
+from rtfstream import RtfReader
 from termcolor import cprint
+from tokencache import CacheEntry, TokenCache, content_digest
 
 
 class AppConfig():
@@ -27,25 +35,175 @@ class AppConfig():
         self.SOURCE_DIR = self.APP_DIR.parent / "files"
         self.SORTING_DIR = self.APP_DIR.parent / "sorted"
         self.UNREADABLE_DIR = self.SORTING_DIR / "unreadable"
+        self.QUARANTINE_DIR = self.SORTING_DIR / "quarantine"
+        # Working state that should survive a restart (caches, indexes). Keep it out of
+        # SORTING_DIR, because everything in there is treated as sorted files.
+        self.STATE_DIR = self.APP_DIR.parent / "state"
         self.MATCH_RATIO_THRESHOLD = 70
+        # How text is split into tokens: 'nltk' (nltk.word_tokenize) or 'regex' (a faster
+        #   approximation of it; see tokenizer_report.py for how close it gets)
+        self.TOKENIZER = 'nltk'
         self.RUN_QUIET = False
         self.FNAME_LEN = 40
         # More important that this be a high number than FNAME_LEN
         # to prevent sorting distinct files into the same directory.
         self.DNAME_LEN = 100
+        # How clusters are laid out in SORTING_DIR: 'flat' (a dir per cluster, named after its first
+        #   file's text) or 'sharded' (dirs named by a hash of that, in 256 shard dirs, with the
+        #   name in a sidecar file; see layout.py)
+        self.SORTING_LAYOUT = 'flat'
+        # run_multi() hands each worker MP_CHUNK_SIZE files at a time and keeps up to
+        # MP_TASKS_PER_WORKER chunks per worker queued, so a slow file doesn't idle the rest.
+        self.MP_CHUNK_SIZE = 4
+        self.MP_TASKS_PER_WORKER = 4
+        # How pools start their workers: None (the platform's default), 'fork', 'spawn' or
+        #   'forkserver'. Workers that aren't forked from this process import the app afresh.
+        #   'forkserver' does that once, in the server, and forks each worker from it (see mp_context()).
+        self.MP_START_METHOD = None
+        # Seconds a worker of sort.run_distributed() has to score a chunk before it's given to another
+        self.LEASE_SECS = 300
+        # sort --watch: a burst of new files is sorted once none have arrived for WATCH_SETTLE_SECS,
+        #   or there are WATCH_BATCH_MAX of them. Without inotify, SOURCE_DIR is listed every
+        #   WATCH_POLL_SECS. Every WATCH_RECONCILE_SECS, SORTING_DIR is re-read and SOURCE_DIR
+        #   sorted in full. 0 means never.
+        self.WATCH_SETTLE_SECS = 5
+        self.WATCH_BATCH_MAX = 1000
+        self.WATCH_POLL_SECS = 60
+        self.WATCH_RECONCILE_SECS = 0
+        # Seconds between writes of the metrics.json and metrics.prom progress files in STATE_DIR.
+        #   0 turns them off.
+        self.METRICS_INTERVAL = 30
+        # How to score a file against the cluster representatives: 'set' (Python sets of str)
+        #   or 'numpy' (arrays of hashed tokens, scored in one batch; see vectorsim.py)
+        self.SIMILARITY_BACKEND = 'set'
+        # With the 'set' backend, rule out clusters that can't reach the threshold from token counts
+        #   before scoring (see OverlapIndex). Exact, but the index holds every representative token
+        #   again, so it costs about as much memory as the representatives' token sets.
+        self.PREFIX_FILTER_ENABLED = True
+        # Sort, prune and sift only record where each file belongs, in the manifest in STATE_DIR,
+        #   and leave the files where they are. manifest.py carries it out at the end, so a file
+        #   is moved once instead of at every step of every sift threshold.
+        self.VIRTUAL_SORT = False
+        # How sift works: 'sort' (sort and prune the files at each threshold) or 'graph' (score
+        #   each pair of files once and work out every threshold from that; see graph.py)
+        self.SIFT_ENGINE = 'sort'
+        # Files that are at least BOILERPLATE_THRESHOLD % made of the tokens of a known piece of
+        #   boilerplate (license agreements, disclaimers...) go to QUARANTINE_DIR instead of being
+        #   sorted. See boilerplate.py. Files with fewer than BOILERPLATE_MIN_TOKENS distinct tokens
+        #   are too short to tell.
+        self.BOILERPLATE_ENABLED = True
+        self.BOILERPLATE_THRESHOLD = 90
+        self.BOILERPLATE_MIN_TOKENS = 20
+        # Byte-identical files are sorted and pruned as one
+        self.DEDUP_ENABLED = True
+        self.TOKEN_CACHE_ENABLED = True
+        self.TOKEN_CACHE_MEM_MB = 512
+        self.TOKEN_CACHE_DISK_MB = 4096
+        # Files (sources and representatives) read ahead of scoring, on PREFETCH_THREADS threads,
+        #   so tokenizing one overlaps reading the next. Holds at most PREFETCH_MEM_MB. 0 turns it off.
+        self.PREFETCH_DEPTH = 8
+        self.PREFETCH_MEM_MB = 64
+        self.PREFETCH_THREADS = 4
+        # Optional MinHash/LSH index to find candidate clusters without scanning them all
+        self.LSH_ENABLED = False
+        self.LSH_NUM_PERM = 128
+        self.LSH_RECALL = 0.95  # Chance of finding a cluster that's right at the threshold
+        self.LSH_VERIFY = False  # Also do the full scan and report where the index disagrees
 
     def set_app_dir(self, path: Path) -> None:
         self.APP_DIR = path
         self.SOURCE_DIR = self.APP_DIR.parent / "files"
         self.SORTING_DIR = self.APP_DIR.parent / "sorted"
         self.UNREADABLE_DIR = self.SORTING_DIR / "unreadable"
+        self.QUARANTINE_DIR = self.SORTING_DIR / "quarantine"
+        self.STATE_DIR = self.APP_DIR.parent / "state"
+
+    def set_state_dir(self, path: Path) -> None:
+        self.STATE_DIR = path
+
+    def set_mp_start_method(self, method: t.Optional[str]) -> None:
+        if method is not None and method not in multiprocessing.get_all_start_methods():
+            raise ValueError(f"Unknown start method '{method}'. Use one of: {', '.join(multiprocessing.get_all_start_methods())}.")
+        self.MP_START_METHOD = method
+
+    def set_lease_secs(self, seconds: float) -> None:
+        self.LEASE_SECS = seconds
 
     def set_match_ratio_threshold(self, threshold: int) -> None:
         self.MATCH_RATIO_THRESHOLD = threshold
 
+    def set_tokenizer(self, tokenizer: str) -> None:
+        if tokenizer not in TOKENIZERS:
+            raise ValueError(f"Unknown tokenizer '{tokenizer}'. Use one of: {', '.join(TOKENIZERS)}.")
+        self.TOKENIZER = tokenizer
+
     def set_run_quiet(self, quiet: bool = True) -> None:
         self.RUN_QUIET = quiet
 
+    def set_token_cache(self, enabled: bool = True, mem_mb: t.Optional[int] = None, disk_mb: t.Optional[int] = None) -> None:
+        self.TOKEN_CACHE_ENABLED = enabled
+        if mem_mb is not None:
+            self.TOKEN_CACHE_MEM_MB = mem_mb
+        if disk_mb is not None:
+            self.TOKEN_CACHE_DISK_MB = disk_mb
+
+    def set_prefetch(self, depth: int, mem_mb: t.Optional[int] = None, threads: t.Optional[int] = None) -> None:
+        self.PREFETCH_DEPTH = depth
+        if mem_mb is not None:
+            self.PREFETCH_MEM_MB = mem_mb
+        if threads is not None:
+            self.PREFETCH_THREADS = threads
+
+    def set_watch(self, settle_secs: t.Optional[float] = None, batch_max: t.Optional[int] = None,
+                  poll_secs: t.Optional[float] = None, reconcile_secs: t.Optional[float] = None) -> None:
+        if settle_secs is not None:
+            self.WATCH_SETTLE_SECS = settle_secs
+        if batch_max is not None:
+            self.WATCH_BATCH_MAX = batch_max
+        if poll_secs is not None:
+            self.WATCH_POLL_SECS = poll_secs
+        if reconcile_secs is not None:
+            self.WATCH_RECONCILE_SECS = reconcile_secs
+
+    def set_metrics_interval(self, seconds: float) -> None:
+        self.METRICS_INTERVAL = seconds
+
+    def set_sorting_layout(self, layout: str) -> None:
+        if layout not in ('flat', 'sharded'):
+            raise ValueError(f"Unknown sorting layout '{layout}'. Use 'flat' or 'sharded'.")
+        self.SORTING_LAYOUT = layout
+
+    def set_virtual_sort(self, enabled: bool = True) -> None:
+        self.VIRTUAL_SORT = enabled
+
+    def set_sift_engine(self, engine: str) -> None:
+        if engine not in ('sort', 'graph'):
+            raise ValueError(f"Unknown sift engine '{engine}'. Use 'sort' or 'graph'.")
+        self.SIFT_ENGINE = engine
+
+    def set_prefix_filter(self, enabled: bool = True) -> None:
+        self.PREFIX_FILTER_ENABLED = enabled
+
+    def set_boilerplate(self, enabled: bool = True, threshold: t.Optional[float] = None,
+                        min_tokens: t.Optional[int] = None) -> None:
+        self.BOILERPLATE_ENABLED = enabled
+        if threshold is not None:
+            self.BOILERPLATE_THRESHOLD = threshold
+        if min_tokens is not None:
+            self.BOILERPLATE_MIN_TOKENS = min_tokens
+
+    def set_similarity_backend(self, backend: str) -> None:
+        if backend not in ('set', 'numpy'):
+            raise ValueError(f"Unknown similarity backend '{backend}'. Use 'set' or 'numpy'.")
+        self.SIMILARITY_BACKEND = backend
+
+    def set_lsh(self, enabled: bool = True, recall: t.Optional[float] = None, verify: t.Optional[bool] = None) -> None:
+        self.LSH_ENABLED = enabled
+        if recall is not None:
+            self.LSH_RECALL = recall
+        if verify is not None:
+            self.LSH_VERIFY = verify
+
     def dump(self, f: t.BinaryIO) -> Path:
         """Stash config object in the temporary file provided by `f`. Used when multiprocessing."""
         pickle.dump(self, f)
@@ -104,11 +262,24 @@ def path_short_name(path: Path, max_len: int) -> str:
     return name
 
 
-def batch_iterdir(dir: Path, count: int) -> t.Generator[list[Path], None, None]:
-    batch = [f for f in dir.iterdir() if f.is_file()][:count]
-    while batch:
+def iter_files(dir: Path) -> t.Generator[Path, None, None]:
+    """Files directly in dir, from a single pass over the directory."""
+    with os.scandir(dir) as it:
+        for entry in it:
+            if entry.is_file():
+                yield Path(entry.path)
+
+
+def batched(items: t.Iterable, count: int) -> t.Generator[list, None, None]:
+    """Lists of up to count items."""
+    it = iter(items)
+    while batch := list(itertools.islice(it, count)):
         yield batch
-        batch = [f for f in dir.iterdir() if f not in batch and f.is_file()][:count]
+
+
+def batch_iterdir(dir: Path, count: int) -> t.Generator[list[Path], None, None]:
+    """Files in dir in lists of up to count, from a single pass over the directory."""
+    return batched(iter_files(dir), count)
 
 
 def largest_file(dir: Path) -> t.Optional[Path]:
@@ -127,48 +298,385 @@ def pseudo_jaccard_similarity(label1: set, label2: set) -> float:
     return 0
 
 
-def read_rtf(file: Path, length: int = -1) -> str:
-    with open(file) as f:
+class OverlapIndex():
+    """
+    Exact filter for pseudo_jaccard_similarity() at a threshold (a percentage, like
+    MATCH_RATIO_THRESHOLD). candidates() names the indexed token sets that could score at least
+    threshold against a query, going only by token counts and positions, before anything is
+    intersected. Every set it leaves out would have scored under the threshold.
+
+    It's prefix filtering (as in AllPairs and PPJoin), adapted to a denominator of the smaller set's
+    size. Each set's tokens are ordered rarest first. If two sets share `need` tokens, the smaller
+    one's first size - need + 1 tokens include one of them. The size filter those papers use has
+    no counterpart here, since a small set inside a large one scores 100%. So sets at least as big
+    as the query are found through the query's prefix, in an index of all their tokens. Smaller
+    ones are found through their own prefixes, in an index of those. The first shared token gives a
+    bound on how many can be shared in all, which rules out more.
+
+    Token rarity is counted over the indexed sets, and counted again whenever their number grows
+    fourfold. Tokens it hasn't counted are taken to be rarest.
+    """
+
+    # Once candidates() has looked at this many index entries per set, it gives up and returns every
+    #   set: a full scan intersects sets in C, which beats many more dict lookups in Python.
+    PROBE_BUDGET = 128
+    # Against fewer sets than this, scoring every one is quicker than keeping an index up to date
+    MIN_SETS = 256
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._need: dict[int, int] = {}
+        self._rank: dict[str, int] = {}  # Token -> place in the order, commonest last
+        self._ranked_at = 0  # Number of sets when _rank was counted
+        self._ids: dict[t.Hashable, int] = {}  # Postings hold ints, which hash faster than Paths
+        self._keys: dict[int, t.Hashable] = {}
+        self._next_id = 0
+        self._sets: dict[int, list[str]] = {}  # In token order
+        self._all: dict[str, dict[int, int]] = {}  # Token -> {id: its position in the set}
+        self._prefixes: dict[str, dict[int, int]] = {}  # The same, for prefix tokens only
+
+    def __len__(self) -> int:
+        return len(self._sets)
+
+    def required(self, size: int) -> int:
+        """Fewest shared tokens that bring a set of size tokens (the smaller of two) to the threshold."""
+        need = self._need.get(size)
+        if need is None:
+            need = max(1, math.ceil(self.threshold * size / 100))
+            # Settle it with the arithmetic the score is tested with, so rounding can't lose a match
+            while need > 1 and 100 * ((need - 1) / size) >= self.threshold:
+                need -= 1
+            while need <= size and not 100 * (need / size) >= self.threshold:
+                need += 1
+            self._need[size] = need
+        return need
+
+    def _order(self, tokens: t.Iterable[str]) -> list[str]:
+        rank = self._rank
+        for tok in [tok for tok in tokens if tok not in rank]:
+            rank[tok] = -len(rank) - 1  # Uncounted, so rarer than any counted token
+        return sorted(tokens, key=rank.__getitem__)
+
+    def set(self, key: t.Hashable, tokens: t.Collection[str]) -> None:
+        self.set_many({key: tokens})
+
+    def set_many(self, sets: dict[t.Hashable, t.Collection[str]]) -> None:
+        for key in sets:
+            self.remove(key)
+        if len(self._sets) + len(sets) < max(64, 4 * self._ranked_at):
+            for key, tokens in sets.items():
+                self._add(key, self._order(tokens))
+            return
+
+        # Count rarity again, over the new sets as well, and index everything in the new order
+        sets = {self._keys[i]: tokens for i, tokens in self._sets.items()} | sets
+        self._ids, self._keys, self._sets, self._all, self._prefixes = {}, {}, {}, {}, {}
+        counts: dict[str, int] = {}
+        for tokens in sets.values():
+            for tok in tokens:
+                counts[tok] = counts.get(tok, 0) + 1
+        self._rank = {tok: i for i, tok in enumerate(sorted(counts, key=lambda tok: (counts[tok], tok)))}
+        self._ranked_at = len(sets)
+        for key, tokens in sets.items():
+            self._add(key, self._order(tokens))
+
+    def _add(self, key: t.Hashable, ordered: list[str]) -> None:
+        i = self._next_id
+        self._next_id += 1
+        self._ids[key], self._keys[i], self._sets[i] = i, key, ordered
+        prefix = len(ordered) - self.required(len(ordered)) + 1 if ordered else 0  # Empty scores 0
+        for index, tokens in ((self._prefixes, ordered[:prefix]), (self._all, ordered)):
+            for pos, tok in enumerate(tokens):
+                postings = index.get(tok)
+                if postings is None:
+                    index[tok] = {i: pos}
+                else:
+                    postings[i] = pos
+
+    def remove(self, key: t.Hashable) -> None:
+        i = self._ids.pop(key, None)
+        if i is None:
+            return
+        del self._keys[i]
+        ordered = self._sets.pop(i)
+        prefix = len(ordered) - self.required(len(ordered)) + 1 if ordered else 0
+        for index, tokens in ((self._prefixes, ordered[:prefix]), (self._all, ordered)):
+            for tok in tokens:
+                postings = index[tok]
+                del postings[i]
+                if not postings:
+                    del index[tok]
+
+    def candidates(self, tokens: t.Collection[str]) -> list[t.Hashable]:
+        """Keys of the indexed sets that could score at least threshold against tokens."""
+        if self.threshold <= 0:
+            return list(self._ids)
+        query = self._order(tokens)
+        size = len(query)
+        if not size:
+            return []
+        need = self.required(size)
+        sets = self._sets
+        seen_big, seen_small = set(), set()
+        found = []
+        budget = self.PROBE_BUDGET * len(sets)
+        for pos, tok in enumerate(query):
+            left = size - pos  # Tokens of the query from here on
+            big, small = self._all.get(tok, {}), self._prefixes.get(tok, {})
+            budget -= len(big) + len(small)
+            if budget < 0:
+                return list(self._ids)  # Scoring everything will be quicker
+            if left >= need:
+                # Sets at least as big as the query. This is the first token they share with it.
+                for i, other_pos in big.items():
+                    other_size = len(sets[i])
+                    if other_size >= size and i not in seen_big:
+                        seen_big.add(i)
+                        if min(left, other_size - other_pos) >= need:
+                            found.append(i)
+            # Smaller sets, through their prefixes
+            for i, other_pos in small.items():
+                other_size = len(sets[i])
+                if other_size < size and i not in seen_small:
+                    seen_small.add(i)
+                    if min(left, other_size - other_pos) >= self.required(other_size):
+                        found.append(i)
+        keys = self._keys
+        return [keys[i] for i in found]
+
+
+def read_rtf(file: t.Union[Path, bytes], length: int = -1) -> str:
+    """Plain text of an RTF file (or its contents), or of its first length characters of markup."""
+    with RtfReader(file) as reader:
+        return reader.text(length)
+
+
+def nltk_tokens(text: str) -> set:
+    import nltk  # Not at the top: it's most of the app's import time, and only this tokenizer needs it
+    return set(nltk.word_tokenize(text))
+
+
+def ensure_tokenizer_data(tokenizer: t.Optional[str] = None) -> None:
+    """
+    Check that tokenizer (Config.TOKENIZER by default) has the data files it needs. nltk's needs the
+    punkt models. The Docker image has them (see dockerfile). Elsewhere they're downloaded the first
+    time, if there's a network.
+    """
+    if (tokenizer or Config.TOKENIZER) != 'nltk':
+        return
+    import nltk
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        nltk.download('punkt', quiet=True)  # Prints an error, but doesn't raise, when it can't
         try:
-            # NB: 'errors' arg is the same as bytes.decode()
-            # See here for possible values: https://docs.python.org/3.10/library/codecs.html#error-handlers
-            text = rtf_to_text(f.read(length), errors="ignore")
-        except UnicodeDecodeError as e:
-            if e.reason.startswith('invalid') and e.reason.endswith('byte'):
-                # Fallback: try just reading the text we can read
-                text = rtf_to_text(f.read(e.start - 1), errors="ignore")
-                return text
-
-            raise
-    
-    return text
+            nltk.data.find('tokenizers/punkt')
+        except LookupError:
+            raise RuntimeError("nltk's punkt models aren't installed, and downloading them failed. Run "
+                               "`python3 -m nltk.downloader -d DIR punkt` where there's a network, then copy DIR "
+                               "here and point NLTK_DATA at it. Or set TOKENIZER = 'regex', which needs no data.") from None
+
+
+# Characters that nltk.word_tokenize() always splits off as tokens of their own
+_SPLIT_CHARS = r';@#$%&?!*()\[\]{}<>«»“”‘’„'
+# One pass over the text finds every candidate token. _refine_chunk() finishes the job for the
+#   few distinct chunks that need it, so the per-file cost is one findall() and one set().
+_CHUNK = re.compile(rf'[^\s"`{_SPLIT_CHARS}]+|[{_SPLIT_CHARS}]|`+')
+_OPEN_QUOTE = re.compile(r'(?:^|(?<=[\s(\[{<]))"')
+_CLOSE_QUOTE = re.compile(r'(?<=[^\s(\[{<])"')
+_DASHES_ELLIPSES = re.compile(r"(--|\.{2,}|'')")
+_COMMA_COLON = re.compile(r'([:,])(?!\d)')
+_SUFFIX = re.compile(r"^(.*[^' ])('[sSmMdD]|'ll|'LL|'re|'RE|'ve|'VE|n't|N'T|')$")
+_LEADING_QUOTE = re.compile(r"^'(?!re|ve|ll|m|t|s|d|n)\w\b", re.IGNORECASE)
+_SPLIT_WORDS = re.compile(r"^(can)(not)$|^(d)('ye)$|^(gim)(me)$|^(gon)(na)$|^(got)(ta)$|^(lem)(me)$"
+                          r"|^(more)('n)$|^(wan)(na)$|^('t)(is)$|^('t)(was)$", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _refine_chunk(chunk: str) -> tuple[str, ...]:
+    """Apply nltk.word_tokenize()'s punctuation and contraction rules to one whitespace-free chunk."""
+    if chunk.isalpha() and not _SPLIT_WORDS.match(chunk):
+        return (chunk,)
+    ret = []
+    if chunk.startswith("''"):  # An opening quote, written with apostrophes
+        ret.append('``')
+        chunk = chunk[2:]
+    for part in _DASHES_ELLIPSES.split(chunk):
+        for sub in _COMMA_COLON.split(part):
+            if not sub:
+                continue
+            # NLTK splits off a sentence's final period. Words with inner periods are abbreviations.
+            if len(sub) > 1 and sub.endswith('.') and '.' not in sub[:-1]:
+                ret.append('.')
+                sub = sub[:-1]
+            if _LEADING_QUOTE.match(sub):
+                ret.append("'")
+                sub = sub[1:]
+            if m := _SUFFIX.match(sub):
+                ret.append(m.group(2))
+                sub = m.group(1)
+            if m := _SPLIT_WORDS.match(sub):
+                ret.extend(g for g in m.groups() if g)
+            else:
+                ret.append(sub)
+    return tuple(ret)
+
+
+def regex_tokens(text: str) -> set:
+    """Close to set(nltk.word_tokenize(text)), several times faster. Skips sentence splitting."""
+    tokens = set()
+    for chunk in set(_CHUNK.findall(text)):
+        tokens.update(_refine_chunk(chunk))
+    if '"' in text:
+        if _OPEN_QUOTE.search(text):
+            tokens.add('``')
+        if _CLOSE_QUOTE.search(text):
+            tokens.add("''")
+    return tokens
+
+
+TOKENIZERS: dict[str, t.Callable[[str], set]] = {'nltk': nltk_tokens, 'regex': regex_tokens}
+
+
+def tokenize(text: str) -> set:
+    """Set of tokens in text, from the tokenizer picked in Config.TOKENIZER."""
+    with metrics().timer('tokenize'):
+        return TOKENIZERS[Config.TOKENIZER](text)
+
+
+def parse_rtf(file: Path, data: t.Optional[bytes] = None) -> CacheEntry:
+    """
+    Read and tokenize a whole RTF file. Keeps the start of the text for naming files and dirs.
+    data is file's contents, if they've been read already.
+    """
+    text = read_rtf(file if data is None else data)
+    return CacheEntry(frozenset(tokenize(text)), text[:HEAD_LEN])
+
+
+def token_cache() -> TokenCache:
+    """The token cache for the current config. Created on first use in each process."""
+    global _token_cache
+    db_path = Config.STATE_DIR / 'tokens.sqlite3'
+    # Different tokenizers give different token sets, so each gets its own namespace
+    if _token_cache is None or _token_cache.db_path != db_path or _token_cache.namespace != Config.TOKENIZER:
+        _token_cache = TokenCache(db_path, namespace=Config.TOKENIZER,
+                                  mem_budget_mb=Config.TOKEN_CACHE_MEM_MB,
+                                  disk_budget_mb=Config.TOKEN_CACHE_DISK_MB)
+    return _token_cache
+
+
+def lsh_index() -> LSHIndex:
+    """The LSH index for the current config. Created on first use in each process."""
+    global _lsh_index
+    db_path = Config.STATE_DIR / 'lsh.sqlite3'
+    if (_lsh_index is None or _lsh_index.db_path != db_path
+            or _lsh_index.num_perm != Config.LSH_NUM_PERM or _lsh_index.recall != Config.LSH_RECALL):
+        _lsh_index = LSHIndex(db_path, num_perm=Config.LSH_NUM_PERM, recall=Config.LSH_RECALL)
+    return _lsh_index
+
+
+def prefetcher() -> Prefetcher:
+    """The read-ahead buffer for the current config. Created on first use in each process."""
+    global _prefetcher, _prefetcher_pid
+    settings = (Config.PREFETCH_DEPTH, Config.PREFETCH_MEM_MB * 2**20)
+    # Its threads don't survive a fork
+    if _prefetcher is None or _prefetcher_pid != os.getpid() or (_prefetcher.depth, _prefetcher.mem_budget) != settings:
+        _prefetcher = Prefetcher(Config.PREFETCH_DEPTH, Config.PREFETCH_MEM_MB, Config.PREFETCH_THREADS, skip=_is_cached)
+        _prefetcher_pid = os.getpid()
+    return _prefetcher
+
+
+def _is_cached(file: Path) -> bool:
+    """Whether file_tokens() can do without reading file."""
+    return Config.TOKEN_CACHE_ENABLED and token_cache().has(file)
+
+
+def file_digest(file: Path, data: t.Optional[bytes] = None) -> str:
+    """
+    Hash of file's bytes. Goes through the token cache when it's enabled, which remembers it by size
+    and mtime. data is file's contents, if they've been read already.
+    """
+    with metrics().timer('digest'):
+        if Config.TOKEN_CACHE_ENABLED:
+            return token_cache().digest(file, data)
+        return content_digest(file, data)
+
+
+def file_digests(files: t.Iterable[Path]) -> dict[Path, str]:
+    """file_digest() of many files, hashed in parallel."""
+    with metrics().timer('digest'):
+        if Config.TOKEN_CACHE_ENABLED:
+            return token_cache().digest_many(files)
+        files = list(files)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            return dict(zip(files, pool.map(content_digest, files)))
+
+
+def duplicate_groups(files: t.Iterable[Path]) -> dict[Path, list[Path]]:
+    """Group byte-identical files. Returns {first file: [its copies]}, in the order files were given."""
+    groups: dict[str, list[Path]] = {}
+    for file, digest in file_digests(files).items():
+        groups.setdefault(digest, []).append(file)
+    return {group[0]: group[1:] for group in groups.values()}
+
+
+def file_tokens(file: Path, data: t.Optional[bytes] = None) -> CacheEntry:
+    """Token set (and text head) of file, from the token cache when it's enabled. data as for parse_rtf()."""
+    if Config.TOKEN_CACHE_ENABLED:
+        with metrics().timer('token_cache'):  # Lookups only. Parsing on a miss is timed as its own stages.
+            return token_cache().get(file, functools.partial(parse_rtf, data=data), data)
+    return parse_rtf(file, data)
 
 
 def compare_to_rtf(tokens: set, file: Path) -> float:
+    if Config.TOKEN_CACHE_ENABLED:
+        # A cached token set is cheaper than the prefix check below, so always compare the whole file.
+        return 100 * pseudo_jaccard_similarity(tokens, file_tokens(file).tokens)
+
     # Read 500 characters for a sanity check. If it passes, read the whole thing.
-    try:
-        comp_text = read_rtf(file, length=500)
-        
-        if comp_text:
-            comp_tokens = set(nltk.word_tokenize(comp_text))
-            similarity = 100 * pseudo_jaccard_similarity(tokens, comp_tokens)
-        else:
-            # probably a false negative. All 500 chars could be RTF markup.
+    #   The reader keeps what it has read, so the rest of the file picks up where the check stopped.
+    with RtfReader(file) as reader:
+        try:
+            comp_text = reader.text(500)
+
+            if comp_text:
+                comp_tokens = tokenize(comp_text)
+                similarity = 100 * pseudo_jaccard_similarity(tokens, comp_tokens)
+            else:
+                # probably a false negative. All 500 chars could be RTF markup.
+                similarity = 0
+
+        except Exception:
+            # Chopping an RTF file at a fixed offset can cause parsing errors.
+            #   If so, just read the whole thing.
             similarity = 0
 
-    except Exception:
-        # Chopping an RTF file at a fixed offset can cause parsing errors.
-        #   If so, just read the whole thing.
-        similarity = 0
-    
-    if similarity >= Config.MATCH_RATIO_THRESHOLD or similarity == 0:
-        comp_text = read_rtf(file)
-        comp_tokens = set(nltk.word_tokenize(comp_text))
-        similarity = 100 * pseudo_jaccard_similarity(tokens, comp_tokens)
-                
+        if similarity >= Config.MATCH_RATIO_THRESHOLD or similarity == 0:
+            comp_text = reader.text()
+            comp_tokens = tokenize(comp_text)
+            similarity = 100 * pseudo_jaccard_similarity(tokens, comp_tokens)
+
     return similarity
 
 
+def mp_context(*modules: str) -> multiprocessing.context.BaseContext:
+    """
+    Multiprocessing context for a pool, per Config.MP_START_METHOD. With 'forkserver', the server
+    imports modules (those the pool's tasks live in), and nltk if it's the tokenizer, before it
+    forks any worker. That only counts for the first pool this process starts.
+    """
+    ctx = multiprocessing.get_context(Config.MP_START_METHOD)
+    if ctx.get_start_method() == 'forkserver':
+        ctx.set_forkserver_preload(['__main__', *modules] + (['nltk'] if Config.TOKENIZER == 'nltk' else []))
+    return ctx
+
+
 # Common instances
 #-----------------
-Config = AppConfig()
\ No newline at end of file
+Config = AppConfig()
+# Characters of text kept alongside cached tokens. Covers DNAME_LEN and FNAME_LEN.
+HEAD_LEN = 1024
+_token_cache: t.Optional[TokenCache] = None
+_lsh_index: t.Optional[LSHIndex] = None
+_prefetcher: t.Optional[Prefetcher] = None
+_prefetcher_pid: t.Optional[int] = None
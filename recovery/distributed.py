@@ -0,0 +1,255 @@
+"""
+Leases batches of files to workers on any number of hosts, over a socket (multiprocessing.connection,
+with an authkey). sort.run_distributed() is the coordinator and sort.run_worker() the worker.
+
+Messages are pickled tuples:
+    worker -> coordinator   ('hello', name, fetch)    fetch: send file contents along with the paths
+    coordinator -> worker   ('setup', payload)
+    worker -> coordinator   ('lease',)
+    coordinator -> worker   ('batch', seq, updates, [(path, contents or None, error or None), ...])  or  ('done',)
+    worker -> coordinator   ('result', seq, result)
+
+A lease that isn't returned within lease_secs, or whose worker disconnects, goes to the next worker
+that asks. Results come out in batch order no matter who returns them, so a run gives the same
+answer with any number of workers.
+"""
+import heapq
+import os
+import queue
+import threading
+import time
+import typing as t
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener, wait
+from pathlib import Path
+
+from common import cprintif
+from metrics import metrics
+
+DIST_MSG_COLOR = 'light_blue'
+WARN_MSG_COLOR = 'light_yellow'
+
+# Environment variable holding the shared secret. Every worker must have the coordinator's.
+AUTHKEY_ENV = 'JOURNAL_RECOVERY_AUTHKEY'
+
+
+def parse_address(text: str) -> tuple[str, int]:
+    """'host:port' (or ':port', for every interface) as a (host, port) tuple."""
+    host, _, port = text.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+def env_authkey() -> bytes:
+    key = os.environ.get(AUTHKEY_ENV)
+    if not key:
+        raise RuntimeError(f'Set {AUTHKEY_ENV} to the same secret for the coordinator and every worker.')
+    return key.encode()
+
+
+class _Worker():
+    def __init__(self, conn: Connection, name: str, fetch: bool, updates_seen: int):
+        self.conn = conn
+        self.name = name
+        self.fetch = fetch
+        self.updates_seen = updates_seen  # Position in the update log this worker has caught up to
+        self.asking = False  # Waiting for a lease
+        self.leases: set[int] = set()
+
+
+class LeaseServer():
+    """
+    Coordinator side. Workers can join at any time. Each gets setup() when it joins, and with each
+    batch, the updates broadcast() since its last one.
+    """
+
+    def __init__(self, address: tuple[str, int], authkey: bytes, lease_secs: float):
+        self.lease_secs = lease_secs
+        self._listener = Listener(address, authkey=authkey)
+        self._closed = False
+        self._arrivals: queue.Queue = queue.Queue()  # Connections accepted but not yet set up
+        self._workers: dict[Connection, _Worker] = {}
+        self._updates: list = []
+        self._updates_base = 0  # Log position of _updates[0]. Older ones every worker has seen.
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self._listener.address
+
+    def _accept(self) -> None:
+        while not self._closed:
+            try:
+                self._arrivals.put(self._listener.accept())
+            except (AuthenticationError, EOFError, ConnectionError):
+                continue  # Wrong authkey, or it hung up. Ignore it.
+            except OSError:
+                return  # Listener closed
+
+    def close(self) -> None:
+        self._closed = True
+        for worker in self._workers.values():
+            try:
+                worker.conn.send(('done',))
+            except OSError:
+                pass
+            worker.conn.close()
+        self._workers.clear()
+        self._listener.close()
+
+    def broadcast(self, update: t.Any) -> None:
+        """Pass update on to every worker with its next batch."""
+        self._updates.append(update)
+
+    # Workers
+    #--------
+    def _admit(self, setup: t.Callable[[], t.Any]) -> None:
+        while True:
+            try:
+                conn = self._arrivals.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                if not conn.poll(10):
+                    raise EOFError
+                _, name, fetch = conn.recv()
+                conn.send(('setup', setup()))
+            except (EOFError, OSError, ValueError):
+                conn.close()
+                continue
+            # setup() covers everything broadcast so far
+            self._workers[conn] = _Worker(conn, name, fetch, self._updates_base + len(self._updates))
+            cprintif(f'Worker {name} joined ({len(self._workers)} connected)', DIST_MSG_COLOR)
+
+    def _drop(self, worker: _Worker, retry: list[int], leases: dict[int, tuple[_Worker, float]]) -> None:
+        worker.conn.close()
+        del self._workers[worker.conn]
+        for seq in worker.leases:
+            leases.pop(seq, None)
+            heapq.heappush(retry, seq)
+        metrics().count('workers_lost')
+        cprintif(f'Lost worker {worker.name}. {len(worker.leases)} batches go to other workers.', WARN_MSG_COLOR)
+
+    def _lease(self, worker: _Worker, seq: int, files: list[Path]) -> None:
+        updates = self._updates[worker.updates_seen - self._updates_base:]
+        worker.updates_seen = self._updates_base + len(self._updates)
+        payload = [self._fetch(f) if worker.fetch else (f, None, None) for f in files]
+        worker.conn.send(('batch', seq, updates, payload))
+        worker.asking = False
+        worker.leases.add(seq)
+
+        # Forget updates that every worker has
+        seen = min(w.updates_seen for w in self._workers.values())
+        del self._updates[:seen - self._updates_base]
+        self._updates_base = seen
+
+    @staticmethod
+    def _fetch(file: Path) -> tuple[Path, t.Optional[bytes], t.Optional[str]]:
+        """(file, its contents, None), or (file, None, why) if it can't be read. The worker reports it as unreadable."""
+        try:
+            return file, file.read_bytes(), None
+        except OSError as e:
+            return file, None, str(e)
+
+    # Main loop
+    #----------
+    def serve(self, batches: t.Iterable[list[Path]], setup: t.Callable[[], t.Any],
+              tasks_per_worker: int) -> t.Iterator[tuple[str, t.Any]]:
+        """
+        Lease out batches and yield (worker name, result) for each, in batch order. Up to
+        tasks_per_worker batches per connected worker are out or waiting to be yielded at a time.
+        """
+        batches = iter(batches)
+        exhausted = False
+        pending: dict[int, list[Path]] = {}  # Batches not yet returned, by sequence number
+        leases: dict[int, tuple[_Worker, float]] = {}  # Sequence number -> (worker, deadline)
+        retry: list[int] = []  # Heap of batches to lease again, oldest first
+        results: dict[int, tuple[str, t.Any]] = {}
+        next_seq = 0  # Of the next new batch
+        next_out = 0  # Of the next result to yield
+
+        while True:
+            self._admit(setup)
+
+            now = time.monotonic()
+            for seq, (worker, deadline) in list(leases.items()):
+                if deadline < now:
+                    del leases[seq]
+                    worker.leases.discard(seq)
+                    heapq.heappush(retry, seq)
+                    metrics().count('leases_expired')
+                    cprintif(f'Lease on batch {seq} expired on {worker.name}', WARN_MSG_COLOR)
+
+            for worker in list(self._workers.values()):
+                if not worker.asking:
+                    continue
+                if retry:
+                    seq = heapq.heappop(retry)
+                elif not exhausted and next_seq - next_out < tasks_per_worker * len(self._workers):
+                    batch = next(batches, None)
+                    if batch is None:
+                        exhausted = True
+                        continue
+                    seq, next_seq = next_seq, next_seq + 1
+                    pending[seq] = batch
+                else:
+                    continue
+                try:
+                    self._lease(worker, seq, pending[seq])
+                    leases[seq] = (worker, now + self.lease_secs)
+                except ConnectionError:
+                    heapq.heappush(retry, seq)
+                    self._drop(worker, retry, leases)
+
+            while next_out in results:
+                yield results.pop(next_out)
+                next_out += 1
+            if exhausted and next_out == next_seq:
+                return
+
+            for conn in wait(list(self._workers), timeout=0.2):
+                worker = self._workers[conn]
+                try:
+                    msg = conn.recv()
+                except (EOFError, OSError):
+                    self._drop(worker, retry, leases)
+                    continue
+                if msg[0] == 'lease':
+                    worker.asking = True
+                elif msg[0] == 'result':
+                    _, seq, result = msg
+                    worker.leases.discard(seq)
+                    if seq in pending:  # The first return of a batch wins
+                        del pending[seq]
+                        results[seq] = (worker.name, result)
+                        if seq in leases:
+                            leases.pop(seq)[0].leases.discard(seq)
+                        if seq in retry:
+                            retry.remove(seq)
+                            heapq.heapify(retry)
+
+
+def lease_loop(address: tuple[str, int], authkey: bytes, name: str, fetch: bool,
+               on_setup: t.Callable[[t.Any], None],
+               on_batch: t.Callable[[list, list[tuple[Path, t.Optional[bytes], t.Optional[str]]]], t.Any]) -> int:
+    """
+    Worker side. Takes batches from the coordinator until it has no more or goes away. on_batch gets
+    the updates broadcast since the last batch and the batch's (path, contents, error) triples, and
+    returns the result to send back. error is why the coordinator couldn't read a file it was to send. Returns the number of batches done.
+    """
+    done = 0
+    with Client(address, authkey=authkey) as conn:
+        try:
+            conn.send(('hello', name, fetch))
+            _, payload = conn.recv()
+            on_setup(payload)
+            while True:
+                conn.send(('lease',))
+                msg = conn.recv()
+                if msg[0] == 'done':
+                    break
+                _, seq, updates, files = msg
+                conn.send(('result', seq, on_batch(updates, files)))
+                done += 1
+        except (EOFError, ConnectionError):
+            pass  # The coordinator finished or quit
+    return done
@@ -0,0 +1,366 @@
+"""
+The 'graph' sift engine (Config.SIFT_ENGINE). sift() unsorts everything after each threshold and
+sorts it again, so the same pairs of files are scored at every threshold. This scores each pair
+once, keeps the scores that reach the lowest threshold as a weighted similarity graph, and plays
+sift's sort, prune and unsort steps out on the graph in memory. Nothing is touched until the end,
+when the outcome goes in the manifest and is applied.
+
+The outcome is the same as sift() with VIRTUAL_SORT gives (without LSH, which can miss matches, and
+with the token cache, without which sort checks a prefix of each file first): the same files
+deleted, the same ones set aside as unsorted, under the same names. A sift that moves files renames
+what it unsorts, so it can take the files in another order and keep different drafts.
+"""
+import tempfile
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from boilerplate import boilerplate_library
+from common import Config as C
+from common import (OverlapIndex, batched, cprintif, file_digests,
+                    file_tokens, mp_context, pseudo_jaccard_similarity)
+from layout import cluster_dir, cluster_label, is_cluster_dir, member_index
+from manifest import apply_manifest
+from metrics import metrics
+from registry import cluster_registry
+from sort import sorted_name
+from state import ManifestEntry, source_files, state_store
+from tokencache import CacheEntry
+from vectorsim import RepresentativeMatrix, require_numpy, token_array
+
+GRAPH_MSG_COLOR = 'light_green'
+WARN_MSG_COLOR = 'light_yellow'
+DANGER_MSG_COLOR = 'light_red'
+
+
+# Building the graph
+#-------------------
+# The nodes being scored, in this process: token sets, or token arrays for the 'numpy' backend
+_nodes: list = []
+_matrix: t.Optional[RepresentativeMatrix] = None
+_index: t.Optional[OverlapIndex] = None
+_floor = 0.0
+
+
+def _set_nodes(nodes: list, floor: float) -> None:
+    global _nodes, _matrix, _index, _floor
+    _nodes, _floor = nodes, floor
+    _matrix = _index = None
+    if C.SIMILARITY_BACKEND == 'numpy':
+        _matrix = RepresentativeMatrix()
+        _matrix.load(dict(enumerate(nodes)))
+    elif C.PREFIX_FILTER_ENABLED and len(nodes) >= OverlapIndex.MIN_SETS:
+        _index = OverlapIndex(floor)
+        for i, tokens in enumerate(nodes):
+            _index.set(i, tokens)
+
+
+def _row(i: int) -> tuple[list[tuple[int, float]], int]:
+    """
+    Scores of node i against itself and the nodes after it, where they reach the floor, and how many
+    of those pairs were scored rather than ruled out.
+    """
+    if _matrix is not None:
+        keys, scores = _matrix.scores(_nodes[i])
+        np = require_numpy()
+        keys, scores = np.asarray(keys, dtype=np.int64), 100 * scores
+        hits = (keys >= i) & (scores >= _floor)
+        return list(zip(keys[hits].tolist(), scores[hits].tolist())), len(_nodes) - i
+    tokens = _nodes[i]
+    others = range(i, len(_nodes)) if _index is None else sorted(j for j in _index.candidates(tokens) if j >= i)
+    return [(j, score) for j in others
+            if (score := 100 * pseudo_jaccard_similarity(tokens, _nodes[j])) >= _floor], len(others)
+
+
+def _init_worker(mp_cfg_file: Path, nodes: t.Optional[list] = None, floor: float = 0.0) -> None:
+    """Runs once in each pool worker."""
+    C.load(mp_cfg_file)
+    if nodes is not None:
+        _set_nodes(nodes, floor)
+
+
+def _rows_mp(rows: list[int]) -> list[tuple[list[tuple[int, float]], int]]:
+    """Pool task. Scores a chunk of rows."""
+    return [_row(i) for i in rows]
+
+
+def _tokens_mp(files: list[Path]) -> list[t.Optional[CacheEntry]]:
+    """Pool task. Tokenizes a chunk of files. None for one that can't be read."""
+    return [_tokens_or_none(f) for f in files]
+
+
+def _tokens_or_none(file: Path) -> t.Optional[CacheEntry]:
+    try:
+        return file_tokens(file)
+    except Exception:
+        return None  # sort sends it to UNREADABLE_DIR
+
+
+def _pool_map(fn: t.Callable, items: list, workers: int, *initargs) -> list:
+    """fn over chunks of items in a pool of workers, with the results flattened back out, in order."""
+    chunk = max(1, len(items) // (workers * 16))
+    with tempfile.NamedTemporaryFile('wb') as f:
+        config_file = C.dump(f)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context(__name__),
+                                 initializer=_init_worker, initargs=(config_file, *initargs)) as pool:
+            return [r for results in pool.map(fn, batched(items, chunk)) for r in results]
+
+
+class SimilarityGraph():
+    """
+    Scores (0-100) of every pair of token sets, computed once. Only those of at least floor are
+    kept, so score() answers for any threshold at or above it: anything missing is below. With the
+    'set' backend, an OverlapIndex at floor rules out most of the pairs that fall short unscored.
+    """
+
+    def __init__(self, tokens: list[frozenset], floor: float, workers: int = 1):
+        self.floor = floor
+        self.pairs = len(tokens) * (len(tokens) + 1) // 2
+        self.scored = 0  # The rest were ruled out without scoring
+        self._edges: list[dict[int, float]] = [{} for _ in tokens]
+
+        nodes = [token_array(tok) for tok in tokens] if C.SIMILARITY_BACKEND == 'numpy' else tokens
+        with metrics().timer('similarity'):
+            if workers > 1 and len(nodes) > 1:
+                rows = _pool_map(_rows_mp, list(range(len(nodes))), workers, nodes, floor)
+            else:
+                _set_nodes(nodes, floor)
+                rows = [_row(i) for i in range(len(nodes))]
+                _set_nodes([], floor)
+
+        for i, (row, scored) in enumerate(rows):
+            self.scored += scored
+            for j, score in row:
+                self._edges[i][j] = self._edges[j][i] = score
+        metrics().count('comparisons', self.scored)
+        metrics().count('comparisons_pruned', self.pairs - self.scored)
+
+    def __len__(self) -> int:
+        """Number of edges, not counting a node's score against itself."""
+        return (sum(len(e) for e in self._edges) - sum(i in e for i, e in enumerate(self._edges))) // 2
+
+    def score(self, a: int, b: int) -> float:
+        return self._edges[a].get(b, 0.0)
+
+    def neighbours(self, node: int) -> dict[int, float]:
+        """{node: score} of the nodes that score at least floor against node, maybe including itself."""
+        return self._edges[node]
+
+
+# Playing out a sift
+#-------------------
+@dataclass
+class _Cluster():
+    """A dir in SORTING_DIR, as the registry would see it. Its representative is its largest file."""
+    members: list[int] = field(default_factory=list)
+    rep: t.Optional[int] = None
+    rep_size: int = -1
+    next_index: int = 0  # ClusterRegistry.claim_index()
+
+
+class GraphSift():
+    """
+    sift() with VIRTUAL_SORT, on a SimilarityGraph of files. Files are known by their index in
+    files, which is SOURCE_DIR's listing order. Each step does what its counterpart in sort, prune
+    or sift does to the manifest and the registry, in the same order, so ties go the same way.
+    """
+
+    def __init__(self, files: list[Path], floor: float, workers: int = 1):
+        self.files = files
+        self.sizes = [f.stat().st_size for f in files]
+        self.digests = file_digests(files) if C.DEDUP_ENABLED else {}
+        if workers > 1 and len(files) > 1:
+            entries = _pool_map(_tokens_mp, files, workers)
+        else:
+            entries = [_tokens_or_none(f) for f in files]
+        self.heads = [e.head if e else None for e in entries]
+        library = boilerplate_library()
+        self.boilerplate = [library.match(e.tokens) if e and C.BOILERPLATE_ENABLED else None for e in entries]
+
+        # One node per distinct file contents. Unreadable files and boilerplate have none.
+        node_of: dict[t.Any, int] = {}
+        tokens = []
+        self.nodes: list[t.Optional[int]] = []
+        for f, entry, boilerplate in zip(files, entries, self.boilerplate):
+            if entry is None or boilerplate is not None:
+                self.nodes.append(None)
+                continue
+            key = self.digests.get(f, f)
+            if key not in node_of:
+                node_of[key] = len(tokens)
+                tokens.append(entry.tokens)
+            self.nodes.append(node_of[key])
+        self.graph = SimilarityGraph(tokens, floor, workers)
+
+        self.entries: dict[int, tuple[t.Optional[Path], t.Optional[str]]] = {}  # The manifest: (dir, name)
+        self.clusters: dict[Path, _Cluster] = {}
+        self.rep_dirs: dict[int, set[Path]] = {}  # Node of each representative -> its dirs
+        self.lookups = 0  # Comparisons that sift would have made
+
+    # The manifest
+    #-------------
+    def _assign(self, i: int, dir: t.Optional[Path], name: t.Optional[str] = None) -> None:
+        """StateStore.assign()"""
+        if dir is not None and dir / name == self.files[i]:
+            self.entries.pop(i, None)
+        else:
+            self.entries[i] = (dir, name)
+
+    def _name(self, i: int) -> str:
+        """StateStore.destination().name"""
+        return self.entries[i][1] if i in self.entries else self.files[i].name
+
+    def sources(self) -> list[int]:
+        """source_files(): files never moved, in listing order, then the ones sent back, in manifest order."""
+        back = sorted((name, str(self.files[i]), i) for i, (dir, name) in self.entries.items() if dir == C.SOURCE_DIR)
+        return [i for i in range(len(self.files)) if i not in self.entries] + [i for _, _, i in back]
+
+    def write(self) -> None:
+        """Put the outcome in the real manifest."""
+        store = state_store()
+        for i, (dir, name) in self.entries.items():
+            store.assign(ManifestEntry(self.files[i], dir, name, self.sizes[i]))
+        store.flush()
+
+    # The registry
+    #-------------
+    def _add_member(self, dir: Path, i: int) -> None:
+        """ClusterRegistry.add_member()"""
+        cluster = self.clusters.setdefault(dir, _Cluster())
+        cluster.members.append(i)
+        if self.sizes[i] > cluster.rep_size:
+            if cluster.rep is not None:
+                self.rep_dirs[self.nodes[cluster.rep]].discard(dir)
+            cluster.rep, cluster.rep_size = i, self.sizes[i]
+            self.rep_dirs.setdefault(self.nodes[i], set()).add(dir)
+
+    def _reconcile(self) -> None:
+        """ClusterRegistry.reconcile(): the clusters in the manifest, with members in manifest order."""
+        self.clusters.clear()
+        self.rep_dirs.clear()
+        for _, name, _, i in sorted((str(dir), name, str(self.files[i]), i) for i, (dir, name) in self.entries.items()
+                                    if dir is not None and is_cluster_dir(dir)):
+            dir = self.entries[i][0]
+            self._add_member(dir, i)
+            index = member_index(name)
+            if index is not None and index >= self.clusters[dir].next_index:
+                self.clusters[dir].next_index = index + 1
+
+    # Steps
+    #------
+    def sort(self, thresh: int) -> None:
+        """sort.run_single() with VIRTUAL_SORT, at threshold thresh."""
+        self._reconcile()
+        groups: dict[t.Any, list[int]] = {}
+        for i in self.sources():
+            groups.setdefault(self.digests.get(self.files[i], i), []).append(i)
+
+        for leader, *copies in groups.values():
+            node = self.nodes[leader]
+            if node is None:
+                dir = C.UNREADABLE_DIR if self.boilerplate[leader] is None else C.QUARANTINE_DIR
+                for i in [leader, *copies]:
+                    self._assign(i, dir, self.files[i].name)
+                continue
+
+            # Highest score first, ties by name, as place_file() has it
+            self.lookups += len(self.clusters)
+            best = None
+            for other, score in self.graph.neighbours(node).items():
+                if score >= thresh:
+                    for dir in self.rep_dirs.get(other, ()):
+                        if best is None or (-score, str(dir)) < best[:2]:
+                            best = (-score, str(dir), dir)
+            head = self.heads[leader]
+            dir = best[2] if best else cluster_dir(cluster_label(head))
+            for i in [leader, *copies]:
+                cluster = self.clusters.setdefault(dir, _Cluster())
+                self._assign(i, dir, sorted_name(head.lstrip()[:C.FNAME_LEN], cluster.next_index))
+                cluster.next_index += 1
+                self._add_member(dir, i)
+
+    def _match(self, i: int, largest: int) -> float:
+        """plan_dir()'s score of file i against the largest file of its dir."""
+        if C.DEDUP_ENABLED and self.digests[self.files[i]] == self.digests[self.files[largest]]:
+            return 100.0
+        return self.graph.score(self.nodes[i], self.nodes[largest])
+
+    def prune(self, thresh: int) -> int:
+        """prune_similar_files() with VIRTUAL_SORT, at threshold thresh. Returns the number deleted."""
+        pruned = 0
+        for cluster in self.clusters.values():
+            for i in cluster.members:
+                if i == cluster.rep:
+                    continue
+                self.lookups += 1
+                if self._match(i, cluster.rep) >= thresh:
+                    self._assign(i, None)
+                    pruned += 1
+                else:
+                    self._assign(i, C.SOURCE_DIR, self._name(i))
+            cluster.members = [cluster.rep]
+        return pruned
+
+    def unsort(self) -> None:
+        """sift.unsort() with VIRTUAL_SORT"""
+        for i, (dir, name) in list(self.entries.items()):
+            if dir is not None and (is_cluster_dir(dir) or dir in (C.UNREADABLE_DIR, C.SORTING_DIR)):
+                self._assign(i, C.SOURCE_DIR, name)
+        self.clusters.clear()
+        self.rep_dirs.clear()
+
+    def set_aside(self, dir: Path) -> None:
+        """Send the files left in SOURCE_DIR to dir, under the names they have now."""
+        for i in self.sources():
+            self._assign(i, dir, self._name(i))
+
+    def run(self, start_thresh: int, max_thresh: int, step: int) -> None:
+        """The sift loop"""
+        for sort_thresh in range(start_thresh, max_thresh + 1, step):
+            prev_count = len(self.sources())
+            pruned = 0
+            while True:
+                self.sort(sort_thresh)
+                pruned += self.prune(max_thresh)
+                unsorted_count = len(self.sources())
+                if unsorted_count >= prev_count or unsorted_count == 0:
+                    break
+                prev_count = unsorted_count
+            cprintif(f'Threshold {sort_thresh}%: {len(self.clusters)} clusters, {pruned} files removed, '
+                     f'{unsorted_count} could not be sorted', GRAPH_MSG_COLOR)
+
+            if unsorted_count and sort_thresh == max_thresh:
+                (unsorted_dir := C.SOURCE_DIR / "unsorted").mkdir(exist_ok=True)
+                cprintif(f'Moving them to {unsorted_dir}', DANGER_MSG_COLOR)
+                self.set_aside(unsorted_dir)
+            self.unsort()
+
+
+def graph_sift(start_thresh: int = 70, max_thresh: int = 95, step: int = 5, workers: int = 1) -> bool:
+    """
+    sift() on a similarity graph. Starts from everything in SOURCE_DIR, so it won't run while files
+    are sorted, a manifest is waiting or a sift was interrupted. False if it didn't run.
+    """
+    for d in [C.SORTING_DIR, C.UNREADABLE_DIR, C.QUARANTINE_DIR]:
+        d.mkdir(exist_ok=True)
+    store = state_store()
+    store.recover()
+    if store.position() or store.pending() or cluster_registry().clusters():
+        cprintif('The graph engine needs every file in SOURCE_DIR, with nothing sorted or planned. '
+                 'Unsort, or apply or discard the manifest, first.', DANGER_MSG_COLOR)
+        return False
+
+    files = source_files()
+    cprintif(f'Scoring {len(files)} files against each other', GRAPH_MSG_COLOR)
+    sift = GraphSift(files, start_thresh, workers)
+    pruned = sift.graph.pairs - sift.graph.scored
+    cprintif(f'{sift.graph.scored} pairs scored' + (f' ({pruned} more ruled out by the prefix filter)' if pruned else '')
+             + f', {len(sift.graph)} at {start_thresh}% or more', GRAPH_MSG_COLOR)
+    sift.run(start_thresh, max_thresh, step)
+    cprintif(f'{sift.lookups} comparisons answered from the graph', GRAPH_MSG_COLOR)
+
+    sift.write()
+    cprintif(f'Applying {store.pending()} planned moves', GRAPH_MSG_COLOR)
+    apply_manifest()
+    return True
@@ -0,0 +1,207 @@
+"""
+How the clusters are laid out in SORTING_DIR (Config.SORTING_LAYOUT).
+
+'flat' gives each cluster a dir in SORTING_DIR named after the first DNAME_LEN characters of the
+file that started it. That's easy to browse, but SORTING_DIR ends up with tens of thousands of
+entries, and some names are too long for the OS.
+
+'sharded' names each dir after the cluster's id, a hash of that same name, in a shard dir named
+after the id's first two characters: SORTING_DIR/3f/3fa85f6457b2c1d0. The same name always gives
+the same id, so files join clusters just as they do by name, in any process and without a lookup.
+The name goes in a sidecar beside the dir, 3f/3fa85f6457b2c1d0.label, where it isn't a member.
+
+    python3 -m layout list      Each cluster's dir, number of files and label, biggest first
+    python3 -m layout migrate   Move the clusters of a flat SORTING_DIR into the sharded layout
+"""
+import hashlib
+import os
+import re
+import sys
+import typing as t
+from pathlib import Path
+
+from common import Config as C
+from common import cprintif, iter_files, path_short_name
+from pathvalidate import sanitize_filename
+from state import check_no_plan, state_store
+
+LAYOUT_MSG_COLOR = 'light_blue'
+WARN_MSG_COLOR = 'light_yellow'
+DANGER_MSG_COLOR = 'light_red'
+
+ID_LEN = 16  # Hex digits in a cluster id
+SHARD_LEN = 2  # Leading digits of the id that name its shard, so 256 shards
+LABEL_SUFFIX = '.label'
+_SHARD_NAME = re.compile(f'[0-9a-f]{{{SHARD_LEN}}}')
+_MEMBER_INDEX = re.compile(r'(?:^| )(\d+)\.rtf$')
+
+
+# Names
+#------
+def cluster_label(text: str) -> str:
+    """Name of the cluster a file starting with text would start: its first DNAME_LEN characters, made safe."""
+    return sanitize_filename(text[:C.DNAME_LEN]).lstrip()
+
+
+def cluster_id(label: str) -> str:
+    return hashlib.blake2b(label.encode('utf-8', 'surrogatepass'), digest_size=ID_LEN // 2).hexdigest()
+
+
+def cluster_dir(label: str) -> Path:
+    """Dir of the cluster called label, in the current layout. The same label always gives the same dir."""
+    if C.SORTING_LAYOUT == 'sharded':
+        id = cluster_id(label)
+        return C.SORTING_DIR / id[:SHARD_LEN] / id
+    return C.SORTING_DIR / label
+
+
+def label_file(dir: Path) -> Path:
+    """The sidecar that holds a sharded cluster's label."""
+    return dir.with_name(dir.name + LABEL_SUFFIX)
+
+
+def label(dir: Path) -> str:
+    """What dir's cluster is called: its sidecar's label, or its own name."""
+    sidecar = label_file(dir)
+    return sidecar.read_text(encoding='utf-8') if sidecar.is_file() else dir.name
+
+
+def member_index(name: str) -> t.Optional[int]:
+    """The index in a member's file name (see sort.sorted_name()), or None if it wasn't named that way."""
+    match = _MEMBER_INDEX.search(name)
+    return int(match[1]) if match else None
+
+
+# The tree
+#---------
+def is_cluster_dir(dir: Path) -> bool:
+    """Whether dir is where a cluster is or would be, rather than UNREADABLE_DIR, QUARANTINE_DIR or anywhere else."""
+    if C.SORTING_LAYOUT == 'sharded':
+        return dir.parent.parent == C.SORTING_DIR and dir.parent not in (C.UNREADABLE_DIR, C.QUARANTINE_DIR)
+    return dir.parent == C.SORTING_DIR and dir not in (C.UNREADABLE_DIR, C.QUARANTINE_DIR)
+
+
+def _top_dirs() -> list[Path]:
+    """Dirs in SORTING_DIR, other than UNREADABLE_DIR and QUARANTINE_DIR."""
+    with os.scandir(C.SORTING_DIR) as it:
+        return [Path(e.path) for e in it if e.is_dir() and Path(e.path) not in (C.UNREADABLE_DIR, C.QUARANTINE_DIR)]
+
+
+def _holds(dir: Path) -> tuple[bool, bool]:
+    """Whether dir holds (any dirs, any files other than sidecars)."""
+    dirs = files = False
+    with os.scandir(dir) as it:
+        for e in it:
+            if e.is_dir():
+                dirs = True
+            elif not e.name.endswith(LABEL_SUFFIX):
+                files = True
+    return dirs, files
+
+
+def cluster_dirs() -> list[Path]:
+    """
+    Every cluster dir in SORTING_DIR, from one listing of it (and of each shard). Raises if the
+    tree is in the other layout, since sorting into it would mix the two.
+    """
+    top = _top_dirs()
+    if C.SORTING_LAYOUT != 'sharded':
+        if any(_SHARD_NAME.fullmatch(d.name) and _holds(d)[0] for d in top):
+            raise RuntimeError(f"{C.SORTING_DIR} is in the sharded layout. Set Config.SORTING_LAYOUT to 'sharded'.")
+        return top
+
+    dirs = []
+    for shard in top:
+        found = None if _SHARD_NAME.fullmatch(shard.name) else shard
+        with os.scandir(shard) as it:
+            for e in it:
+                if e.is_dir():
+                    dirs.append(Path(e.path))
+                elif not e.name.endswith(LABEL_SUFFIX):
+                    found = shard
+        if found is not None:
+            raise RuntimeError(f'{C.SORTING_DIR} holds clusters in the flat layout, like {found.name}. '
+                               'Move them into the sharded layout (python3 -m layout migrate) first.')
+    return dirs
+
+
+def tree_mtime() -> t.Any:
+    """Changes when a cluster dir is made or removed: SORTING_DIR's mtime, and in the sharded layout, the shards'."""
+    mtime = C.SORTING_DIR.stat().st_mtime_ns
+    if C.SORTING_LAYOUT != 'sharded':
+        return mtime
+    with os.scandir(C.SORTING_DIR) as it:
+        return mtime, sorted((e.name, e.stat().st_mtime_ns) for e in it if e.is_dir())
+
+
+def make_cluster_dir(dir: Path) -> None:
+    """Create a sharded cluster dir, and its shard if need be. Writes its sidecar first, if the label is known."""
+    if dir.is_dir():
+        return
+    name = state_store().label(dir)
+    if name is not None:
+        dir.parent.mkdir(exist_ok=True)
+        label_file(dir).write_text(name, encoding='utf-8')
+    dir.mkdir(parents=True, exist_ok=True)
+
+
+def remove_cluster_dir(dir: Path) -> None:
+    """Remove an empty cluster dir, and its sidecar."""
+    dir.rmdir()
+    if C.SORTING_LAYOUT == 'sharded':
+        label_file(dir).unlink(missing_ok=True)
+
+
+# Migration
+#----------
+def _flat_dirs() -> list[Path]:
+    """The clusters of a flat tree, or of one half-migrated. Shards only ever hold dirs and sidecars."""
+    return sorted(d for d in _top_dirs() if not _SHARD_NAME.fullmatch(d.name) or _holds(d)[1])
+
+
+def migrate() -> int:
+    """
+    Move every flat cluster dir into the sharded layout, with its name as its label. Renames each
+    dir in one go, whatever it holds, since both places are in SORTING_DIR. Returns how many moved.
+    """
+    store = state_store()
+    store.recover()
+    check_no_plan()  # Clusters that are only in the manifest would be left behind
+
+    moved = 0
+    for dir in _flat_dirs():
+        id = cluster_id(dir.name)
+        new_dir = C.SORTING_DIR / id[:SHARD_LEN] / id
+        if new_dir.exists():
+            cprintif(f'  {dir.name}: {new_dir} is taken. Left where it is.', DANGER_MSG_COLOR)
+            continue
+        old_dir = dir
+        if new_dir.parent == dir:
+            dir = dir.rename(dir.with_name(id))  # A flat cluster named like its own shard. Out of the way first.
+        new_dir.parent.mkdir(exist_ok=True)
+        label_file(new_dir).write_text(old_dir.name, encoding='utf-8')
+        dir.rename(new_dir)
+        store.relocate_cluster(old_dir, new_dir)
+        cprintif(f'  {path_short_name(old_dir, 30)} -> {new_dir.relative_to(C.SORTING_DIR)}')
+        moved += 1
+    return moved
+
+
+if __name__ == '__main__':
+    C.set_app_dir(Path(__file__).parent.parent.resolve())
+    C.set_run_quiet(False)
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'list'
+    if command == 'list':
+        sizes = sorted(((len(list(iter_files(d))), d) for d in cluster_dirs()), key=lambda _: (-_[0], _[1]))
+        for size, dir in sizes:
+            cprintif(f'  {dir.relative_to(C.SORTING_DIR)}: {size} files, {label(dir)}')
+        cprintif(f'{len(sizes)} clusters in {C.SORTING_DIR}, {C.SORTING_LAYOUT} layout', LAYOUT_MSG_COLOR)
+    elif command == 'migrate':
+        moved = migrate()
+        cprintif(f'Moved {moved} clusters into the sharded layout', LAYOUT_MSG_COLOR)
+        if C.SORTING_LAYOUT != 'sharded':
+            cprintif("Set Config.SORTING_LAYOUT to 'sharded' to sort into it.", WARN_MSG_COLOR)
+    else:
+        cprintif('Use list or migrate.', DANGER_MSG_COLOR)
+        exit(1)
@@ -0,0 +1,227 @@
+import hashlib
+import os
+import random
+import sqlite3
+import struct
+import typing as t
+from pathlib import Path
+
+# Mersenne prime for the MinHash permutations: h(x) = (a*x + b) mod P
+_PRIME = (1 << 61) - 1
+# Rows per band in each layer of band buckets. Fewer rows per band catches lower Jaccard pairs.
+_LAYERS = (1, 2, 4, 8)
+# Fixed seed so that signatures are comparable across processes and restarts
+_SEED = 0x5EED
+
+
+def token_hash(token: str) -> int:
+    """Stable 64-bit hash of a token. Python's hash() is salted per process, so it can't be used here."""
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little')
+
+
+def _band_key(rows: int, band: int, values: t.Sequence[int]) -> int:
+    """Bucket id for one band of a signature, as a signed 64-bit int for SQLite."""
+    packed = struct.pack(f'<HH{len(values)}Q', rows, band, *values)
+    return int.from_bytes(hashlib.blake2b(packed, digest_size=8).digest(), 'little', signed=True)
+
+
+def _min_jaccard(query_size: int, other_size: int, threshold: float) -> float:
+    """
+    Lowest Jaccard similarity two sets of these sizes can have while still reaching threshold in
+    pseudo_jaccard_similarity(), which divides by the smaller set's size.
+    """
+    overlap = threshold * min(query_size, other_size)
+    union = query_size + other_size - overlap
+    return overlap / union if union > 0 else 1.0
+
+
+class LSHIndex():
+    """
+    MinHash signatures of cluster representatives, bucketed by banded LSH, stored in SQLite.
+
+    Since pseudo_jaccard_similarity() is really a containment measure, a short fragment can fully
+    match a long representative while their Jaccard similarity is low. So every signature is banded
+    several ways (see _LAYERS), and a query uses, for each candidate's size, the widest bands that
+    still find a threshold match with probability `recall`. Clusters whose size is so different
+    from the query's that no layer is good enough are always returned as candidates.
+
+    The index only narrows the scan. Callers still compute the exact similarity for each candidate.
+    """
+
+    def __init__(self, db_path: Path, num_perm: int = 128, recall: float = 0.95):
+        if num_perm % max(_LAYERS):
+            raise ValueError(f'num_perm ({num_perm}) must be a multiple of {max(_LAYERS)}')
+        if not 0 < recall < 1:
+            raise ValueError(f'recall ({recall}) must be between 0 and 1')
+
+        self.db_path = db_path
+        self.num_perm = num_perm
+        self.recall = recall
+
+        rng = random.Random(_SEED)
+        self._perms = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)]
+        self._conn: t.Optional[sqlite3.Connection] = None
+        self._conn_pid: t.Optional[int] = None
+
+        self.queries = 0
+        self.candidates_returned = 0
+        self.forced = 0
+        self.verified = 0
+        self.mismatches = 0
+
+    def _db(self) -> sqlite3.Connection:
+        # A connection inherited across fork() isn't safe to use. Open a fresh one per process.
+        if self._conn is None or self._conn_pid != os.getpid():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS clusters '
+                         '(dir TEXT PRIMARY KEY, rep TEXT, rep_size INTEGER, n_tokens INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS clusters_n_tokens ON clusters (n_tokens)')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (key INTEGER, dir TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS buckets_key ON buckets (key)')
+            conn.execute('CREATE INDEX IF NOT EXISTS buckets_dir ON buckets (dir)')
+
+            # Signatures made with a different num_perm can't be compared. Start over.
+            row = conn.execute("SELECT value FROM meta WHERE key = 'num_perm'").fetchone()
+            if row is None or int(row[0]) != self.num_perm:
+                conn.execute('DELETE FROM clusters')
+                conn.execute('DELETE FROM buckets')
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('num_perm', ?)", (str(self.num_perm),))
+
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    # Signatures
+    #-----------
+    def signature(self, tokens: t.Iterable[str]) -> list[int]:
+        hashes = [token_hash(tok) % _PRIME for tok in tokens]
+        if not hashes:
+            return [_PRIME] * self.num_perm
+        return [min((a * h + b) % _PRIME for h in hashes) for a, b in self._perms]
+
+    def band_keys(self, sig: list[int]) -> dict[int, list[int]]:
+        """Bucket ids of sig for each layer, keyed by rows per band."""
+        return {rows: [_band_key(rows, i, sig[i * rows:(i + 1) * rows]) for i in range(self.num_perm // rows)]
+                for rows in _LAYERS}
+
+    def _layer_for(self, query_size: int, other_size: int, threshold: float) -> t.Optional[int]:
+        """Widest band (most rows) that finds a threshold match with probability >= recall, or None."""
+        j = _min_jaccard(query_size, other_size, threshold)
+        for rows in reversed(_LAYERS):
+            bands = self.num_perm // rows
+            if 1 - (1 - j ** rows) ** bands >= self.recall:
+                return rows
+        return None
+
+    def _size_limits(self, query_size: int, threshold: float) -> tuple[int, int]:
+        """
+        Sizes (in tokens) between which some layer is good enough for this query. Outside them,
+        clusters must be scanned. The minimum Jaccard falls off as sizes diverge, so bisect each side.
+        """
+        if self._layer_for(query_size, query_size, threshold) is None:
+            return query_size + 1, query_size  # Nothing is good enough. Empty range.
+
+        lo, hi = 0, query_size
+        while lo < hi:  # smallest size that's still good enough
+            mid = (lo + hi) // 2
+            if self._layer_for(query_size, mid, threshold) is None:
+                lo = mid + 1
+            else:
+                hi = mid
+        low_limit = lo
+
+        lo, hi = query_size, query_size * 1024 + 1024
+        while lo < hi:  # largest size that's still good enough
+            mid = (lo + hi + 1) // 2
+            if self._layer_for(query_size, mid, threshold) is None:
+                hi = mid - 1
+            else:
+                lo = mid
+        return low_limit, lo
+
+    # Updates
+    #--------
+    def set_representative(self, cluster: Path, rep: Path, rep_size: int, tokens: t.Collection[str]) -> None:
+        """Index (or re-index) a cluster under a new representative file."""
+        keys = self.band_keys(self.signature(tokens))
+        db = self._db()
+        with db:
+            db.execute('BEGIN')
+            db.execute('DELETE FROM buckets WHERE dir = ?', (str(cluster),))
+            db.execute('INSERT OR REPLACE INTO clusters VALUES (?, ?, ?, ?)',
+                       (str(cluster), str(rep), rep_size, len(tokens)))
+            db.executemany('INSERT INTO buckets VALUES (?, ?)',
+                           [(k, str(cluster)) for layer in keys.values() for k in layer])
+
+    def add_member(self, cluster: Path, member: Path, size: int, tokens: t.Collection[str]) -> None:
+        """Record a file moved into cluster. It becomes the representative if it's the largest on disk."""
+        row = self._db().execute('SELECT rep_size FROM clusters WHERE dir = ?', (str(cluster),)).fetchone()
+        if row is None or size > row[0]:
+            self.set_representative(cluster, member, size, tokens)
+
+    def remove(self, cluster: Path) -> None:
+        db = self._db()
+        with db:
+            db.execute('BEGIN')
+            db.execute('DELETE FROM buckets WHERE dir = ?', (str(cluster),))
+            db.execute('DELETE FROM clusters WHERE dir = ?', (str(cluster),))
+
+    def clear(self) -> None:
+        db = self._db()
+        with db:
+            db.execute('BEGIN')
+            db.execute('DELETE FROM buckets')
+            db.execute('DELETE FROM clusters')
+
+    def clusters(self) -> dict[Path, tuple[Path, int]]:
+        """All indexed clusters as {dir: (representative, size on disk)}."""
+        return {Path(d): (Path(r), s) for d, r, s in self._db().execute('SELECT dir, rep, rep_size FROM clusters')}
+
+    # Queries
+    #--------
+    def candidates(self, tokens: t.Collection[str], threshold_pct: float) -> list[Path]:
+        """Clusters that may reach threshold_pct similarity to tokens, in index order."""
+        threshold = threshold_pct / 100
+        query_size = len(tokens)
+        db = self._db()
+
+        found: set[str] = set()
+        low, high = self._size_limits(query_size, threshold)
+        forced = {d for (d,) in db.execute('SELECT dir FROM clusters WHERE n_tokens < ? OR n_tokens > ?', (low, high))}
+        found |= forced
+
+        if low <= high:
+            sizes = dict(db.execute('SELECT dir, n_tokens FROM clusters WHERE n_tokens BETWEEN ? AND ?', (low, high)))
+            for rows, keys in self.band_keys(self.signature(tokens)).items():
+                marks = ','.join('?' * len(keys))
+                for (d,) in db.execute(f'SELECT DISTINCT dir FROM buckets WHERE key IN ({marks})', keys):
+                    # Only trust the layer that was chosen for this cluster's size.
+                    if d in sizes and self._layer_for(query_size, sizes[d], threshold) == rows:
+                        found.add(d)
+
+        self.queries += 1
+        self.candidates_returned += len(found)
+        self.forced += len(forced)
+        return [Path(d) for d in sorted(found)]
+
+    # Reporting
+    #----------
+    def counters(self) -> dict[str, int]:
+        return {'queries': self.queries, 'candidates': self.candidates_returned, 'forced': self.forced,
+                'verified': self.verified, 'mismatches': self.mismatches}
+
+    def reset_counters(self) -> None:
+        self.queries = self.candidates_returned = self.forced = self.verified = self.mismatches = 0
+
+    @staticmethod
+    def summary(counters: dict[str, int], cluster_count: int) -> str:
+        per_query = counters['candidates'] / counters['queries'] if counters['queries'] else 0
+        msg = (f'LSH index: {counters["queries"]} queries, {per_query:.1f} candidates per query '
+               f'({counters["forced"]} forced by size) out of {cluster_count} clusters')
+        if counters['verified']:
+            msg += f'. Verified {counters["verified"]} against full scan: {counters["mismatches"]} mismatches'
+        return msg
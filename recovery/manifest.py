@@ -0,0 +1,129 @@
+"""
+Review, carry out or throw away the moves that virtual sorting (Config.VIRTUAL_SORT) or a dry run
+of sort recorded in the manifest.
+
+    python3 -m manifest [show|apply|discard]
+"""
+import os
+import sys
+from pathlib import Path
+
+from common import Config as C
+from common import cprintif, path_short_name
+from layout import is_cluster_dir
+from metrics import metrics
+from sort import make_target_dir
+from state import ManifestEntry, state_store
+
+MANIFEST_MSG_COLOR = 'light_blue'
+WARN_MSG_COLOR = 'light_yellow'
+DANGER_MSG_COLOR = 'light_red'
+
+
+def sname(path: Path) -> str:
+    """Return shortened name of path. Hard-coded to 30 characters."""
+    return path_short_name(path, 30)
+
+
+def show_plan(entries: list[ManifestEntry]) -> None:
+    """Print the plan one destination dir at a time, deletions first."""
+    by_dir: dict[Path, list[ManifestEntry]] = {}
+    for entry in entries:
+        by_dir.setdefault(entry.dir, []).append(entry)
+
+    if None in by_dir:
+        deletions = by_dir.pop(None)
+        cprintif(f'Delete ({len(deletions)} files):', WARN_MSG_COLOR)
+        for entry in deletions:
+            cprintif(f'  {entry.file}')
+    for dir, dir_entries in by_dir.items():
+        cprintif(f'{dir} ({len(dir_entries)} files):', MANIFEST_MSG_COLOR)
+        for entry in dir_entries:
+            score = f'  [{entry.score:.2f}%]' if entry.score is not None else ''
+            cprintif(f'  {entry.name} <- {entry.file}{score}')
+
+
+def _free_path(path: Path) -> Path:
+    """path, or path with a number added if something's already there."""
+    index = 1
+    free = path
+    while free.exists():
+        free = path.with_name(f'{path.stem} ({index}){path.suffix}')
+        index += 1
+    return free
+
+
+def apply_manifest() -> dict[str, int]:
+    """
+    Carry out the manifest. A file that stays on its device is renamed, which is instant and
+    atomic; one that changes device is copied and deleted through StateStore.move(). Each entry is
+    dropped once it's done, so an interrupted apply can be run again. Returns counts of what was done.
+    """
+    store = state_store()
+    store.recover()
+    m = metrics()
+    done = {"renamed": 0, "copied": 0, "deleted": 0, "missing": 0}
+    made_dirs: dict[Path, tuple[Path, int]] = {}  # Planned dir -> (dir as created, its device)
+
+    pending = store.manifest()
+    sources = {e.file for e in pending}
+    while pending:
+        waiting = []
+        for entry in pending:
+            file = entry.file
+            if not file.exists():
+                # Done by an apply that was interrupted before it could drop the entry
+                done["missing"] += 1
+            elif entry.dir is None:
+                cprintif(f'  {sname(file)} -> Deleted.', WARN_MSG_COLOR)
+                file.unlink()
+                done["deleted"] += 1
+            else:
+                if entry.dir not in made_dirs:
+                    if is_cluster_dir(entry.dir):
+                        dir = make_target_dir(entry.dir)
+                    else:
+                        (dir := entry.dir).mkdir(parents=True, exist_ok=True)
+                    made_dirs[entry.dir] = (dir, dir.stat().st_dev)
+                dir, device = made_dirs[entry.dir]
+                dst = dir / entry.name
+                if dst in sources and dst.exists() and len(waiting) < len(pending) - 1:
+                    # Another file is still to move out of the way. Come back to this one.
+                    waiting.append(entry)
+                    continue
+
+                dst = _free_path(dst)
+                with m.timer("move"):
+                    if file.stat().st_dev == device:
+                        os.rename(file, dst)
+                        done["renamed"] += 1
+                    else:
+                        store.move(file, dst)
+                        done["copied"] += 1
+                cprintif(f'  {sname(file)} -> {sname(dir)}{sname(dst)}')
+            sources.discard(file)
+            store.unassign(file)
+        pending = waiting
+    store.flush()
+    return done
+
+
+if __name__ == '__main__':
+    C.set_app_dir(Path(__file__).parent.parent.resolve())
+    C.set_run_quiet(False)
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'show'
+    store = state_store()
+    if command == 'show':
+        entries = store.manifest()
+        show_plan(entries)
+        cprintif(f'{len(entries)} planned moves', MANIFEST_MSG_COLOR)
+    elif command == 'apply':
+        done = apply_manifest()
+        cprintif(f'{done["renamed"]} files renamed, {done["copied"]} copied across devices, '
+                 f'{done["deleted"]} deleted', MANIFEST_MSG_COLOR)
+    elif command == 'discard':
+        cprintif(f'{store.clear_manifest()} planned moves discarded. No files were touched.', WARN_MSG_COLOR)
+    else:
+        cprintif(f'Unknown command {command!r}. Use show, apply or discard.', DANGER_MSG_COLOR)
+        exit(1)
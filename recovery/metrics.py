@@ -0,0 +1,161 @@
+import json
+import os
+import time
+import typing as t
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+# Prefix for everything in the Prometheus textfile
+_PROM_PREFIX = 'journal_recovery'
+
+
+class Metrics():
+    """
+    Stage timers and event counters for this process. Each pool worker has its own. The parent
+    collects their snapshot()s, and a MetricsExporter writes out the totals.
+
+    Timers are exclusive: when stages nest (say, reading a representative for the first time
+    while scoring), the inner stage's time is taken out of the outer one. So the stages add up
+    to the time spent in all of them.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.secs: dict[str, float] = {}
+        self.calls: dict[str, int] = {}
+        self.counts: dict[str, int] = {}
+        self._stack: list[float] = []  # Time spent in nested stages, per open timer
+
+    @contextmanager
+    def timer(self, stage: str) -> t.Iterator[None]:
+        self._stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            inner = self._stack.pop()
+            self.secs[stage] = self.secs.get(stage, 0.0) + elapsed - inner
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def snapshot(self, **groups: dict[str, int]) -> dict[str, dict]:
+        """Copy of the metrics so far. Other counters can be folded in, e.g. cache={'misses': 3} as cache_misses."""
+        counts = dict(self.counts)
+        for group, counters in groups.items():
+            counts.update({f'{group}_{k}': v for k, v in counters.items()})
+        return {'secs': dict(self.secs), 'calls': dict(self.calls), 'counts': counts}
+
+
+def merge(snapshots: t.Iterable[dict[str, dict]]) -> dict[str, dict]:
+    """Sum of several processes' snapshots."""
+    total = {'secs': {}, 'calls': {}, 'counts': {}}
+    for snapshot in snapshots:
+        for kind, values in total.items():
+            for k, v in snapshot.get(kind, {}).items():
+                values[k] = values.get(k, 0) + v
+    return total
+
+
+def stage_summary(snapshot: dict[str, dict]) -> str:
+    """One line of where the time went, biggest stage first."""
+    stages = sorted(snapshot['secs'].items(), key=lambda _: -_[1])
+    return 'Time by stage: ' + ', '.join(f'{stage} {secs:.1f}s' for stage, secs in stages)
+
+
+class MetricsExporter():
+    """
+    Writes the latest metrics from every process to dir every interval seconds, as metrics.json
+    and as metrics.prom (Prometheus text format, for node_exporter's textfile collector). Files are
+    replaced atomically, so a reader never sees half of one.
+    """
+
+    def __init__(self, dir: Path, interval: float, run: str):
+        self.dir = dir
+        self.interval = interval
+        self.run = run
+        self.started = time.time()
+        self._written = 0.0
+        self._latest: dict[str, dict] = {}  # Latest snapshot per process
+
+    def update(self, worker: t.Union[int, str], snapshot: dict[str, dict]) -> None:
+        """Record a process's latest snapshot. Snapshots are cumulative, so this replaces the last one."""
+        self._latest[str(worker)] = snapshot
+
+    def maybe_write(self, files_total: int) -> bool:
+        if time.time() - self._written < self.interval:
+            return False
+        self.write(files_total)
+        return True
+
+    def report(self, files_total: int) -> dict:
+        totals = merge(self._latest.values())
+        elapsed = time.time() - self.started
+        done = totals['counts'].get('files', 0)
+        return {
+            'run': self.run,
+            'pid': os.getpid(),
+            'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'updated': datetime.now().isoformat(timespec='seconds'),
+            'elapsed_secs': elapsed,
+            'files_total': files_total,
+            'files_done': done,
+            'files_per_sec': done / elapsed if elapsed else 0.0,
+            'comparisons_per_file': totals['counts'].get('comparisons', 0) / done if done else 0.0,
+            'totals': totals,
+            'workers': self._latest,
+        }
+
+    def write(self, files_total: int) -> None:
+        report = self.report(files_total)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._replace(self.dir / 'metrics.json', json.dumps(report, indent=2))
+        self._replace(self.dir / 'metrics.prom', _prometheus(report))
+        self._written = time.time()
+
+    @staticmethod
+    def _replace(path: Path, text: str) -> None:
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        tmp.write_text(text)
+        os.replace(tmp, path)
+
+
+def _prometheus(report: dict) -> str:
+    run = report['run']
+    lines = []
+
+    def metric(name: str, kind: str, help: str, samples: t.Iterable[tuple[dict[str, str], float]]) -> None:
+        lines.append(f'# HELP {_PROM_PREFIX}_{name} {help}')
+        lines.append(f'# TYPE {_PROM_PREFIX}_{name} {kind}')
+        for labels, value in samples:
+            label_str = ','.join(f'{k}="{v}"' for k, v in {'run': run, **labels}.items())
+            lines.append(f'{_PROM_PREFIX}_{name}{{{label_str}}} {value}')
+
+    metric('files_total', 'gauge', 'Files this run started with.', [({}, report['files_total'])])
+    metric('files_done', 'gauge', 'Files placed so far.', [({}, report['files_done'])])
+    metric('files_per_second', 'gauge', 'Files placed per second, over the whole run.', [({}, report['files_per_sec'])])
+    metric('stage_seconds_total', 'counter', 'Time spent in each stage, per process.',
+           [({'stage': stage, 'worker': worker}, secs)
+            for worker, snapshot in report['workers'].items() for stage, secs in snapshot['secs'].items()])
+    metric('stage_calls_total', 'counter', 'Times each stage ran, over all processes.',
+           [({'stage': stage}, calls) for stage, calls in report['totals']['calls'].items()])
+    metric('events_total', 'counter', 'Counted events (comparisons, bytes read, cache hits, ...), over all processes.',
+           [({'name': name}, count) for name, count in report['totals']['counts'].items()])
+    return '\n'.join(lines) + '\n'
+
+
+# Common instances
+#-----------------
+_metrics = Metrics()
+
+
+def metrics() -> Metrics:
+    """This process's metrics."""
+    return _metrics
@@ -0,0 +1,137 @@
+"""
+Reads files ahead of when they're needed, on a few threads, so that tokenizing one file overlaps
+waiting on the disk for the next. It matters most when SOURCE_DIR is on a slow network mount.
+"""
+import time
+import typing as t
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from metrics import metrics
+
+
+def _read(file: Path) -> tuple[bytes, float]:
+    """file's contents, and how long it took to read them."""
+    start = time.perf_counter()
+    data = file.read_bytes()
+    return data, time.perf_counter() - start
+
+
+class Prefetcher():
+    """
+    Reads scheduled files, in the order they were scheduled, up to depth files and mem_mb of them
+    ahead of take(). Files are expected to be taken in that order too: taking one drops anything
+    scheduled before it that wasn't taken, so files that turn out not to be needed don't hold the
+    rest up. skip(file) says a file needn't be read after all (say, because its tokens are cached).
+
+    Use it from one thread. The reads happen on threads of its own.
+    """
+
+    def __init__(self, depth: int, mem_mb: int, threads: int, skip: t.Callable[[Path], bool]):
+        self.depth = depth
+        self.mem_budget = mem_mb * 2**20
+        self.skip = skip
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='prefetch')
+        self._queue: deque[Path] = deque()  # Scheduled and not started
+        self._queued: set[Path] = set()
+        self._started: OrderedDict[Path, tuple[Future, int]] = OrderedDict()  # Read or being read, with sizes
+        self._buffered = 0  # Bytes of the files in _started
+        self.reset_counters()
+
+    def schedule(self, files: t.Iterable[Path]) -> None:
+        """Read files ahead, in this order. Ones already scheduled keep their place."""
+        for file in files:
+            if file not in self._queued and file not in self._started:
+                self._queue.append(file)
+                self._queued.add(file)
+        self._fill()
+
+    def _fill(self) -> None:
+        while self._queue and len(self._started) < self.depth:
+            file = self._queue[0]
+            try:
+                size = None if self.skip(file) else file.stat().st_size
+            except OSError:
+                size = None  # Let whoever wants it find out what's wrong
+            if size is not None and size > self.mem_budget:
+                self.too_big += 1
+                size = None
+            if size is not None and self._buffered + size > self.mem_budget:
+                return  # Wait for room
+
+            self._queue.popleft()
+            self._queued.discard(file)
+            if size is not None:
+                self._started[file] = (self._pool.submit(_read, file), size)
+                self._buffered += size
+                self.reads += 1
+
+    def _drop(self, file: Path) -> tuple[Future, int]:
+        future, size = self._started.pop(file)
+        self._buffered -= size
+        return future
+
+    def take(self, file: Path) -> t.Optional[bytes]:
+        """file's contents if they were read ahead, after waiting for the read if need be. Otherwise None."""
+        if file in self._queued:
+            # Asked for before its turn. Nothing ahead of it will be wanted.
+            while self._queue.popleft() != file:
+                pass
+            self._queued.clear()
+            self._queued.update(self._queue)
+            self._drop_all_started()
+        if file not in self._started:
+            self._fill()
+            return None
+
+        while (older := next(iter(self._started))) != file:
+            self._drop(older).cancel()
+            self.unused += 1
+        future = self._drop(file)
+        if future.done():
+            self.ready += 1
+        else:
+            self.waited += 1
+            start = time.perf_counter()
+            with metrics().timer('prefetch_wait'):
+                future.exception()
+            self.wait_ms += int(1000 * (time.perf_counter() - start))
+        self._fill()
+
+        if future.exception() is not None:
+            return None  # Let the caller read it again and deal with the error
+        data, secs = future.result()
+        self.read_ms += int(1000 * secs)
+        self.bytes += len(data)
+        return data
+
+    def _drop_all_started(self) -> None:
+        for file in list(self._started):
+            self._drop(file).cancel()
+            self.unused += 1
+
+    def clear(self) -> None:
+        """Forget everything scheduled. Reads in progress finish, but nobody gets them."""
+        self._queue.clear()
+        self._queued.clear()
+        self._drop_all_started()
+
+    # Reporting
+    #----------
+    def counters(self) -> dict[str, int]:
+        return {'reads': self.reads, 'ready': self.ready, 'waited': self.waited, 'unused': self.unused,
+                'too_big': self.too_big, 'bytes': self.bytes, 'read_ms': self.read_ms, 'wait_ms': self.wait_ms}
+
+    def reset_counters(self) -> None:
+        self.reads = self.ready = self.waited = self.unused = self.too_big = 0
+        self.bytes = self.read_ms = self.wait_ms = 0
+
+    @staticmethod
+    def summary(counters: dict[str, int]) -> str:
+        # Time spent reading that nobody had to wait for
+        hidden = max(0, counters['read_ms'] - counters['wait_ms']) / 1000
+        return (f'Prefetch: {counters["ready"] + counters["waited"]} files read ahead '
+                f'({counters["bytes"] / 2**20:.1f} MB), {counters["ready"]} ready when needed, '
+                f'{counters["waited"]} waited for, {counters["unused"]} unused, {counters["too_big"]} too big. '
+                f'{hidden:.1f}s of the {counters["read_ms"] / 1000:.1f}s spent reading was hidden')
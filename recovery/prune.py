@@ -1,9 +1,18 @@
+import multiprocessing as mp
+import tempfile
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from shutil import copy
 
-import nltk
 from common import Config as C
-from common import compare_to_rtf, largest_file, read_rtf, path_short_name, cprintif
+from common import (batched, compare_to_rtf, cprintif, ensure_tokenizer_data,
+                    file_digest, file_tokens, iter_files, mp_context,
+                    path_short_name, pseudo_jaccard_similarity, token_cache)
+from layout import cluster_dirs, remove_cluster_dir
+from registry import cluster_registry
+from state import ManifestEntry, check_no_plan, state_store
+from tokencache import TokenCache
+from vectorsim import RepresentativeMatrix, token_array
 
 PRUNE_MSG_COLOR = 'light_blue'
 WARN_MSG_COLOR = 'light_yellow'
@@ -22,49 +31,164 @@ def check_dir_for_one_file(dir: Path) -> bool:
 
 def sanity_check() -> list[Path]:
     """Return paths that don't have only one file in them."""
-    ret = []
-    for subdir in C.SORTING_DIR.iterdir():
-        if subdir.is_dir() and subdir != C.UNREADABLE_DIR and not check_dir_for_one_file(subdir):
-            ret.append(subdir)
-    return ret
-
-def prune_similar_files() -> int:
+    registry = cluster_registry()
+    registry.refresh_if_changed()
+    return [c.dir for c in registry.clusters() if c.members != 1]
+
+class PruneDecision(t.NamedTuple):
+    """What prune will do with one file: delete it, or return it to SOURCE_DIR to be sorted again."""
+    dir: Path
+    file: Path
+    match: float
+    delete: bool
+
+
+def plan_dir(dir: Path, largest: Path, members: t.Optional[list[Path]] = None) -> tuple[list[PruneDecision], int]:
+    """
+    Decide the fate of every file in dir except largest, without touching any of them. Each file is
+    tokenized once and all of them are scored against largest in one batch. Returns the decisions,
+    in file name order, and how many comparisons were skipped because files were byte-identical.
+    members defaults to the files on disk in dir.
+    """
+    members = sorted(f for f in (iter_files(dir) if members is None else members) if f != largest)
+    if C.TOKEN_CACHE_ENABLED or C.SIMILARITY_BACKEND == 'numpy':
+        largest_tokens = file_tokens(largest).tokens
+
+    # Byte-identical files get the same match as the first one we compared
+    matches = {}
+    skipped = 0
+    to_score: dict[Path, frozenset] = {}
+    if C.DEDUP_ENABLED:
+        digests = {f: file_digest(f) for f in members}
+        matches[file_digest(largest)] = 100.0
+        first_of = {}
+        for f in members:
+            if digests[f] in matches or digests[f] in first_of:
+                skipped += 1
+            else:
+                first_of[digests[f]] = f
+                to_score[f] = file_tokens(f).tokens
+    else:
+        to_score = {f: file_tokens(f).tokens for f in members}
+
+    if C.SIMILARITY_BACKEND == 'numpy':
+        # Score them all at once. The measure is symmetric, so largest can be the query.
+        matrix = RepresentativeMatrix()
+        for f, tokens in to_score.items():
+            matrix.set(f, tokens)
+        files, scores = matrix.scores(token_array(largest_tokens))
+        scored = dict.fromkeys(to_score, 0.0) | {f: 100 * float(m) for f, m in zip(files, scores)}
+    elif C.TOKEN_CACHE_ENABLED:
+        scored = {f: 100 * pseudo_jaccard_similarity(tokens, largest_tokens) for f, tokens in to_score.items()}
+    else:
+        # The original path, prefix check and all, as sort takes without the cache
+        scored = {f: compare_to_rtf(tokens, largest) for f, tokens in to_score.items()}
+
+    if C.DEDUP_ENABLED:
+        matches |= {digests[f]: m for f, m in scored.items()}
+        scored = {f: matches[digests[f]] for f in members}
+
+    return [PruneDecision(dir, f, scored[f], scored[f] >= C.MATCH_RATIO_THRESHOLD) for f in members], skipped
+
+
+def _init_worker(mp_cfg_file: Path) -> None:
+    """Runs once in each pool worker."""
+    C.load(mp_cfg_file)
+
+
+def _plan_dirs_mp(clusters: list[tuple[Path, Path, list[Path]]]) -> list[tuple[list[PruneDecision], int]]:
+    """Pool task. Plans a chunk of (dir, largest file, members)."""
+    return [plan_dir(*cluster) for cluster in clusters]
+
+
+def plan_prune(workers: int = 1) -> tuple[list[PruneDecision], int]:
+    """
+    Plan a prune of every cluster, in parallel when workers > 1. The decisions come back in
+    (dir, file) order, so the same tree always gives the same plan.
+    """
+    registry = cluster_registry()
+    registry.refresh_if_changed()
+    # Dirs with one file have nothing to prune
+    clusters = sorted((c.dir, c.rep, registry.members(c.dir)) for c in registry.clusters() if c.members > 1)
+
+    if workers > 1 and len(clusters) > 1:
+        with tempfile.NamedTemporaryFile('wb') as f:
+            config_file = C.dump(f)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context(__name__),
+                                     initializer=_init_worker, initargs=(config_file,)) as pool:
+                chunks = pool.map(_plan_dirs_mp, batched(clusters, C.MP_CHUNK_SIZE))
+                plans = [plan for chunk in chunks for plan in chunk]
+    else:
+        plans = [plan_dir(*cluster) for cluster in clusters]
+
+    decisions = [d for plan, _ in plans for d in plan]
+    return decisions, sum(skipped for _, skipped in plans)
+
+
+def apply_prune(decisions: list[PruneDecision]) -> int:
+    """
+    Carry out a plan from plan_prune(), in order. Returns the number of files deleted. With
+    Config.VIRTUAL_SORT, deleting and returning files only go in the manifest.
+    """
     pruned = 0
-    for dir in C.SORTING_DIR.iterdir():
-        if dir.is_dir() and dir != C.UNREADABLE_DIR:
+    registry = cluster_registry()
+    store = state_store()
+    dir = None
+    for decision in decisions:
+        if decision.dir != dir:
+            dir = decision.dir
             cprintif(f'Working in {sname(dir)}', PRUNE_MSG_COLOR)
-            # Compare to the largest file on disk because sortem does.
-            largest = largest_file(dir)
-
-            for file in dir.iterdir():
-                if file.is_file() and file != largest:
-                    source_tokens = set(nltk.word_tokenize(read_rtf(file)))
-                    match = compare_to_rtf(source_tokens, largest)
-                    
-                    if  match >= C.MATCH_RATIO_THRESHOLD:
-                        cprintif(f'  {sname(file)} match {match:.2f}% -> Deleted.', WARN_MSG_COLOR)
-                        file.unlink()
-                        pruned += 1
-                    else:
-                        cprintif(f'  {sname(file)} match {match:.2f}% -> Returned to /{C.SOURCE_DIR.stem}')
-                        copy(file, C.SOURCE_DIR / file.name)
-                        file.unlink()
+
+        file, match = decision.file, decision.match
+        if decision.delete:
+            cprintif(f'  {sname(file)} match {match:.2f}% -> Deleted.', WARN_MSG_COLOR)
+            if C.VIRTUAL_SORT:
+                store.assign(ManifestEntry(file, None, None, file.stat().st_size))
+            else:
+                file.unlink()
+            pruned += 1
+        else:
+            cprintif(f'  {sname(file)} match {match:.2f}% -> Returned to /{C.SOURCE_DIR.stem}')
+            if C.VIRTUAL_SORT:
+                # Keep the name it was sorted under, as a real move would
+                name = store.destination(file).name
+                store.assign(ManifestEntry(file, C.SOURCE_DIR, name, file.stat().st_size))
+            else:
+                store.move(file, C.SOURCE_DIR / file.name)
+        registry.remove_member(dir, file, virtual=C.VIRTUAL_SORT)
+        store.forget(file)
+    store.flush()
     return pruned
 
 
+def prune_similar_files(workers: int = 1) -> int:
+    """Delete files that match their dir's largest file, and return the rest to SOURCE_DIR. Returns the number deleted."""
+    if not C.VIRTUAL_SORT:
+        check_no_plan()
+    if state_store().recover():
+        cluster_registry().reconcile()
+    decisions, skipped = plan_prune(workers)
+    if skipped:
+        cprintif(f'{skipped} comparisons skipped for byte-identical files', PRUNE_MSG_COLOR)
+    return apply_prune(decisions)
+
+
 def remove_empty_sorting_dirs() -> None:
-    for subdir in C.SORTING_DIR.iterdir():
-        if subdir.is_dir() and subdir != C.UNREADABLE_DIR:
+    registry = cluster_registry()
+    for subdir in cluster_dirs():
+        if not registry.member_count(subdir):
             if not len([i for i in subdir.iterdir()]):  # If empty
                 cprintif(f'  Deleting /{sname(subdir)}', WARN_MSG_COLOR)
-                subdir.rmdir()
+                remove_cluster_dir(subdir)
+                registry.remove_cluster(subdir)
+                state_store().remove_cluster(subdir)
 
 
 if __name__ == '__main__':
     C.set_app_dir(Path(__file__).parent.parent.resolve())
     C.set_match_ratio_threshold(90)
     C.set_run_quiet(False)
-    nltk.download('punkt', quiet=True)  # Needed by nltk
+    ensure_tokenizer_data()
     
     opening_msgs = [
         '----------------------',
@@ -76,8 +200,10 @@ if __name__ == '__main__':
     cprintif('\n'.join(opening_msgs))
     
     cprintif('Pruning similar files')
-    pruned = prune_similar_files()
+    pruned = prune_similar_files(workers=max(1, mp.cpu_count() - 1))
     cprintif(f'{pruned} files removed.', WARN_MSG_COLOR)
+    if C.TOKEN_CACHE_ENABLED:
+        cprintif(TokenCache.summary(token_cache().counters()))
 
     cprintif('----------------------')
     cprintif('Removing empty sorting dirs')
@@ -0,0 +1,406 @@
+import os
+import typing as t
+from dataclasses import dataclass
+from pathlib import Path
+
+from common import (Config, OverlapIndex, file_digest, file_tokens, iter_files,
+                    lsh_index, prefetcher)
+from layout import cluster_dirs, is_cluster_dir, member_index, tree_mtime
+from state import state_store
+from vectorsim import RepresentativeMatrix
+
+
+class ClusterDelta(t.NamedTuple):
+    """The full state of one cluster as of a registry version. Applying it twice is harmless."""
+    version: int
+    dir: Path
+    rep: t.Optional[Path]
+    rep_size: int
+    members: int
+    tokens: t.Optional[frozenset]
+    digest: t.Optional[str]
+
+
+class RegistrySnapshot(t.NamedTuple):
+    """
+    Everything a worker needs to score files, without reading SORTING_DIR or any representative:
+    each cluster's state and, for the 'numpy' backend, the representatives' token arrays instead of
+    their token sets.
+    """
+    clusters: list[ClusterDelta]
+    arrays: t.Optional[dict[Path, t.Any]]
+
+
+@dataclass
+class Cluster():
+    """
+    A cluster dir in SORTING_DIR (see layout.py). Its representative is the largest file, which is what sort compares to.
+    With virtual sorting, the dir and its files may only exist in the manifest so far.
+    """
+    dir: Path
+    rep: t.Optional[Path] = None
+    rep_size: int = -1
+    members: int = 0
+    tokens: t.Optional[frozenset] = None
+    digest: t.Optional[str] = None  # Of the representative's bytes, if known
+
+
+class ClusterRegistry():
+    """
+    In-memory view of the clusters in SORTING_DIR, loaded with one pass over the tree.
+
+    Sort and prune tell the registry about every file they move in or out, so they don't have to
+    list and stat SORTING_DIR for each file. Call reconcile() to re-read the tree from disk.
+
+    Files that the manifest (see StateStore) has placed in a cluster count as members of it, wherever
+    they are on disk. Files the manifest has moved elsewhere don't count where they are.
+
+    Each process has its own registry. refresh_if_changed() picks up clusters that other processes
+    created or removed, at the cost of one stat() of SORTING_DIR (and a listing of it, in the
+    sharded layout). Or, when one process owns all changes, it can hand out deltas that the others
+    apply().
+
+    `version` counts changes to cluster representatives since the last reconcile().
+
+    The process that places files also numbers them: claim_index() counts up from the highest
+    member index in each cluster, so naming a file doesn't mean counting or probing the dir.
+    """
+
+    def __init__(self, sorting_dir: Path, ignores: t.Iterable[Path]):
+        self.sorting_dir = sorting_dir
+        self.ignores = set(ignores)
+        self.version = 0
+        self._clusters: dict[Path, Cluster] = {}
+        self._changes: list[Path] = []  # Dir whose representative changed, per version
+        self._digests: dict[str, Path] = {}  # Content digest -> dir, for files we've seen placed
+        self._mtime: t.Any = None  # layout.tree_mtime() when last listed
+        self._matrix: t.Optional[RepresentativeMatrix] = None
+        self._matrix_stale: set[Path] = set()  # Dirs to (re)load into _matrix
+        self._overlap: t.Optional[OverlapIndex] = None
+        self._overlap_stale: set[Path] = set()  # Dirs to (re)load into _overlap
+        self._virtual: dict[Path, dict[Path, int]] = {}  # Dir -> {file: size} of members only in the manifest
+        self._relocated: set[Path] = set()  # Files the manifest has moved away from where they are on disk
+        self._indices: dict[Path, int] = {}  # Dir -> next member index
+
+    # Disk scans
+    #-----------
+    def _scan_cluster(self, dir: Path) -> Cluster:
+        cluster = Cluster(dir)
+        if dir.is_dir():
+            with os.scandir(dir) as it:
+                for entry in it:
+                    if not entry.is_file():
+                        continue
+                    self._count_index(dir, entry.name)
+                    if not (self._relocated and Path(entry.path) in self._relocated):
+                        cluster.members += 1
+                        size = entry.stat().st_size
+                        if size > cluster.rep_size:
+                            cluster.rep, cluster.rep_size = Path(entry.path), size
+        for file, size in self._virtual.get(dir, {}).items():
+            cluster.members += 1
+            if size > cluster.rep_size:
+                cluster.rep, cluster.rep_size = file, size
+        return cluster
+
+    def _list_dirs(self) -> set[Path]:
+        dirs = {d for d in cluster_dirs() if d not in self.ignores}
+        return dirs | {d for d, files in self._virtual.items() if files}
+
+    def _load_manifest(self) -> None:
+        self._virtual.clear()
+        self._relocated.clear()
+        for entry in state_store().manifest():
+            self._relocated.add(entry.file)
+            if entry.dir and is_cluster_dir(entry.dir) and entry.dir not in self.ignores:
+                self._virtual.setdefault(entry.dir, {})[entry.file] = entry.size
+                self._count_index(entry.dir, entry.name)
+
+    def _count_index(self, dir: Path, name: str) -> None:
+        """Keep claim_index() above the index in name, a member's file name."""
+        index = member_index(name)
+        if index is not None and index >= self._indices.get(dir, 0):
+            self._indices[dir] = index + 1
+
+    def reconcile(self) -> None:
+        """Throw away what we know and re-read SORTING_DIR from disk, and the manifest."""
+        self._mtime = tree_mtime()
+        self._indices.clear()
+        self._load_manifest()
+        self._clusters = {d: self._scan_cluster(d) for d in sorted(self._list_dirs())}
+        self.version = 0
+        self._changes.clear()
+        self._digests.clear()
+        self._matrix = None
+        self._overlap = None
+
+    def refresh_if_changed(self) -> bool:
+        """Pick up clusters created or removed by someone else. Return True if SORTING_DIR had changed."""
+        mtime = tree_mtime()
+        if mtime == self._mtime:
+            return False
+
+        self._mtime = mtime
+        on_disk = self._list_dirs()
+        for d in self._clusters.keys() - on_disk:
+            del self._clusters[d]
+            self._indices.pop(d, None)
+            self._stale(d)
+        for d in sorted(on_disk - self._clusters.keys()):
+            self._clusters[d] = self._scan_cluster(d)
+            self._stale(d)
+        return True
+
+    # Lookups
+    #--------
+    def __len__(self) -> int:
+        return len(self._clusters)
+
+    def clusters(self) -> list[Cluster]:
+        """Clusters with at least one file in them. Rescans any that were empty when last seen."""
+        ret = []
+        for d, cluster in self._clusters.items():
+            if cluster.rep is None:
+                # Could have been mid-creation by another process when we scanned it
+                cluster = self._clusters[d] = self._scan_cluster(d)
+                self._stale(d)
+            if cluster.rep is not None:
+                ret.append(cluster)
+        return ret
+
+    def matrix(self) -> RepresentativeMatrix:
+        """Token arrays of all the representatives, for the 'numpy' similarity backend."""
+        if self._matrix is None:
+            self._matrix = RepresentativeMatrix()
+            self._matrix_stale = set(self._clusters)
+
+        for d in sorted(self._matrix_stale):  # In the order unparsed() promises
+            cluster = self._clusters.get(d)
+            if cluster is None or cluster.rep is None:
+                self._matrix.remove(d)
+            else:
+                self._matrix.set(d, self.tokens(cluster))
+                # The array is all we need for scoring. Don't hold onto the set as well.
+                cluster.tokens = None
+        self._matrix_stale.clear()
+        return self._matrix
+
+    def overlap_index(self) -> OverlapIndex:
+        """The representatives' tokens, for ruling out clusters at MATCH_RATIO_THRESHOLD with the 'set' backend."""
+        if self._overlap is None or self._overlap.threshold != Config.MATCH_RATIO_THRESHOLD:
+            self._overlap = OverlapIndex(Config.MATCH_RATIO_THRESHOLD)
+            self._overlap_stale = set(self._clusters)
+
+        for d in sorted(self._overlap_stale):  # In the order unparsed() promises
+            cluster = self._clusters.get(d)
+            if cluster is None or cluster.rep is None:
+                self._overlap.remove(d)
+            else:
+                self._overlap.set(d, self.tokens(cluster))
+        self._overlap_stale.clear()
+        return self._overlap
+
+    def members(self, dir: Path) -> list[Path]:
+        """Files in the cluster: on disk in dir, or put there by the manifest."""
+        on_disk = list(iter_files(dir)) if dir.is_dir() else []
+        if self._relocated:
+            on_disk = [f for f in on_disk if f not in self._relocated]
+        return on_disk + list(self._virtual.get(dir, {}))
+
+    def get(self, dir: Path) -> t.Optional[Cluster]:
+        return self._clusters.get(dir)
+
+    def member_count(self, dir: Path) -> int:
+        cluster = self._clusters.get(dir)
+        return cluster.members if cluster else 0
+
+    def claim_index(self, dir: Path) -> int:
+        """An index for naming a file placed in dir (see sort.sorted_name()) that no member has used."""
+        index = self._indices.get(dir, 0)
+        self._indices[dir] = index + 1
+        return index
+
+    def changed_since(self, version: int) -> set[Path]:
+        """Dirs whose representative changed after version."""
+        return set(self._changes[version:])
+
+    def delta(self, dir: Path) -> ClusterDelta:
+        cluster = self._clusters[dir]
+        return ClusterDelta(self.version, dir, cluster.rep, cluster.rep_size, cluster.members,
+                            self.tokens(cluster), cluster.digest)
+
+    def snapshot(self) -> RegistrySnapshot:
+        """This registry as it stands, for load() in another process. Parses any representative not parsed yet."""
+        if Config.SIMILARITY_BACKEND == 'numpy' and (not Config.LSH_ENABLED or Config.LSH_VERIFY):
+            # Scoring only uses the matrix. Send its arrays, so the worker doesn't have to hash every token again.
+            arrays = self.matrix().arrays()
+            return RegistrySnapshot([ClusterDelta(self.version, c.dir, c.rep, c.rep_size, c.members, None, c.digest)
+                                     for c in self.clusters()], arrays)
+        return RegistrySnapshot([self.delta(c.dir) for c in self.clusters()], None)
+
+    def load(self, snapshot: RegistrySnapshot) -> None:
+        """Take on another process's snapshot()."""
+        for delta in snapshot.clusters:
+            self.apply(delta)
+        if snapshot.arrays is not None:
+            if self._matrix is None:
+                self._matrix = RepresentativeMatrix()
+            self._matrix.load(snapshot.arrays)
+            self._matrix_stale -= snapshot.arrays.keys()
+
+    def apply(self, delta: ClusterDelta) -> None:
+        """Take on a cluster's state from another process's registry."""
+        self._clusters[delta.dir] = Cluster(delta.dir, delta.rep, delta.rep_size, delta.members, delta.tokens, delta.digest)
+        self._stale(delta.dir)
+        if delta.digest:
+            self._digests[delta.digest] = delta.dir
+        self.version = max(self.version, delta.version)
+
+    def find_digest(self, digest: str) -> t.Optional[Path]:
+        """Dir holding a file with these exact contents, if we've seen one placed."""
+        d = self._digests.get(digest)
+        return d if d in self._clusters else None
+
+    def tokens(self, cluster: Cluster) -> frozenset:
+        """Token set of the cluster's representative. Parsed on first use and kept."""
+        if cluster.tokens is None:
+            data = prefetcher().take(cluster.rep)
+            cluster.tokens = file_tokens(cluster.rep, data).tokens
+            if Config.DEDUP_ENABLED and cluster.digest is None:
+                cluster.digest = file_digest(cluster.rep, data)
+                self._digests.setdefault(cluster.digest, cluster.dir)
+        return cluster.tokens
+
+    def unparsed(self) -> list[Path]:
+        """Representatives that scoring a file will have to parse (or fetch from the token cache), in the order it will."""
+        if Config.SIMILARITY_BACKEND == 'numpy':
+            stale = set(self._clusters) if self._matrix is None else self._matrix_stale
+            return [c.rep for d in sorted(stale) if (c := self._clusters.get(d)) and c.rep]
+        return [c.rep for c in self._clusters.values() if c.rep and c.tokens is None]
+
+    # Updates
+    #--------
+    def add_member(self, dir: Path, file: Path, size: int, tokens: t.Optional[t.Collection[str]] = None,
+                   digest: t.Optional[str] = None, virtual: bool = False) -> Cluster:
+        """
+        Record that file (of size bytes) was moved into dir, or if virtual, that the manifest put it
+        there. Creates the cluster if it's new.
+        """
+        cluster = self._clusters.get(dir)
+        if cluster is None:
+            cluster = self._clusters[dir] = Cluster(dir)
+        if virtual:
+            self._virtual.setdefault(dir, {})[file] = size
+            self._relocated.add(file)
+
+        cluster.members += 1
+        if digest:
+            self._digests[digest] = dir
+        if size > cluster.rep_size:
+            cluster.rep, cluster.rep_size = file, size
+            cluster.tokens = frozenset(tokens) if tokens is not None else None
+            cluster.digest = digest
+            self._changed(dir)
+            if Config.LSH_ENABLED:
+                self._index(cluster)
+        return cluster
+
+    def remove_member(self, dir: Path, file: Path, virtual: bool = False) -> None:
+        """Record that file was moved out of dir or deleted, or if virtual, that the manifest took it out."""
+        cluster = self._clusters.get(dir)
+        if cluster is None:
+            return
+        if virtual:
+            self._virtual.get(dir, {}).pop(file, None)
+            self._relocated.add(file)
+
+        if file == cluster.rep:
+            # Rare: the largest file left. Find the next largest.
+            self._clusters[dir] = self._scan_cluster(dir)
+            self._changed(dir)
+            if Config.LSH_ENABLED and self._clusters[dir].rep is not None:
+                self._index(self._clusters[dir])
+        else:
+            cluster.members -= 1
+
+        if not self._clusters[dir].members and not dir.is_dir():
+            self.remove_cluster(dir)  # Only ever existed in the manifest
+
+    def _changed(self, dir: Path) -> None:
+        self._changes.append(dir)
+        self.version = len(self._changes)
+        self._stale(dir)
+
+    def _stale(self, dir: Path) -> None:
+        """dir's representative needs loading into the matrix and the overlap index again."""
+        self._matrix_stale.add(dir)
+        self._overlap_stale.add(dir)
+
+    def remove_cluster(self, dir: Path) -> None:
+        self._clusters.pop(dir, None)
+        self._virtual.pop(dir, None)
+        self._indices.pop(dir, None)
+        self._stale(dir)
+        if Config.LSH_ENABLED:
+            lsh_index().remove(dir)
+
+    def clear(self) -> None:
+        self._clusters.clear()
+        self._changes.clear()
+        self._digests.clear()
+        self._virtual.clear()
+        self._relocated.clear()
+        self._indices.clear()
+        self._matrix = None
+        self._overlap = None
+        self.version = 0
+        self._mtime = None
+        if Config.LSH_ENABLED:
+            lsh_index().clear()
+
+    # LSH index upkeep
+    #-----------------
+    def _index(self, cluster: Cluster) -> None:
+        lsh_index().set_representative(cluster.dir, cluster.rep, cluster.rep_size, self.tokens(cluster))
+
+    def sync_lsh(self) -> None:
+        """Bring the LSH index in line with this registry."""
+        index = lsh_index()
+        known = index.clusters()
+        current = {c.dir: c for c in self.clusters()}
+
+        for d in known.keys() - current.keys():
+            index.remove(d)
+        for d, cluster in current.items():
+            if d not in known or known[d][0] != cluster.rep:
+                self._index(cluster)
+
+
+# Common instances
+#-----------------
+_registry: t.Optional[ClusterRegistry] = None
+
+
+def cluster_registry() -> ClusterRegistry:
+    """The registry for the current SORTING_DIR. Loaded from disk on first use in each process."""
+    global _registry
+    if _registry is None or _registry.sorting_dir != Config.SORTING_DIR:
+        _registry = ClusterRegistry(Config.SORTING_DIR, ignores=[Config.UNREADABLE_DIR, Config.QUARANTINE_DIR])
+        _registry.reconcile()
+    return _registry
+
+
+def empty_cluster_registry() -> ClusterRegistry:
+    """
+    Start this process's registry empty instead of reading SORTING_DIR, for a worker that gets every
+    cluster from the coordinator, as a snapshot and then deltas.
+    """
+    global _registry
+    _registry = ClusterRegistry(Config.SORTING_DIR, ignores=[Config.UNREADABLE_DIR, Config.QUARANTINE_DIR])
+    return _registry
+
+
+def reset_cluster_registry() -> None:
+    """Forget the registry, e.g. after other processes have changed SORTING_DIR. It's reloaded on next use."""
+    global _registry
+    _registry = None
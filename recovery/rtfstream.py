@@ -0,0 +1,166 @@
+import codecs
+import io
+import locale
+import re
+import typing as t
+from pathlib import Path
+
+from metrics import metrics
+from striprtf.striprtf.striprtf.striprtf import rtf_to_text
+
+# Bytes read from disk at a time
+_CHUNK = 1 << 16
+# Groups whose contents are binary data (hex digits or raw bytes), never text. striprtf ignores
+# them, so dropping them before decoding doesn't change the extracted text.
+_BINARY_GROUPS = rb'pict|objdata|datastore|themedata|colorschememapping'
+# Control words and braces that the filter cares about. Everything else passes through untouched.
+_TOKEN = re.compile(rb'\\bin(\d{1,10}) ?|\\[\\{}]|\{(?:\\\*)?\\(' + _BINARY_GROUPS + rb')(?![a-zA-Z])|[{}]')
+_TOKEN_START = re.compile(rb'[\\{]')
+# Longest token above, plus a lookahead byte. A token may start this close to the end of a chunk
+# without being complete yet, so that much is held back for the next chunk.
+_LOOKBEHIND = 32
+
+
+class BinaryGroupFilter():
+    """
+    Removes embedded binary data from a stream of RTF bytes: \\pict, \\objdata and similar groups,
+    and the raw payload of \\binN. Feed it chunks in order. Memory use doesn't depend on how big
+    the embedded data is.
+    """
+
+    def __init__(self):
+        self._pending = b''  # Held back from the last chunk
+        self._depth = 0  # Group nesting
+        self._skip_depth: t.Optional[int] = None  # Depth of the binary group we're in, if any
+        self._bin_remaining = 0  # Raw \bin bytes still to skip
+
+    def feed(self, data: bytes, final: bool = False) -> bytes:
+        buf = self._pending + data
+        if final:
+            hold = len(buf)
+        else:
+            m = _TOKEN_START.search(buf, max(len(buf) - _LOOKBEHIND, 0))
+            hold = m.start() if m else len(buf)
+
+        out = []
+        pos = 0
+        while pos < hold:
+            if self._bin_remaining:
+                skip = min(self._bin_remaining, len(buf) - pos)
+                pos += skip
+                self._bin_remaining -= skip
+                continue
+
+            m = _TOKEN.search(buf, pos)
+            if m is None or m.start() >= hold:
+                if self._skip_depth is None:
+                    out.append(buf[pos:hold])
+                pos = hold
+                break
+
+            if self._skip_depth is None:
+                out.append(buf[pos:m.start()])
+            token = m.group(0)
+            if m.group(1) is not None:  # \binN: drop the control word and its payload
+                self._bin_remaining = int(m.group(1))
+            elif m.group(2) is not None:
+                self._depth += 1
+                if self._skip_depth is None:
+                    self._skip_depth = self._depth
+            elif token == b'{':
+                self._depth += 1
+                if self._skip_depth is None:
+                    out.append(token)
+            elif token == b'}':
+                if self._skip_depth is None:
+                    out.append(token)
+                elif self._skip_depth == self._depth:
+                    self._skip_depth = None
+                self._depth -= 1
+            elif self._skip_depth is None:  # Escaped \\, \{ or \}
+                out.append(token)
+            pos = m.end()
+
+        self._pending = buf[pos:]
+        return b''.join(out)
+
+
+class RtfReader():
+    """
+    Reads an RTF file incrementally, for when only the start of it may be needed.
+
+    The file is read in chunks, binary groups are filtered out (see BinaryGroupFilter), and the
+    rest is decoded the way open() would. What's been read is kept, so text(500) followed by text()
+    reads the file from disk only once.
+
+    An invalid byte for the encoding ends the file: the text up to that byte is all there is.
+    """
+
+    def __init__(self, source: t.Union[Path, bytes, t.BinaryIO], encoding: t.Optional[str] = None):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self._file = io.BytesIO(source)
+            self._owns_file = True
+        elif isinstance(source, (str, Path)):
+            self._file = open(source, 'rb')
+            self._owns_file = True
+        else:
+            self._file = source
+            self._owns_file = False
+
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self._filter = BinaryGroupFilter()
+        self._decoder = codecs.getincrementaldecoder(self.encoding)()
+        self._newlines = io.IncrementalNewlineDecoder(None, translate=True)
+        self._parts: list[str] = []
+        self._length = 0
+        self._eof = False
+
+    def __enter__(self) -> 'RtfReader':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._owns_file:
+            self._file.close()
+
+    def _decode(self, data: bytes, final: bool) -> str:
+        try:
+            text = self._decoder.decode(data, final)
+        except UnicodeDecodeError as e:
+            # e.start counts from the bytes the decoder was still holding onto
+            held = self._decoder.getstate()[0]
+            text = codecs.decode((held + data)[:e.start], self.encoding)
+            self._eof = final = True
+        return self._newlines.decode(text, final)
+
+    def _read_more(self) -> None:
+        m = metrics()
+        with m.timer('read'):
+            chunk = self._file.read(_CHUNK)
+        m.count('bytes_read', len(chunk))
+        final = not chunk
+        with m.timer('rtf_strip'):
+            text = self._decode(self._filter.feed(chunk, final), final)
+        if text:
+            self._parts.append(text)
+            self._length += len(text)
+        self._eof = self._eof or final
+
+    def rtf(self, length: int = -1) -> str:
+        """The first length characters of RTF markup, without binary groups. All of it if length < 0."""
+        while not self._eof and (length < 0 or self._length < length):
+            self._read_more()
+        if len(self._parts) > 1:
+            self._parts = [''.join(self._parts)]
+        rtf = self._parts[0] if self._parts else ''
+        return rtf if length < 0 else rtf[:length]
+
+    def text(self, length: int = -1) -> str:
+        """Plain text of the first length characters of markup, or of the whole file."""
+        # NB: 'errors' arg is the same as bytes.decode()
+        # See here for possible values: https://docs.python.org/3.10/library/codecs.html#error-handlers
+        rtf = self.rtf(length)
+        with metrics().timer('rtf_strip'):
+            return rtf_to_text(rtf, errors="ignore")
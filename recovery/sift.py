@@ -1,28 +1,32 @@
+import argparse
+import multiprocessing
 from pathlib import Path
-from shutil import copy
 
-import nltk
 import prune as P
 import sort as S
 from common import Config as C
-from common import cprintif
+from common import cprintif, ensure_tokenizer_data, token_cache
+from graph import graph_sift
+from layout import cluster_dirs, is_cluster_dir, remove_cluster_dir
+from manifest import apply_manifest
+from registry import cluster_registry
+from state import ManifestEntry, source_files, state_store
+from tokencache import TokenCache
 
 SIFT_MSG_COLOR = 'light_green'
 WARN_MSG_COLOR = 'light_yellow'
 DANGER_MSG_COLOR = 'light_red'
 
 
-def count_files(dir: Path) -> int:
-    if dir.is_dir():
-        try:
-            return sum(1 for _ in dir.iterdir() if _.is_file())
-        except FileNotFoundError:
-            return 0
-    raise ValueError(f'{dir} is not a directory.')
+def count_unsorted() -> int:
+    """Files waiting in SOURCE_DIR, including any the manifest has sent back there."""
+    if not C.SOURCE_DIR.is_dir():
+        raise ValueError(f'{C.SOURCE_DIR} is not a directory.')
+    return len(source_files())
 
 
 def sort(mp:bool = True) -> int:
-    file_count = count_files(C.SOURCE_DIR)
+    file_count = count_unsorted()
     cprintif('----------------------', SIFT_MSG_COLOR)
     cprintif(f'Sorting {file_count} files', SIFT_MSG_COLOR)
     
@@ -34,11 +38,13 @@ def sort(mp:bool = True) -> int:
     return file_count
 
 
-def prune() -> bool:
+def prune(mp: bool = True) -> bool:
     cprintif('----------------------', SIFT_MSG_COLOR)
     cprintif('Pruning similar files', SIFT_MSG_COLOR)
-    pruned = P.prune_similar_files()
+    pruned = P.prune_similar_files(workers=max(1, multiprocessing.cpu_count() - 1) if mp else 1)
     cprintif(f'{pruned} files removed', WARN_MSG_COLOR)
+    if C.TOKEN_CACHE_ENABLED:
+        cprintif(TokenCache.summary(token_cache().counters()), SIFT_MSG_COLOR)
 
     cprintif('Removing empty sorting dirs', SIFT_MSG_COLOR)
     P.remove_empty_sorting_dirs()                      
@@ -54,52 +60,93 @@ def prune() -> bool:
 def unsort() -> None:
     cprintif('----------------------', SIFT_MSG_COLOR)
     cprintif('Unsorting remaining files', SIFT_MSG_COLOR)
-    for item in C.SORTING_DIR.iterdir():
-        if item.is_dir():
-            for file in item.iterdir():
+    store = state_store()
+    store.recover()
+    if C.VIRTUAL_SORT:
+        _unsort_manifest()
+        return
+
+    # Boilerplate in QUARANTINE_DIR stays out of the way for the rest of the sift
+    for dir in cluster_dirs() + [C.UNREADABLE_DIR]:
+        if dir.is_dir():
+            for file in dir.iterdir():
                 if file.is_file():
-                    copy(file, C.SOURCE_DIR / file.name)
-                    file.unlink()
-            item.rmdir()
-        elif item.is_file():
-            copy(item, C.SOURCE_DIR / item.name)
-            item.unlink()
+                    store.move(file, C.SOURCE_DIR / file.name)
+            remove_cluster_dir(dir)
+    for item in C.SORTING_DIR.iterdir():
+        if item.is_file():
+            store.move(item, C.SOURCE_DIR / item.name)
 
+    cluster_registry().clear()
+    store.clear_sorted()
 
-if __name__ == '__main__':
-    C.set_app_dir(Path(__file__).parent.parent.resolve())  
-    C.set_run_quiet(False)
-    nltk.download('punkt', quiet=True)  # Needed by nltk
-    
-    opening_msgs = [
-        '----------------------',
-        '----------------------',
-        f'Application directory: {C.APP_DIR}',
-        f'Unsorted files in {C.SOURCE_DIR}',
-        f'Sorted files in {C.SORTING_DIR}',
-    ]
-    cprintif('\n'.join(opening_msgs), SIFT_MSG_COLOR)
+
+def _unsort_manifest() -> None:
+    """unsort() for virtual sorting: send everything in SORTING_DIR back to SOURCE_DIR in the manifest."""
+    store = state_store()
+    registry = cluster_registry()
+    # Files that were really moved into a cluster before virtual sorting was turned on
+    for cluster in registry.clusters():
+        for file in registry.members(cluster.dir):
+            if file.parent == cluster.dir:
+                store.assign(ManifestEntry(file, C.SOURCE_DIR, file.name, file.stat().st_size))
+    # Files that are only in SORTING_DIR on paper. They go back under the name they were sorted
+    #   with, as they would in a real move. That includes files with no text, which the flat
+    #   layout sorts into SORTING_DIR itself.
+    for entry in store.manifest():
+        if entry.dir and (is_cluster_dir(entry.dir) or entry.dir in (C.UNREADABLE_DIR, C.SORTING_DIR)):
+            store.assign(entry._replace(dir=C.SOURCE_DIR))
+    store.flush()
+
+    registry.clear()
+    registry.reconcile()
+    store.clear_sorted()
+
+
+def sift(start_thresh: int = 70, max_thresh: int = 95, step: int = 5, mp: bool = True) -> bool:
+    """
+    Sort and prune at rising thresholds until every file is sorted or set aside. False if a sanity
+    check failed. Picks up where the last call left off if it was interrupted.
+    """
+    if C.SIFT_ENGINE == 'graph':
+        return graph_sift(start_thresh, max_thresh, step, max(1, multiprocessing.cpu_count() - 1) if mp else 1)
+
+    store = state_store()
+    store.recover()
+    resume = store.position()
+    if resume:
+        cprintif(f'Resuming at threshold {resume["thresh"]}%, {resume["phase"]} step', WARN_MSG_COLOR)
 
     # Because prune is destructive, it should always run at a very high threshold.
 	#   This will ensure it only destroys with maximum confidence.
     # Sort can be iteratively ratcheted up to meet the same threshold.
-    start_thresh = 70
-    max_thresh = 95
-    for sort_thresh in range(start_thresh, max_thresh + 1, 5):
+    for sort_thresh in range(start_thresh, max_thresh + 1, step):
+        if resume and sort_thresh < resume["thresh"]:
+            continue  # Finished before the interruption
         cprintif('----------------------', SIFT_MSG_COLOR)
         cprintif('----------------------', SIFT_MSG_COLOR)
         cprintif(f'Sorting with threshold: {sort_thresh}%', SIFT_MSG_COLOR)
+
+        if resume and resume["phase"] == 'unsort':
+            # Only the unsort was left to do at this threshold
+            resume = None
+            store.checkpoint(thresh=sort_thresh, phase='unsort')
+            unsort()
+            continue
         
         # Sort/Prune at this threshold until they keep shuffling the same files back and forth
-        prev_count = count_files(C.SOURCE_DIR)
+        prev_count = resume["prev_count"] if resume else count_unsorted()
+        resume = None
         while True:
+            # Restarting a sort or a prune is safe: they only act on what's still to do.
+            store.checkpoint(thresh=sort_thresh, phase='sort', prev_count=prev_count)
             C.set_match_ratio_threshold(sort_thresh)
-            sort()
+            sort(mp)
             C.set_match_ratio_threshold(max_thresh)
-            if not prune():
+            if not prune(mp):
                 # Sanity check failed
-                exit(1)
-            unsorted_count = count_files(C.SOURCE_DIR)
+                return False
+            unsorted_count = count_unsorted()
             if unsorted_count >= prev_count or unsorted_count == 0:
                 break
             prev_count = unsorted_count
@@ -110,11 +157,45 @@ if __name__ == '__main__':
             if sort_thresh == max_thresh:  # Final sort/prune loop completed
                 (unsorted_dir := C.SOURCE_DIR / "unsorted").mkdir(exist_ok=True)
                 cprintif(f'Moving them to {unsorted_dir}', DANGER_MSG_COLOR)
-                for f in C.SOURCE_DIR.iterdir():
-                    if f.is_file():
-                        copy(f, unsorted_dir / f.name)
-                        f.unlink()
+                if C.VIRTUAL_SORT:
+                    for f in source_files():
+                        store.assign(ManifestEntry(f, unsorted_dir, store.destination(f).name, f.stat().st_size))
+                    store.flush()
+                else:
+                    for f in C.SOURCE_DIR.iterdir():
+                        if f.is_file():
+                            store.move(f, unsorted_dir / f.name)
         else:
             cprintif('All files sorted', SIFT_MSG_COLOR)
         
+        store.checkpoint(thresh=sort_thresh, phase='unsort')
         unsort()
+
+    if C.VIRTUAL_SORT:
+        cprintif('----------------------', SIFT_MSG_COLOR)
+        cprintif(f'Applying {store.pending()} planned moves', SIFT_MSG_COLOR)
+        apply_manifest()
+    store.clear_position()
+    return True
+
+
+if __name__ == '__main__':
+    C.set_app_dir(Path(__file__).parent.parent.resolve())  
+    C.set_run_quiet(False)
+    parser = argparse.ArgumentParser(description='Sort and prune at rising thresholds.')
+    parser.add_argument('--engine', choices=['sort', 'graph'], default=C.SIFT_ENGINE,
+                        help="'graph' scores each pair of files once instead of at every threshold")
+    C.set_sift_engine(parser.parse_args().engine)
+    ensure_tokenizer_data()
+    
+    opening_msgs = [
+        '----------------------',
+        '----------------------',
+        f'Application directory: {C.APP_DIR}',
+        f'Unsorted files in {C.SOURCE_DIR}',
+        f'Sorted files in {C.SORTING_DIR}',
+    ]
+    cprintif('\n'.join(opening_msgs), SIFT_MSG_COLOR)
+
+    if not sift():
+        exit(1)
@@ -1,17 +1,38 @@
+import argparse
+import functools
 import multiprocessing as mp
+import os
+import queue
+import socket
+import sys
 import tempfile
+import time
 import typing as t
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from datetime import datetime, timedelta
-from functools import partial
 from pathlib import Path
 from shutil import copy
 from time import sleep
 
-import nltk
+from boilerplate import BoilerplateLibrary, boilerplate_library
 from common import Config as C
-from common import (batch_iterdir, compare_to_rtf, cprintif, largest_file,
-                    path_short_name, read_rtf)
+from common import (OverlapIndex, batched, compare_to_rtf, cprintif,
+                    duplicate_groups, ensure_tokenizer_data, file_digest, file_tokens,
+                    lsh_index, mp_context, path_short_name, prefetcher,
+                    pseudo_jaccard_similarity, token_cache)
+from distributed import LeaseServer, env_authkey, lease_loop, parse_address
+from layout import cluster_dir, cluster_label, make_cluster_dir
+from lsh import LSHIndex
+from metrics import MetricsExporter, merge, metrics, stage_summary
 from pathvalidate import sanitize_filename
+from prefetch import Prefetcher
+from registry import (Cluster, ClusterDelta, RegistrySnapshot, cluster_registry,
+                      empty_cluster_registry)
+from state import ManifestEntry, check_no_plan, source_files, state_store
+from tokencache import CacheEntry, TokenCache
+from vectorsim import require_numpy, token_array
+from watch import DirWatcher
 
 SORT_MSG_COLOR = 'light_blue'
 WARN_MSG_COLOR = 'light_yellow'
@@ -36,73 +57,265 @@ def _safe_make_dir(d: Path):
             cprintif(f'Found something named {d.name} in {d.parent} and renamed it to {d.name}.bak', DANGER_MSG_COLOR)
 
 
-def _print_file_count_msg() -> None:
-    file_count = sum(1 for _ in C.SOURCE_DIR.iterdir() if _.is_file())
+def _print_file_count_msg(file_count: int) -> None:
     cprintif(datetime.now().strftime("%A, %H:%M") + f': {file_count} files remaining', WARN_MSG_COLOR)
 
 
-def sort_file(source_file: Path, mp_cfg_file: Path = None, dry_run: bool=False) -> Path:
-    """Note: Specify config_file when running in multiprocessing mode."""
-    
-    if mp_cfg_file and mp_cfg_file.exists():
-        C.load(mp_cfg_file)
-    
-    file_sname = _sname(source_file)
-    
+class ScoredFile(t.NamedTuple):
+    """A source file's similarity to the clusters, as computed by a worker. Enough to place it without re-reading it."""
+    file: Path
+    entry: t.Optional[CacheEntry]
+    calcs: list[dict[float, Path]]
+    version: int  # Registry version the calcs were computed against
+    error: t.Optional[str] = None
+    digest: t.Optional[str] = None
+    boilerplate: t.Optional[str] = None  # Signature it matched. It goes to QUARANTINE_DIR.
+
+
+# Comparisons we didn't have to make because a file was a byte-identical copy of one already placed
+_dedup = {"files": 0, "comparisons": 0}
+
+
+def score_file(source_file: Path) -> ScoredFile:
+    """The CPU-bound half of sorting a file: read it and compare it to the clusters we know of. Moves nothing."""
+    registry = cluster_registry()
+    data = prefetcher().take(source_file)
+    digest = None
     try:
-        source_text = read_rtf(source_file)
+        if C.DEDUP_ENABLED:
+            digest = file_digest(source_file, data)
+        source = file_tokens(source_file, data)
     except Exception as e:
-        cprintif(f'  {file_sname} -> {_sname(C.UNREADABLE_DIR)} because {e}', DANGER_MSG_COLOR)
-        new_file_path = C.UNREADABLE_DIR / source_file.name
-        copy(source_file, new_file_path)
-        source_file.unlink()
-        return new_file_path
+        return ScoredFile(source_file, None, [], registry.version, str(e), digest)
+
+    if C.BOILERPLATE_ENABLED:
+        with metrics().timer('boilerplate'):
+            name = boilerplate_library().match(source.tokens)
+        if name is not None:
+            return ScoredFile(source_file, source, [], registry.version, None, digest, name)
+
+    if digest and (dir := registry.find_digest(digest)):
+        # A copy of this file is already sorted. Go where it went.
+        _dedup["files"] += 1
+        _dedup["comparisons"] += len(registry)
+        return ScoredFile(source_file, source, [{"metric": 100.0, "dir": dir}], registry.version, None, digest)
+
+    return ScoredFile(source_file, source, compare_to_sorted(source.tokens), registry.version, None, digest)
+
+
+def _read_ahead(source_files: list[Path]) -> None:
+    """
+    Have the prefetcher read source_files, and the representatives that haven't been parsed yet, in
+    the order score_file() will want them: the first file, the representatives it's compared to,
+    then the rest of the files.
+    """
+    reps = []
+    if not C.LSH_ENABLED or C.LSH_VERIFY:  # Otherwise there's no telling which representatives it will want
+        if C.TOKEN_CACHE_ENABLED or C.SIMILARITY_BACKEND == 'numpy':  # Otherwise compare_to_rtf() reads them itself
+            reps = cluster_registry().unparsed()
+    prefetcher().schedule(source_files[:1] + reps + source_files[1:])
+
+
+def follow(leader: ScoredFile, leader_path: Path, copy_of_leader: Path) -> ScoredFile:
+    """Score for a byte-identical copy of leader, which was placed at leader_path. Sends it to the same place."""
+    _dedup["files"] += 1
+    _dedup["comparisons"] += len(cluster_registry())
+    calcs = [] if leader.error or leader.boilerplate else [{"metric": 100.0, "dir": leader_path.parent}]
+    return leader._replace(file=copy_of_leader, calcs=calcs)
+
 
-    calcs = compare_to_sorted(source_text, C.SORTING_DIR)
+def _dedup_sources(files: t.Optional[list[Path]] = None) -> tuple[list[Path], dict[Path, list[Path]]]:
+    """
+    Files to sort, and {file: [byte-identical copies of it]} to place alongside it. That's everything
+    in SOURCE_DIR, or those of files that are still there and not already sorted into the manifest.
+    """
+    if files is None:
+        files = source_files()
+    else:
+        store = state_store()
+        files = [f for f in files if f.is_file() and store.destination(f) == f]
+    if not C.DEDUP_ENABLED:
+        return files, {}
+    groups = duplicate_groups(files)
+    copies = sum(len(g) for g in groups.values())
+    if copies:
+        cprintif(f'{copies} files are copies of others and will follow them', SORT_MSG_COLOR)
+    return list(groups), {k: v for k, v in groups.items() if v}
+
+
+def place_file(scored: ScoredFile, dry_run: bool=False) -> Path:
+    """
+    The other half: choose a cluster from scored.calcs, move the file there, and update the registry.
+    With dry_run or Config.VIRTUAL_SORT, the move only goes in the manifest. Returns where the file
+    went, or will go.
+    """
+    source_file = scored.file
+    file_sname = _sname(source_file)
+    virtual = dry_run or C.VIRTUAL_SORT
+    store = state_store()
+
+    m = metrics()
+    m.count("files")
+    if scored.error is not None:
+        cprintif(f'  {file_sname} -> {_sname(C.UNREADABLE_DIR)} because {scored.error}', DANGER_MSG_COLOR)
+        m.count("unreadable")
+        return _set_aside(source_file, C.UNREADABLE_DIR, virtual)
+    if scored.boilerplate is not None:
+        cprintif(f'  {file_sname} -> {_sname(C.QUARANTINE_DIR)}: boilerplate ({scored.boilerplate})', WARN_MSG_COLOR)
+        m.count("quarantined")
+        return _set_aside(source_file, C.QUARANTINE_DIR, virtual)
+
+    source_text = scored.entry.head
+    # Highest metric first. Break ties by name so that results don't depend on scan order.
+    calcs = sorted(scored.calcs, key=lambda _: (-_["metric"], str(_["dir"])))
     
+    score = None  # Of the match, if the file joins an existing dir
     if not calcs:
-        target_dir = C.SORTING_DIR / sanitize_filename(source_text[:C.DNAME_LEN]).lstrip()
-        cprintif(f'  {file_sname}: No similarities were calculated!', DANGER_MSG_COLOR)
+        target_dir = cluster_dir(cluster_label(source_text))
+        if len(cluster_registry()):
+            cprintif(f'  {file_sname}: no cluster can reach {C.MATCH_RATIO_THRESHOLD}%', WARN_MSG_COLOR)
+        else:
+            cprintif(f'  {file_sname}: No similarities were calculated!', DANGER_MSG_COLOR)
+    elif calcs[0]["metric"] < C.MATCH_RATIO_THRESHOLD:
+        target_dir = cluster_dir(cluster_label(source_text))
+        cprintif(f'  {file_sname} match {calcs[0]["metric"]:.2f}% < {C.MATCH_RATIO_THRESHOLD}%', WARN_MSG_COLOR)
     else:
-        calcs.sort(reverse=True, key=lambda _: _["metric"])
+        target_dir = calcs[0]["dir"]
+        score = calcs[0]["metric"]
+        cprintif(f'  {file_sname} match: {calcs[0]["metric"]:.2f}% in {_sname(target_dir)}')
     
-        if calcs[0]["metric"] < C.MATCH_RATIO_THRESHOLD:
-            target_dir = C.SORTING_DIR / sanitize_filename(source_text[:C.DNAME_LEN]).lstrip()
-            cprintif(f'  {file_sname} match {calcs[0]["metric"]:.2f}% < {C.MATCH_RATIO_THRESHOLD}%', WARN_MSG_COLOR)
+    registry = cluster_registry()
+    if C.SORTING_LAYOUT == 'sharded' and registry.get(target_dir) is None:
+        store.set_label(target_dir, cluster_label(source_text))  # For its sidecar, once the dir is made
+    # Use first 100 characters of text as filename stem.
+    new_stem = source_text.lstrip()[:C.FNAME_LEN]
+    if virtual:
+        new_file_path = target_dir / sorted_name(new_stem, registry.claim_index(target_dir))
+        if registry.get(target_dir) is None:
+            m.count("clusters_created")
+        size = source_file.stat().st_size
+        with m.timer("move"):
+            store.assign(ManifestEntry(source_file, target_dir, new_file_path.name, size, score, scored.digest))
+        registry.add_member(target_dir, source_file, size, scored.entry.tokens, scored.digest, virtual=True)
+        cprintif(f'  {file_sname} => {_sname(target_dir)}{_sname(new_file_path)}')
+        return new_file_path
+
+    with m.timer("move"):
+        new_file_path = move_to_sorted(source_file, new_stem, target_dir)
+    # NB: Use the parent because move_to_sorted() may have shortened the dir name.
+    if registry.get(new_file_path.parent) is None:
+        m.count("clusters_created")
+    cluster = registry.add_member(new_file_path.parent, new_file_path, new_file_path.stat().st_size,
+                                  scored.entry.tokens, scored.digest)
+    store.record_assignment(new_file_path, score, scored.digest)
+    if cluster.rep == new_file_path:
+        store.set_representative(cluster.dir, cluster.rep, cluster.rep_size)
+    return new_file_path
+
+
+def _set_aside(source_file: Path, dir: Path, virtual: bool) -> Path:
+    """Move source_file to dir (UNREADABLE_DIR or QUARANTINE_DIR), which isn't a cluster, under its own name."""
+    new_file_path = dir / source_file.name
+    if not source_file.exists():  # Gone since it was listed. There's nothing to move.
+        cprintif(f'  {_sname(source_file)} is gone. Left it out.', WARN_MSG_COLOR)
+        return new_file_path
+    with metrics().timer("move"):
+        if virtual:
+            state_store().assign(ManifestEntry(source_file, dir, source_file.name, source_file.stat().st_size))
         else:
-            target_dir = calcs[0]["dir"]
-            cprintif(f'  {file_sname} match: {calcs[0]["metric"]:.2f}% in {_sname(target_dir)}')
-    
-    if not dry_run:
-        # Use first 100 characters of text as filename stem.
-        new_file_path = move_to_sorted(source_file, source_text.lstrip()[:C.FNAME_LEN], target_dir)
-    
+            state_store().move(source_file, new_file_path)
     return new_file_path
 
 
-def compare_to_sorted(text: str, sorted_dir: Path) -> list[dict[float, Path]]:
-    """Compare to the largest file in each subdir of SORTING_DIR. Build a list of {metric, dir}."""
-    
-    source_tokens = set(nltk.word_tokenize(text))
+def sort_file(source_file: Path, dry_run: bool=False) -> Path:
+    return place_file(score_file(source_file), dry_run=dry_run)
 
-    ignores = [C.UNREADABLE_DIR]
-    calcs = []
-    for subdir in sorted_dir.iterdir():
-        
-        if subdir.is_dir() and subdir not in ignores:
-            # NB: Certain content, like embedded images, lives in the RTF tags and not the
-            #   stripped text. So the largest file on disk could have the most content,
-            #   rather than the longest stripped text.
-            comp_file = largest_file(subdir)
 
-            if comp_file:
-                metric = compare_to_rtf(source_tokens, comp_file)
-                calcs.append({"metric": metric, "dir": subdir})
+def compare_to_sorted(source_tokens: set) -> list[dict[float, Path]]:
+    """Compare to the representative (largest file) of each cluster in SORTING_DIR. Build a list of {metric, dir}."""
+    with metrics().timer("similarity"):
+        return _compare_to_sorted(source_tokens)
+
+
+def _compare_to_sorted(source_tokens: set) -> list[dict[float, Path]]:
+    registry = cluster_registry()
+    if C.LSH_ENABLED and not C.LSH_VERIFY:
+        clusters = [c for d in lsh_index().candidates(source_tokens, C.MATCH_RATIO_THRESHOLD)
+                    if (c := registry.get(d)) and c.rep]
+    elif C.SIMILARITY_BACKEND == 'numpy':
+        clusters = None
+    else:
+        # NB: Certain content, like embedded images, lives in the RTF tags and not the
+        #   stripped text. So the largest file on disk could have the most content,
+        #   rather than the longest stripped text.
+        clusters = registry.clusters()
+        if C.PREFIX_FILTER_ENABLED and C.TOKEN_CACHE_ENABLED and len(clusters) >= OverlapIndex.MIN_SETS:
+            # Only the clusters that could reach the threshold. Scores below it don't change where the file goes.
+            candidates = set(registry.overlap_index().candidates(source_tokens))
+            metrics().count("comparisons_pruned", len(clusters) - len(candidates))
+            clusters = [c for c in clusters if c.dir in candidates]  # In the same order, for ties
+
+    if clusters is None:
+        calcs = _compare_to_matrix(source_tokens)
+    else:
+        calcs = []
+        for cluster in clusters:
+            calcs.append({"metric": _score(source_tokens, cluster), "dir": cluster.dir})
+        metrics().count("comparisons", len(clusters))
+
+    if C.LSH_ENABLED and C.LSH_VERIFY:
+        _verify_candidates(source_tokens, calcs)
 
     return calcs
 
 
-def move_to_sorted(source_path: Path, new_stem: str, target_dir: Path) -> Path:
+def _score(source_tokens: set, cluster: Cluster) -> float:
+    """Similarity to one cluster's representative, as a percentage."""
+    if C.TOKEN_CACHE_ENABLED:
+        return 100 * pseudo_jaccard_similarity(source_tokens, cluster_registry().tokens(cluster))
+    return compare_to_rtf(source_tokens, cluster.rep)  # The original path, prefix check and all
+
+
+def _compare_to_matrix(source_tokens: set) -> list[dict[float, Path]]:
+    """
+    Score against every representative in one batch. Only returns the clusters at or over the
+    threshold, plus the best one, since building a dict per cluster would cost more than the scoring.
+    """
+    np = require_numpy()
+    dirs, scores = cluster_registry().matrix().scores(token_array(source_tokens))
+    metrics().count("comparisons", len(dirs))
+    if not dirs:
+        return []
+    keep = set(np.flatnonzero(100 * scores >= C.MATCH_RATIO_THRESHOLD).tolist())
+    keep.add(int(np.argmax(scores)))
+    return [{"metric": 100 * float(scores[i]), "dir": dirs[i]} for i in sorted(keep)]
+
+
+def _best_match(calcs: list[dict[float, Path]]) -> t.Optional[Path]:
+    best = max(calcs, key=lambda _: _["metric"], default=None)
+    if best and best["metric"] >= C.MATCH_RATIO_THRESHOLD:
+        return best["dir"]
+    return None
+
+
+def _verify_candidates(source_tokens: set, calcs: list[dict[float, Path]]) -> None:
+    """Check that the LSH candidates alone would have given the same decision as the full scan in calcs."""
+    index = lsh_index()
+    candidates = set(index.candidates(source_tokens, C.MATCH_RATIO_THRESHOLD))
+    full = _best_match(calcs)
+    narrowed = _best_match([c for c in calcs if c["dir"] in candidates])
+    index.verified += 1
+    if full != narrowed:
+        index.mismatches += 1
+        cprintif(f'  LSH mismatch: full scan chose {_sname(full) if full else "a new dir"}, '
+                 f'index chose {_sname(narrowed) if narrowed else "a new dir"}', DANGER_MSG_COLOR)
+
+
+def make_target_dir(target_dir: Path) -> Path:
+    """Create target_dir if need be. Returns it, or a shorter name for it if the OS refused the name."""
+    if C.SORTING_LAYOUT == 'sharded':
+        make_cluster_dir(target_dir)  # Named by a short hash, which no OS refuses
+        return target_dir
     try:
         target_dir.mkdir(exist_ok=True)
     except OSError as e:
@@ -119,75 +332,468 @@ def move_to_sorted(source_path: Path, new_stem: str, target_dir: Path) -> Path:
             target_dir.mkdir(exist_ok=True)
         else:
             raise e
-    
-    # When saving, sanitize stem, add a unique index + ".rtf".
-    new_fname: str = ''.join([sanitize_filename(new_stem), f' {len(list(target_dir.iterdir()))}', '.rtf'])
-    new_file_path = target_dir / new_fname.strip()
-    copy(source_path, new_file_path)
-    source_path.unlink()
+    return target_dir
+
+
+def sorted_name(new_stem: str, index: int) -> str:
+    """When saving, sanitize stem, add a unique index + ".rtf"."""
+    return ''.join([sanitize_filename(new_stem), f' {index}', '.rtf']).strip()
+
+
+def move_to_sorted(source_path: Path, new_stem: str, target_dir: Path) -> Path:
+    target_dir = make_target_dir(target_dir)
+    registry = cluster_registry()
+    while True:
+        new_file_path = target_dir / sorted_name(new_stem, registry.claim_index(target_dir))
+        if not new_file_path.exists():  # Only if something other than sort put a file there
+            break
+    state_store().move(source_path, new_file_path)
     cprintif(f'  {_sname(source_path)} -> {_sname(target_dir)}{_sname(new_file_path)}')
     return new_file_path
 
 
-def run_multi(workers:int = 0) -> None:
-    
+def _counters() -> dict[str, dict]:
+    """This process's counters by kind, plus a metrics snapshot that includes them all."""
+    counters = {"cache": token_cache().counters(), "lsh": lsh_index().counters(), "dedup": dict(_dedup),
+                "prefetch": prefetcher().counters(), "boilerplate": boilerplate_library().counters()}
+    counters["metrics"] = metrics().snapshot(**counters)
+    return counters
+
+
+# Worker process state
+_delta_queue: t.Optional[mp.Queue] = None
+
+
+def _init_worker(mp_cfg_file: Path, snapshot: RegistrySnapshot, delta_queues: list[mp.Queue],
+                 queue_counter: mp.Value) -> None:
+    """
+    Runs once in each pool worker. Loads the config and the coordinator's clusters, and claims this
+    worker's queue of registry deltas. From then on the worker's registry lives in memory, kept up to
+    date by the deltas, and nothing about the clusters is read from disk.
+    """
+    global _delta_queue
+    C.load(mp_cfg_file)
+    empty_cluster_registry().load(snapshot)
+    with queue_counter.get_lock():
+        _delta_queue = delta_queues[queue_counter.value]
+        queue_counter.value += 1
+
+
+def _apply_deltas() -> None:
+    """Catch up with clusters the coordinator has created or changed since our last task."""
+    registry = cluster_registry()
+    while True:
+        try:
+            registry.apply(_delta_queue.get_nowait())
+        except queue.Empty:
+            return
+
+
+def _trim_calcs(scored: ScoredFile) -> ScoredFile:
+    """The coordinator only needs the candidates and the best miss (for the printout)."""
+    scored.calcs[:] = [c for i, c in enumerate(sorted(scored.calcs, key=lambda _: -_["metric"]))
+                       if i == 0 or c["metric"] >= C.MATCH_RATIO_THRESHOLD]
+    return scored
+
+
+def _score_files_mp(source_files: list[Path]) -> tuple[int, dict[str, dict], list[ScoredFile]]:
+    """Pool task. Returns this worker's pid and counters, so the parent can total them, and the scores."""
+    _apply_deltas()
+    _read_ahead(source_files)
+    scored = [_trim_calcs(score_file(source_file)) for source_file in source_files]
+    prefetcher().clear()
+    return os.getpid(), _counters(), scored
+
+
+def _rescore(scored: ScoredFile) -> ScoredFile:
+    """
+    Bring a worker's scores up to date with clusters that changed after it computed them. This is
+    what lets near-identical files in the same batch land in one cluster.
+    """
+    registry = cluster_registry()
+    changed = registry.changed_since(scored.version)
+    if scored.error is not None or scored.boilerplate is not None or not changed:
+        return scored
+
+    m = metrics()
+    calcs = [c for c in scored.calcs if c["dir"] not in changed]
+    with m.timer("similarity"):
+        for d in sorted(changed):
+            cluster = registry.get(d)
+            if cluster and cluster.rep:
+                calcs.append({"metric": _score(scored.entry.tokens, cluster), "dir": d})
+                m.count("comparisons")
+    return scored._replace(calcs=calcs, version=registry.version)
+
+
+def _place_batch(scored: list[ScoredFile], copies: dict[Path, list[Path]]) -> list[ClusterDelta]:
+    """
+    Place a worker's chunk of files, one at a time, in order. Returns deltas of the clusters whose
+    representative changed, to pass on to the workers.
+    """
+    registry = cluster_registry()
+    deltas = []
+    for s in scored:
+        version = registry.version
+        new_file_path = place_file(_rescore(s))
+        for f in copies.get(s.file, []):
+            place_file(follow(s, new_file_path, f))
+        if registry.version != version:
+            deltas.append(registry.delta(new_file_path.parent))
+    return deltas
+
+
+def _print_run_summary(by_worker: dict[int, dict[str, dict]]) -> None:
+    """Print totals of the latest counters from each worker."""
+    def total(kind: str) -> dict[str, int]:
+        totals = {}
+        for counters in by_worker.values():
+            for k, v in counters[kind].items():
+                totals[k] = totals.get(k, 0) + v
+        return totals
+
+    if not by_worker:
+        return
+    if C.TOKEN_CACHE_ENABLED:
+        cprintif(TokenCache.summary(total("cache")), SORT_MSG_COLOR)
+    if C.LSH_ENABLED:
+        cprintif(LSHIndex.summary(total("lsh"), len(lsh_index().clusters())), SORT_MSG_COLOR)
+    if C.DEDUP_ENABLED:
+        dedup = total("dedup")
+        cprintif(f'Duplicates: {dedup["files"]} files placed with their copies, '
+                 f'skipping {dedup["comparisons"]} comparisons', SORT_MSG_COLOR)
+    if C.PREFETCH_DEPTH:
+        cprintif(Prefetcher.summary(total("prefetch")), SORT_MSG_COLOR)
+    if C.BOILERPLATE_ENABLED and (signatures := len(boilerplate_library().signatures())):
+        cprintif(BoilerplateLibrary.summary(total("boilerplate"), signatures), SORT_MSG_COLOR)
+    merged = merge(c["metrics"] for c in by_worker.values())
+    if "comparisons_pruned" in merged["counts"]:
+        pruned = merged["counts"]["comparisons_pruned"]
+        cprintif(f'Prefix filter: {pruned} of {pruned + merged["counts"].get("comparisons", 0)} comparisons '
+                 f'ruled out without scoring', SORT_MSG_COLOR)
+    cprintif(stage_summary(merged), SORT_MSG_COLOR)
+
+
+def _exporter() -> t.Optional[MetricsExporter]:
+    if C.METRICS_INTERVAL > 0:
+        return MetricsExporter(C.STATE_DIR, C.METRICS_INTERVAL, run="sort")
+    return None
+
+
+def _reset_counters() -> None:
+    """Counters are per run. (Pool workers are forked or spawned after this, so they start at zero too.)"""
+    token_cache().reset_counters()
+    lsh_index().reset_counters()
+    prefetcher().reset_counters()
+    boilerplate_library().reset_counters()
+    _dedup.update(files=0, comparisons=0)
+    metrics().reset()
+
+
+def _prepare_run(virtual: bool = False, full: bool = True) -> None:
+    """Get ready to sort. Unless full, the registry is trusted as it stands rather than re-read from disk."""
+    for d in [C.SORTING_DIR, C.UNREADABLE_DIR, C.QUARANTINE_DIR]:
+        _safe_make_dir(d)
+
+    if not virtual:
+        check_no_plan()
+
+    _reset_counters()
+    boilerplate_library().reload()  # Signatures added since the last run
+
+    recovered = state_store().recover()
+    if recovered:
+        cprintif(f'Finished {recovered} file moves that the last run left unfinished', WARN_MSG_COLOR)
+
+    registry = cluster_registry()
+    if not full:
+        registry.refresh_if_changed()
+        return
+    registry.reconcile()
+    if C.LSH_ENABLED:
+        registry.sync_lsh()
+
+
+def run_multi(workers:int = 0, files: t.Optional[list[Path]] = None) -> None:
+    """Sort SOURCE_DIR (or just files, against the clusters as they stand) with a pool of worker processes."""
     # if __name__ != '__main__':
     #     # Multiprocessing only works (in 'spawn' mode on MacOS) when running from the command line.
     #     raise Exception('This function should only be called when running from the command line.')
     
-    for d in [C.SORTING_DIR, C.UNREADABLE_DIR]:
-        _safe_make_dir(d)
-    
-    then = datetime.now()
-    _print_file_count_msg()
+    _prepare_run(C.VIRTUAL_SORT, full=files is None)
+    exporter = _exporter()
     
-    max_workers = mp.cpu_count() - 1  # Leave one behind to be polite to the OS
+    max_workers = max(1, mp.cpu_count() - 1)  # Leave one behind to be polite to the OS
     if not 1 <= workers <= max_workers:
         workers = max_workers
+    max_in_flight = workers * C.MP_TASKS_PER_WORKER
     cprintif(f'Using {workers} workers', SORT_MSG_COLOR)
     
+    counters: dict[int, dict[str, dict]] = {}  # Latest cumulative counters from each worker
+    registry = cluster_registry()
+    sources, copies = _dedup_sources(files)
+    file_count = len(sources) + sum(len(c) for c in copies.values())
+    then = datetime.now()
+    _print_file_count_msg(file_count)
+    ctx = mp_context(__name__)
+    delta_queues = [ctx.Queue() for _ in range(workers)]
+
+    def commit(future: Future) -> None:
+        """Place a chunk's files, one at a time, and tell the workers about any new representatives."""
+        pid, worker_counters, scored = future.result()
+        counters[pid] = worker_counters
+        if exporter:
+            exporter.update(pid, worker_counters["metrics"])
+        for delta in _place_batch(scored, copies):
+            for q in delta_queues:
+                q.put(delta)
+        if exporter:
+            exporter.update(os.getpid(), metrics().snapshot())
+            exporter.maybe_write(file_count)
+
+    # Parse every representative here, once, rather than in each worker
+    _read_ahead([])
+    snapshot = registry.snapshot()
+    prefetcher().clear()
+
     with tempfile.NamedTemporaryFile('wb') as f:
         # Serialize config object to file so that subprocesses can access it.
         config_file = C.dump(f)
-        
-        with mp.Pool(processes=workers) as pool:
-            for batch in batch_iterdir(C.SOURCE_DIR, count=workers):
+
+        # Workers only read and score files. This process owns SORTING_DIR: it places each file
+        #   and creates clusters, in the order the files were submitted. So the results are the
+        #   same no matter which worker finishes first.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(config_file, snapshot, delta_queues, ctx.Value('i', 0))) as pool:
+            # Stream chunks of files to the pool as workers free up, rather than in lockstep batches.
+            #   Bounding the number of queued chunks is the backpressure: we stop listing the
+            #   source dir until a chunk finishes.
+            in_flight: deque[Future] = deque()
+            for batch in batched(sources, C.MP_CHUNK_SIZE):
+                while in_flight and (in_flight[0].done() or len(in_flight) >= max_in_flight):
+                    commit(in_flight.popleft())
+
                 now = datetime.now()
                 if now - then > timedelta(minutes=5):
-                    _print_file_count_msg()
+                    _print_file_count_msg(file_count - metrics().counts.get("files", 0))
                     then = now
                 
-                cprintif('Working on\n  ' + '\n  '.join([_sname(b) for b in batch]), SORT_MSG_COLOR)
-                pool.map(partial(sort_file, mp_cfg_file=config_file), batch)
+                cprintif('Queued\n  ' + '\n  '.join([_sname(b) for b in batch]), SORT_MSG_COLOR)
+                in_flight.append(pool.submit(_score_files_mp, batch))
 
+            while in_flight:
+                commit(in_flight.popleft())
 
-def run_single(dry_run: bool=False) -> None:
-    
-    for d in [C.SORTING_DIR, C.UNREADABLE_DIR]:
-        _safe_make_dir(d)
-    
+    for q in delta_queues:
+        q.close()
+        q.cancel_join_thread()  # Don't wait on deltas that no worker will read
+
+    state_store().flush()
+    counters[os.getpid()] = _counters()  # This process placed the copies
+    _print_run_summary(counters)
+    if exporter:
+        exporter.update(os.getpid(), counters[os.getpid()]["metrics"])
+        exporter.write(file_count)
+
+
+def run_distributed(address: tuple[str, int], authkey: bytes, local_workers: int = 0,
+                    files: t.Optional[list[Path]] = None) -> None:
+    """
+    Like run_multi(), but the workers connect over a socket and can be on any host (see
+    distributed.py and run_worker()). local_workers starts that many on this host too. Workers can
+    come and go during the run. Any chunk a lost worker had is scored again by another.
+    """
+    _prepare_run(C.VIRTUAL_SORT, full=files is None)
+    exporter = _exporter()
+
+    counters: dict[str, dict[str, dict]] = {}  # Latest cumulative counters from each worker
+    registry = cluster_registry()
+    sources, copies = _dedup_sources(files)
+    file_count = len(sources) + sum(len(c) for c in copies.values())
     then = datetime.now()
-    _print_file_count_msg()
+    _print_file_count_msg(file_count)
+
+    def setup() -> tuple[dict, RegistrySnapshot, dict[str, frozenset]]:
+        """What a worker needs when it joins: the config, every cluster as it stands, and the boilerplate signatures."""
+        return dict(vars(C)), registry.snapshot(), boilerplate_library().signatures()
+
+    server = LeaseServer(address, authkey, C.LEASE_SECS)
+    cprintif(f'Coordinator listening on {server.address[0]}:{server.address[1]}', SORT_MSG_COLOR)
+    local = [mp_context(__name__).Process(target=run_worker, args=(server.address, authkey))
+             for _ in range(local_workers)]
+    for p in local:
+        p.start()
+    try:
+        chunks = batched(sources, C.MP_CHUNK_SIZE)
+        for worker, (worker_counters, scored) in server.serve(chunks, setup, C.MP_TASKS_PER_WORKER):
+            counters[worker] = worker_counters
+            for delta in _place_batch(scored, copies):
+                server.broadcast(delta)
+
+            now = datetime.now()
+            if now - then > timedelta(minutes=5):
+                _print_file_count_msg(file_count - metrics().counts.get("files", 0))
+                then = now
+            if exporter:
+                exporter.update(worker, worker_counters["metrics"])
+                exporter.update(os.getpid(), metrics().snapshot())
+                exporter.maybe_write(file_count)
+    finally:
+        server.close()
+        for p in local:
+            p.join()
+
+    state_store().flush()
+    counters[str(os.getpid())] = _counters()  # This process placed the copies
+    _print_run_summary(counters)
+    if exporter:
+        exporter.update(os.getpid(), counters[str(os.getpid())]["metrics"])
+        exporter.write(file_count)
+
+
+def run_worker(address: tuple[str, int], authkey: bytes, fetch: bool = False,
+               state_dir: t.Optional[Path] = None) -> int:
+    """
+    Score chunks leased by the coordinator of run_distributed() until it has none left. With fetch,
+    the coordinator sends each file's contents, for hosts that don't mount SOURCE_DIR. state_dir
+    stands in for the coordinator's STATE_DIR, for hosts that don't share it. Returns the number of
+    chunks scored.
+    """
+    registry = None
+
+    def on_setup(payload: tuple[dict, RegistrySnapshot, dict[str, frozenset]]) -> None:
+        nonlocal registry
+        config, snapshot, signatures = payload
+        vars(C).update(config)
+        C.set_lsh(False)  # The index lives with the coordinator. Score against every cluster.
+        if state_dir:
+            C.set_state_dir(state_dir)
+        _reset_counters()  # A --worker process stays up across runs
+        registry = empty_cluster_registry()
+        registry.load(snapshot)
+        boilerplate_library().load(signatures)  # Its STATE_DIR may not have them
+        ensure_tokenizer_data()  # For the coordinator's TOKENIZER, which may not be this host's
+
+    with tempfile.TemporaryDirectory(prefix='journal_worker_') as spool:
+        def on_batch(deltas: list[ClusterDelta], files: list[tuple[Path, t.Optional[bytes], t.Optional[str]]]):
+            for delta in deltas:
+                registry.apply(delta)
+            _read_ahead([file for file, contents, error in files if contents is None and error is None])
+            scored = []
+            for file, contents, error in files:
+                if error is not None:
+                    scored.append(ScoredFile(file, None, [], registry.version, error))  # The coordinator couldn't read it
+                    continue
+                try:
+                    if contents is None:
+                        scored.append(_trim_calcs(score_file(file)))
+                    else:
+                        # Score a local copy, under the coordinator's path
+                        local = Path(spool) / file.name
+                        try:
+                            local.write_bytes(contents)
+                            scored.append(_trim_calcs(score_file(local)._replace(file=file)))
+                        finally:
+                            local.unlink(missing_ok=True)
+                except Exception as e:
+                    # Report it, rather than die on it. The batch would only go to the next worker.
+                    scored.append(ScoredFile(file, None, [], registry.version, str(e)))
+            prefetcher().clear()
+            return _counters(), scored
+
+        name = f'{socket.gethostname()}:{os.getpid()}'
+        return lease_loop(address, authkey, name, fetch, on_setup, on_batch)
+
+
+def run_single(dry_run: bool=False, files: t.Optional[list[Path]] = None) -> None:
+    """
+    Sort SOURCE_DIR in this process, or just files, against the clusters as they stand. With dry_run,
+    only plan the moves (see manifest.py) and leave the files alone.
+    """
+    _prepare_run(dry_run or C.VIRTUAL_SORT, full=files is None)
+    exporter = _exporter()
     
     cprintif(f'Using 1 worker', SORT_MSG_COLOR)
     
-    for file in C.SOURCE_DIR.iterdir():
+    sources, copies = _dedup_sources(files)
+    file_count = len(sources) + sum(len(c) for c in copies.values())
+    then = datetime.now()
+    _print_file_count_msg(file_count)
+    _read_ahead(sources)
+    for file in sources:
         now = datetime.now()
         if now - then > timedelta(minutes=5):
-            _print_file_count_msg()
+            _print_file_count_msg(file_count - metrics().counts.get("files", 0))
             then = now
+        if exporter:
+            exporter.update(os.getpid(), metrics().snapshot())
+            exporter.maybe_write(file_count)
         
         cprintif(f'Working on {_sname(file)}', SORT_MSG_COLOR)
-        sort_file(file, dry_run=dry_run)
+        scored = score_file(file)
+        new_file_path = place_file(scored, dry_run=dry_run)
+        for f in copies.get(file, []):
+            place_file(follow(scored, new_file_path, f), dry_run=dry_run)
+
+    prefetcher().clear()
+    if dry_run:
+        cprintif(f'Dry run: {state_store().pending()} moves planned and none made. Review them with '
+                 '`python3 -m manifest show`, then `apply` or `discard` them.', SORT_MSG_COLOR)
+    state_store().flush()
+    counters = _counters()
+    _print_run_summary({os.getpid(): counters})
+    if exporter:
+        exporter.update(os.getpid(), counters["metrics"])
+        exporter.write(file_count)
+
+
+def watch(run: t.Callable[..., None]) -> None:
+    """
+    Sort SOURCE_DIR, then sort files as they arrive in it, a burst at a time, against the clusters
+    as they stand. run is run_single(), run_multi() or the like, and is given files= for each burst.
+    Every WATCH_RECONCILE_SECS (if set), SORTING_DIR is re-read and SOURCE_DIR sorted in full.
+    """
+    watcher = DirWatcher(C.SOURCE_DIR, C.WATCH_POLL_SECS, source_files)
+    cprintif(f'Watching {C.SOURCE_DIR} for new files ({watcher.mode})', SORT_MSG_COLOR)
+    last_full = None
+    try:
+        while True:
+            if last_full is None or (C.WATCH_RECONCILE_SECS and time.monotonic() >= last_full + C.WATCH_RECONCILE_SECS):
+                if source_files():
+                    run()
+                last_full = time.monotonic()
+
+            timeout = None  # Until the next full pass
+            if C.WATCH_RECONCILE_SECS:
+                timeout = max(0.0, last_full + C.WATCH_RECONCILE_SECS - time.monotonic())
+            batch = watcher.next_batch(C.WATCH_SETTLE_SECS, C.WATCH_BATCH_MAX, timeout)
+            if batch:
+                cprintif(f'{len(batch)} new files', SORT_MSG_COLOR)
+                run(files=batch)
+    finally:
+        watcher.close()
+
+
+def _parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='sort', description='Sort SOURCE_DIR into SORTING_DIR, and keep doing it.')
+    parser.add_argument('--coordinator', metavar='HOST:PORT',
+                        help='Lease the work to workers that connect here instead of using a local pool')
+    parser.add_argument('--local-workers', type=int, default=0, help='Coordinator: start this many workers here too')
+    parser.add_argument('--watch', action='store_true',
+                        help='Sort new files as they arrive instead of checking SOURCE_DIR every minute')
+    parser.add_argument('--worker', metavar='HOST:PORT', help='Score files for the coordinator at this address')
+    parser.add_argument('--fetch', action='store_true',
+                        help='Worker: get file contents from the coordinator instead of a shared volume')
+    parser.add_argument('--state-dir', type=Path, help="Worker: keep the token cache here, not in the coordinator's STATE_DIR")
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
+    args = _parse_args(sys.argv[1:])
     C.set_app_dir(Path(__file__).parent.parent.resolve())
     C.set_match_ratio_threshold(80)    
     C.set_run_quiet(False)
     
-    nltk.download('punkt', quiet=True)  # Needed by nltk
-    
     opening_msgs = [
         '----------------------',
         f'Application directory: {C.APP_DIR}',
@@ -198,16 +804,36 @@ if __name__ == '__main__':
     ]
     cprintif('\n'.join(opening_msgs))
 
+    # The coordinator and workers share a secret (see distributed.py)
+    authkey = env_authkey() if args.coordinator or args.worker else b''
+    while args.worker:
+        try:
+            chunks = run_worker(parse_address(args.worker), authkey, args.fetch, args.state_dir)
+            cprintif(f'Scored {chunks} chunks. Waiting for the next run.', SORT_MSG_COLOR)
+        except ConnectionRefusedError:
+            pass
+        sleep(10)
+
+    ensure_tokenizer_data()
+    if args.watch:
+        if args.coordinator:
+            watch(functools.partial(run_distributed, parse_address(args.coordinator), authkey, args.local_workers))
+        else:
+            watch(run_multi)
+
     while True:
         try:
-            file_count = sum(1 for _ in C.SOURCE_DIR.iterdir() if _.is_file())
+            file_count = len(source_files())
         except FileNotFoundError:
             file_count = 0
                 
         if not file_count:
-            _print_file_count_msg()
+            _print_file_count_msg(file_count)
             sleep(60)
             continue
 
         # run_single(dry_run=False)
-        run_multi()
+        if args.coordinator:
+            run_distributed(parse_address(args.coordinator), authkey, args.local_workers)
+        else:
+            run_multi()
@@ -0,0 +1,295 @@
+import json
+import os
+import sqlite3
+import time
+import typing as t
+from pathlib import Path
+from shutil import copy
+
+from common import Config, iter_files
+
+
+def _fsync(file: Path) -> None:
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ManifestEntry(t.NamedTuple):
+    """A decision about a file that hasn't been carried out on disk yet."""
+    file: Path  # Where the file is now
+    dir: t.Optional[Path]  # Where it belongs. None if it's to be deleted.
+    name: t.Optional[str]  # What it will be called there
+    size: int
+    score: t.Optional[float] = None
+    digest: t.Optional[str] = None
+
+
+class StateStore():
+    """
+    Crash-safe record of a sort/prune/sift run, in SQLite: where each sorted file went and with
+    what score, each cluster's representative, the file moves in progress, and how far the sift
+    loop got.
+
+    Files move by copy-then-unlink, since the volumes may be different file systems. Each move is
+    journaled before it starts and cleared once the source is gone, so recover() can finish any
+    move that a crash cut short instead of leaving a half-written copy, or the same file in two
+    places.
+
+    It also holds the manifest for virtual sorting (see Config.VIRTUAL_SORT): where each file
+    belongs, for files that haven't been moved there yet. Manifest writes are buffered and
+    committed in batches, since losing the last few on a crash only means re-sorting those files.
+    So are the labels of new clusters in the sharded layout (see layout.py), until their dirs are made.
+
+    Only the process that moves files (the coordinator) should write to it.
+    """
+
+    # Manifest changes buffered between commits
+    _MANIFEST_BATCH = 500
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._conn: t.Optional[sqlite3.Connection] = None
+        self._conn_pid: t.Optional[int] = None
+        self._manifest_pending: dict[str, t.Optional[ManifestEntry]] = {}  # file -> entry, or None to drop it
+        self._labels_pending: dict[str, str] = {}  # dir -> label
+
+    def _db(self) -> sqlite3.Connection:
+        # A connection inherited across fork() isn't safe to use. Open a fresh one per process.
+        if self._conn is None or self._conn_pid != os.getpid():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')  # A journaled move must survive losing the VM
+            conn.execute('CREATE TABLE IF NOT EXISTS moves (id INTEGER PRIMARY KEY, src TEXT, dst TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS assignments '
+                         '(file TEXT PRIMARY KEY, dir TEXT, score REAL, digest TEXT, placed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS assignments_dir ON assignments (dir)')
+            conn.execute('CREATE TABLE IF NOT EXISTS clusters (dir TEXT PRIMARY KEY, rep TEXT, rep_size INTEGER)')
+            conn.execute('CREATE TABLE IF NOT EXISTS position (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS manifest (file TEXT PRIMARY KEY, dir TEXT, name TEXT, '
+                         'size INTEGER, score REAL, digest TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS manifest_dir ON manifest (dir)')
+            conn.execute('CREATE TABLE IF NOT EXISTS labels (dir TEXT PRIMARY KEY, label TEXT)')
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    # File moves
+    #-----------
+    def move(self, src: Path, dst: Path) -> None:
+        """Move src to dst so that a crash at any point can be rolled forward by recover()."""
+        db = self._db()
+        move_id = db.execute('INSERT INTO moves (src, dst) VALUES (?, ?)', (str(src), str(dst))).lastrowid
+        # NB: copy/delete works across file systems per https://stackoverflow.com/a/42400063/2539684
+        #   whereas shutil.move() doesn't.
+        copy(src, dst)
+        _fsync(dst)  # The copy has to be on disk before the only other copy is gone
+        src.unlink()
+        db.execute('DELETE FROM moves WHERE id = ?', (move_id,))
+
+    def recover(self) -> int:
+        """Finish the moves that were in progress when the last run stopped. Returns how many there were."""
+        db = self._db()
+        pending = db.execute('SELECT id, src, dst FROM moves ORDER BY id').fetchall()
+        for move_id, src, dst in pending:
+            src, dst = Path(src), Path(dst)
+            if src.exists():
+                # The copy may be partial. Redo it. (If src is gone, the copy was complete.)
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                copy(src, dst)
+                _fsync(dst)
+                src.unlink()
+            db.execute('DELETE FROM moves WHERE id = ?', (move_id,))
+        return len(pending)
+
+    # Assignments and representatives
+    #--------------------------------
+    def record_assignment(self, file: Path, score: t.Optional[float], digest: t.Optional[str] = None) -> None:
+        """Note that file was sorted into its parent dir, matching it by score (None if it started the dir)."""
+        self._db().execute('INSERT OR REPLACE INTO assignments VALUES (?, ?, ?, ?, ?)',
+                           (str(file), str(file.parent), score, digest, time.time()))
+
+    def forget(self, file: Path) -> None:
+        """Note that file left SORTING_DIR."""
+        self._db().execute('DELETE FROM assignments WHERE file = ?', (str(file),))
+
+    def assignments(self, dir: t.Optional[Path] = None) -> dict[Path, t.Optional[float]]:
+        """{file: score} of files sorted into dir, or into any dir."""
+        if dir is None:
+            rows = self._db().execute('SELECT file, score FROM assignments')
+        else:
+            rows = self._db().execute('SELECT file, score FROM assignments WHERE dir = ?', (str(dir),))
+        return {Path(f): s for f, s in rows}
+
+    def set_representative(self, dir: Path, rep: Path, rep_size: int) -> None:
+        self._db().execute('INSERT OR REPLACE INTO clusters VALUES (?, ?, ?)', (str(dir), str(rep), rep_size))
+
+    def remove_cluster(self, dir: Path) -> None:
+        self._labels_pending.pop(str(dir), None)
+        db = self._db()
+        with db:
+            db.execute('BEGIN')
+            db.execute('DELETE FROM clusters WHERE dir = ?', (str(dir),))
+            db.execute('DELETE FROM assignments WHERE dir = ?', (str(dir),))
+            db.execute('DELETE FROM labels WHERE dir = ?', (str(dir),))
+
+    def relocate_cluster(self, dir: Path, new_dir: Path) -> None:
+        """Note that dir, and every file in it, was moved to new_dir."""
+        old, new = str(dir), str(new_dir)
+        db = self._db()
+        with db:
+            db.execute('BEGIN')
+            db.execute('UPDATE assignments SET file = ? || substr(file, ?), dir = ? WHERE dir = ?',
+                       (new, len(old) + 1, new, old))
+            db.execute('UPDATE clusters SET rep = ? || substr(rep, ?), dir = ? WHERE dir = ?',
+                       (new, len(old) + 1, new, old))
+
+    def set_label(self, dir: Path, label: str) -> None:
+        """Note what the cluster in dir is called, for its sidecar once dir is made."""
+        self._labels_pending[str(dir)] = label
+
+    def label(self, dir: Path) -> t.Optional[str]:
+        key = str(dir)
+        if key in self._labels_pending:
+            return self._labels_pending[key]
+        row = self._db().execute('SELECT label FROM labels WHERE dir = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def representatives(self) -> dict[Path, tuple[Path, int]]:
+        return {Path(d): (Path(r), s) for d, r, s in self._db().execute('SELECT dir, rep, rep_size FROM clusters')}
+
+    def clear_sorted(self) -> None:
+        """Forget all assignments and clusters, e.g. once SORTING_DIR has been emptied."""
+        self._labels_pending.clear()
+        db = self._db()
+        with db:
+            db.execute('BEGIN')
+            db.execute('DELETE FROM assignments')
+            db.execute('DELETE FROM clusters')
+            db.execute('DELETE FROM labels')
+
+    # Sift loop position
+    #-------------------
+    def checkpoint(self, **position: t.Any) -> None:
+        """Record where the sift loop is, replacing the last checkpoint."""
+        db = self._db()
+        with db:
+            db.execute('BEGIN')
+            db.execute('DELETE FROM position')
+            db.executemany('INSERT INTO position VALUES (?, ?)', [(k, json.dumps(v)) for k, v in position.items()])
+
+    def position(self) -> dict[str, t.Any]:
+        """The last checkpoint, or {} if the sift loop isn't mid-run."""
+        return {k: json.loads(v) for k, v in self._db().execute('SELECT key, value FROM position')}
+
+    def clear_position(self) -> None:
+        self._db().execute('DELETE FROM position')
+
+    # Manifest
+    #---------
+    def assign(self, entry: ManifestEntry) -> None:
+        """Record where a file belongs. If that's where it already is, forget it instead."""
+        if entry.dir is not None and entry.dir / entry.name == entry.file:
+            self.unassign(entry.file)
+        else:
+            self._stage_manifest(str(entry.file), entry)
+
+    def unassign(self, file: Path) -> None:
+        """Drop file's manifest entry. It belongs wherever it is on disk."""
+        self._stage_manifest(str(file), None)
+
+    def _stage_manifest(self, key: str, entry: t.Optional[ManifestEntry]) -> None:
+        self._manifest_pending[key] = entry
+        if len(self._manifest_pending) >= self._MANIFEST_BATCH:
+            self.flush()
+
+    def flush(self) -> None:
+        """Commit buffered manifest changes and labels."""
+        if not (self._manifest_pending or self._labels_pending) or self._conn_pid not in (None, os.getpid()):
+            self._manifest_pending.clear()  # Inherited by a worker process. Not ours to write.
+            self._labels_pending.clear()
+            return
+        db = self._db()
+        with db:
+            db.execute('BEGIN')
+            for key, e in self._manifest_pending.items():
+                if e is None:
+                    db.execute('DELETE FROM manifest WHERE file = ?', (key,))
+                else:
+                    db.execute('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, str(e.dir) if e.dir else None, e.name, e.size, e.score, e.digest))
+            db.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?)', self._labels_pending.items())
+        self._manifest_pending.clear()
+        self._labels_pending.clear()
+
+    def manifest(self) -> list[ManifestEntry]:
+        """Every pending decision, ordered by destination."""
+        self.flush()
+        rows = self._db().execute('SELECT file, dir, name, size, score, digest FROM manifest ORDER BY dir, name, file')
+        return [ManifestEntry(Path(f), Path(d) if d else None, n, s, sc, dg) for f, d, n, s, sc, dg in rows]
+
+    def destination(self, file: Path) -> t.Optional[Path]:
+        """Where file will be once the manifest is applied: file itself if it has no entry, None if it's to be deleted."""
+        key = str(file)
+        if key in self._manifest_pending:
+            entry = self._manifest_pending[key]
+            dir, name = (entry.dir, entry.name) if entry else (file.parent, file.name)
+        else:
+            row = self._db().execute('SELECT dir, name FROM manifest WHERE file = ?', (key,)).fetchone()
+            dir, name = (Path(row[0]) if row[0] else None, row[1]) if row else (file.parent, file.name)
+        return dir / name if dir else None
+
+    def pending(self) -> int:
+        """Number of manifest entries not yet applied."""
+        self.flush()
+        return self._db().execute('SELECT COUNT(*) FROM manifest').fetchone()[0]
+
+    def clear_manifest(self) -> int:
+        """Forget every pending decision. Returns how many there were."""
+        self.flush()
+        return self._db().execute('DELETE FROM manifest').rowcount
+
+
+# Common instances
+#-----------------
+_state_store: t.Optional[StateStore] = None
+
+
+def state_store() -> StateStore:
+    """The state store for the current config. Opened on first use in each process."""
+    global _state_store
+    db_path = Config.STATE_DIR / 'state.sqlite3'
+    if _state_store is None or _state_store.db_path != db_path:
+        _state_store = StateStore(db_path)
+    return _state_store
+
+
+def reset_state_store() -> None:
+    """Forget the state store, e.g. after STATE_DIR was deleted. It's reopened on next use."""
+    global _state_store
+    _state_store = None
+
+
+def check_no_plan() -> None:
+    """Raise if the manifest holds moves that haven't been applied. Moving files directly would go around them."""
+    pending = state_store().pending()
+    if pending:
+        raise RuntimeError(f'{pending} planned moves are waiting in the manifest. Apply them '
+                           '(python3 -m manifest apply) or discard them (python3 -m manifest discard) first, '
+                           'or set Config.VIRTUAL_SORT to keep planning.')
+
+
+def source_files() -> list[Path]:
+    """
+    Files waiting to be sorted: those in SOURCE_DIR that the manifest hasn't sent elsewhere, and
+    those elsewhere that the manifest has sent back.
+    """
+    entries = state_store().manifest()
+    if not entries:
+        return list(iter_files(Config.SOURCE_DIR))
+    relocated = {e.file for e in entries}
+    files = [f for f in iter_files(Config.SOURCE_DIR) if f not in relocated]
+    return files + [e.file for e in entries if e.dir == Config.SOURCE_DIR]
@@ -0,0 +1,242 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import sys
+import time
+import typing as t
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Bytes read per chunk when hashing file contents
+_HASH_CHUNK = 1 << 20
+
+
+class CacheEntry(t.NamedTuple):
+    """What we remember about a file's contents: its token set and the start of its text."""
+    tokens: frozenset
+    head: str
+
+
+def content_digest(file: Path, data: t.Optional[bytes] = None) -> str:
+    """
+    Hash the raw bytes of file. Identical contents give identical digests, wherever they live.
+    data is file's contents, if they've been read already.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if data is not None:
+        h.update(data)
+        return h.hexdigest()
+    with open(file, 'rb') as f:
+        while chunk := f.read(_HASH_CHUNK):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _entry_size(entry: CacheEntry) -> int:
+    """Rough in-memory footprint of an entry. Good enough for budgeting, not for accounting."""
+    return sys.getsizeof(entry.tokens) + sum(sys.getsizeof(tok) for tok in entry.tokens) + sys.getsizeof(entry.head)
+
+
+class TokenCache():
+    """
+    Content-addressed cache of token sets, backed by an SQLite file so it survives restarts.
+
+    Entries are keyed by a hash of the file's bytes, so a file keeps its cache entry when it's
+    copied between SOURCE_DIR and SORTING_DIR. A (size, mtime) record per path lets repeat lookups
+    skip re-hashing. Both the in-memory layer and the on-disk layer are LRU-evicted to stay within
+    their budgets.
+
+    Safe to use from several processes: each process opens its own connection, and SQLite
+    serializes the writes.
+    """
+
+    # How many inserts between disk budget checks. Summing the table isn't free.
+    _DISK_CHECK_INTERVAL = 200
+    # Don't bother refreshing an entry's last_used more often than this (seconds).
+    _TOUCH_INTERVAL = 3600
+
+    def __init__(self, db_path: Path, namespace: str, mem_budget_mb: int, disk_budget_mb: int):
+        self.db_path = db_path
+        self.namespace = namespace
+        self.mem_budget = mem_budget_mb * 2**20
+        self.disk_budget = disk_budget_mb * 2**20
+
+        self._mem: OrderedDict[str, tuple[CacheEntry, int]] = OrderedDict()
+        self._mem_size = 0
+        self._stats: dict[str, tuple[int, int, str]] = {}  # path -> (size, mtime_ns, digest)
+        self._conn: t.Optional[sqlite3.Connection] = None
+        self._conn_pid: t.Optional[int] = None
+        self._inserts = 0
+
+        self.hits_mem = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    # Connection management
+    #----------------------
+    def _db(self) -> sqlite3.Connection:
+        # A connection inherited across fork() isn't safe to use. Open a fresh one per process.
+        if self._conn is None or self._conn_pid != os.getpid():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS tokens '
+                         '(key TEXT PRIMARY KEY, data BLOB, nbytes INTEGER, last_used REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS tokens_last_used ON tokens (last_used)')
+            conn.execute('CREATE TABLE IF NOT EXISTS paths '
+                         '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)')
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    # Lookups
+    #--------
+    def digest(self, file: Path, data: t.Optional[bytes] = None) -> str:
+        """Content digest of file, skipping the hash if its size and mtime are unchanged. data as for content_digest()."""
+        st = file.stat()
+        key = str(file)
+
+        known = self._stats.get(key)
+        if known is None:
+            row = self._db().execute('SELECT size, mtime_ns, digest FROM paths WHERE path = ?', (key,)).fetchone()
+            known = tuple(row) if row else None
+
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            digest = known[2]
+        else:
+            digest = content_digest(file, data)
+            self._db().execute('INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)',
+                               (key, st.st_size, st.st_mtime_ns, digest))
+
+        self._stats[key] = (st.st_size, st.st_mtime_ns, digest)
+        return digest
+
+    def digest_many(self, files: t.Iterable[Path], threads: int = 8) -> dict[Path, str]:
+        """Like digest(), for a lot of files at once. The hashing runs in a thread pool, since it's mostly I/O."""
+        files = list(files)
+        stats = {f: f.stat() for f in files}
+        ret = {}
+        todo = []
+        for f in files:
+            known = self._stats.get(str(f))
+            if known and known[0] == stats[f].st_size and known[1] == stats[f].st_mtime_ns:
+                ret[f] = known[2]
+            else:
+                todo.append(f)
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            hashed = list(pool.map(content_digest, todo))
+
+        db = self._db()
+        with db:
+            db.execute('BEGIN')
+            for f, digest in zip(todo, hashed):
+                st = stats[f]
+                db.execute('INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?)', (str(f), st.st_size, st.st_mtime_ns, digest))
+                self._stats[str(f)] = (st.st_size, st.st_mtime_ns, digest)
+                ret[f] = digest
+        return {f: ret[f] for f in files}  # In the order given, as duplicate_groups() promises
+
+    def get(self, file: Path, parse: t.Callable[[Path], CacheEntry], data: t.Optional[bytes] = None) -> CacheEntry:
+        """
+        Return the cached entry for file's contents. On a miss, call parse(file) and store the result.
+        data as for content_digest().
+        """
+        key = f'{self.namespace}:{self.digest(file, data)}'
+
+        if key in self._mem:
+            self._mem.move_to_end(key)
+            self.hits_mem += 1
+            return self._mem[key][0]
+
+        row = self._db().execute('SELECT data, last_used FROM tokens WHERE key = ?', (key,)).fetchone()
+        if row:
+            tokens, head = pickle.loads(zlib.decompress(row[0]))
+            entry = CacheEntry(frozenset(tokens), head)
+            now = time.time()
+            if now - row[1] > self._TOUCH_INTERVAL:
+                self._db().execute('UPDATE tokens SET last_used = ? WHERE key = ?', (now, key))
+            self.hits_disk += 1
+        else:
+            entry = parse(file)
+            entry = CacheEntry(frozenset(entry.tokens), entry.head)
+            data = zlib.compress(pickle.dumps((tuple(entry.tokens), entry.head), protocol=pickle.HIGHEST_PROTOCOL), 1)
+            self._db().execute('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)',
+                               (key, data, len(data), time.time()))
+            self.misses += 1
+            self._inserts += 1
+            if self._inserts % self._DISK_CHECK_INTERVAL == 0:
+                self.evict_disk()
+
+        self._remember(key, entry)
+        return entry
+
+    def has(self, file: Path) -> bool:
+        """Whether get(file) would be a hit, without reading file. False if it's changed since it was last hashed."""
+        st = file.stat()
+        known = self._stats.get(str(file))
+        if known is None:
+            row = self._db().execute('SELECT size, mtime_ns, digest FROM paths WHERE path = ?', (str(file),)).fetchone()
+            known = tuple(row) if row else None
+        if not known or known[0] != st.st_size or known[1] != st.st_mtime_ns:
+            return False
+        key = f'{self.namespace}:{known[2]}'
+        return key in self._mem or self._db().execute('SELECT 1 FROM tokens WHERE key = ?', (key,)).fetchone() is not None
+
+    # Eviction
+    #---------
+    def _remember(self, key: str, entry: CacheEntry) -> None:
+        size = _entry_size(entry)
+        if size > self.mem_budget:
+            return
+        self._mem[key] = (entry, size)
+        self._mem_size += size
+        while self._mem_size > self.mem_budget:
+            _, (_, old_size) = self._mem.popitem(last=False)
+            self._mem_size -= old_size
+
+    def evict_disk(self) -> int:
+        """Drop least recently used rows until the table fits in 90% of the disk budget. Return rows dropped."""
+        db = self._db()
+        total = db.execute('SELECT COALESCE(SUM(nbytes), 0) FROM tokens').fetchone()[0]
+        if total <= self.disk_budget:
+            return 0
+
+        target = int(self.disk_budget * 0.9)
+        dropped = 0
+        for key, nbytes in db.execute('SELECT key, nbytes FROM tokens ORDER BY last_used').fetchall():
+            if total <= target:
+                break
+            db.execute('DELETE FROM tokens WHERE key = ?', (key,))
+            total -= nbytes
+            dropped += 1
+
+        # Path records are only shortcuts to digests. Keep them from growing without bound.
+        db.execute('DELETE FROM paths WHERE digest NOT IN (SELECT substr(key, ?) FROM tokens)',
+                   (len(self.namespace) + 2,))
+        return dropped
+
+    # Reporting
+    #----------
+    def counters(self) -> dict[str, int]:
+        return {'hits_mem': self.hits_mem, 'hits_disk': self.hits_disk, 'misses': self.misses}
+
+    def reset_counters(self) -> None:
+        self.hits_mem = self.hits_disk = self.misses = 0
+
+    @staticmethod
+    def summary(counters: dict[str, int]) -> str:
+        hits = counters['hits_mem'] + counters['hits_disk']
+        total = hits + counters['misses']
+        rate = 100 * hits / total if total else 0
+        return (f'Token cache: {hits} hits ({counters["hits_mem"]} memory, {counters["hits_disk"]} disk), '
+                f'{counters["misses"]} misses, {rate:.1f}% hit rate')
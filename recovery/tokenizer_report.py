@@ -0,0 +1,109 @@
+"""
+How close is a tokenizer to nltk.word_tokenize()? Tokenizes a sample of the RTF files in SOURCE_DIR
+and SORTING_DIR both ways, then reports how often the token sets differ, the speedup, and how many
+files a sort would place differently.
+
+    python3 tokenizer_report.py [tokenizer] [sample size]
+"""
+import random
+import sys
+import time
+import typing as t
+from pathlib import Path
+
+from common import Config as C
+from common import (TOKENIZERS, cprintif, ensure_tokenizer_data, iter_files,
+                    pseudo_jaccard_similarity, read_rtf)
+from layout import cluster_dirs
+
+REPORT_MSG_COLOR = 'light_blue'
+WARN_MSG_COLOR = 'light_yellow'
+
+
+def sample_files(count: int, seed: int = 0) -> list[Path]:
+    files = list(iter_files(C.SOURCE_DIR))
+    if C.SORTING_DIR.is_dir():
+        for d in cluster_dirs():
+            files.extend(iter_files(d))
+    files.sort()
+    random.Random(seed).shuffle(files)
+    return files[:count]
+
+
+def timed_tokenize(tokenizer: str, texts: list[str]) -> tuple[list[set], float]:
+    """Token sets of texts, and the seconds it took to make them."""
+    tokenize = TOKENIZERS[tokenizer]
+    start = time.perf_counter()
+    token_sets = [tokenize(text) for text in texts]
+    return token_sets, time.perf_counter() - start
+
+
+def simulate_sort(token_sets: list[set], sizes: list[int], threshold: int) -> list[frozenset]:
+    """
+    Place files one at a time the way sort does: into the best matching cluster if it reaches
+    threshold, otherwise into a new one. Representatives are the largest files. Returns, for
+    each file, the set of files it ended up with.
+    """
+    reps: list[int] = []
+    placed: list[int] = []
+    for i, tokens in enumerate(token_sets):
+        scores = [100 * pseudo_jaccard_similarity(tokens, token_sets[rep]) for rep in reps]
+        best = max(range(len(scores)), key=scores.__getitem__, default=None)
+        if best is not None and scores[best] >= threshold:
+            placed.append(best)
+            if sizes[i] > sizes[reps[best]]:
+                reps[best] = i
+        else:
+            placed.append(len(reps))
+            reps.append(i)
+
+    members: dict[int, list[int]] = {}
+    for i, cluster in enumerate(placed):
+        members.setdefault(cluster, []).append(i)
+    return [frozenset(members[cluster]) for cluster in placed]
+
+
+def compare(tokenizer: str, files: list[Path], thresholds: t.Iterable[int]) -> dict:
+    texts = [read_rtf(f) for f in files]
+    sizes = [f.stat().st_size for f in files]
+    reference, ref_secs = timed_tokenize('nltk', texts)
+    candidate, secs = timed_tokenize(tokenizer, texts)
+
+    similarities = [pseudo_jaccard_similarity(a, b) if a or b else 1.0 for a, b in zip(reference, candidate)]
+    report = {
+        'files': len(files),
+        'identical_sets': sum(a == b for a, b in zip(reference, candidate)),
+        'mean_similarity': sum(similarities) / len(similarities) if similarities else 1.0,
+        'min_similarity': min(similarities, default=1.0),
+        'nltk_secs': ref_secs,
+        'secs': secs,
+        'placement_changes': {},
+    }
+    for threshold in thresholds:
+        expected = simulate_sort(reference, sizes, threshold)
+        actual = simulate_sort(candidate, sizes, threshold)
+        report['placement_changes'][threshold] = sum(a != b for a, b in zip(expected, actual))
+    return report
+
+
+if __name__ == '__main__':
+    C.set_app_dir(Path(__file__).parent.parent.resolve())
+    C.set_run_quiet(False)
+    ensure_tokenizer_data('nltk')  # The reference, whatever tokenizer is being tried
+
+    tokenizer = sys.argv[1] if len(sys.argv) > 1 else 'regex'
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    C.set_tokenizer(tokenizer)  # Validates the name
+
+    files = sample_files(count)
+    cprintif(f'Comparing tokenizer {tokenizer!r} to nltk on {len(files)} files', REPORT_MSG_COLOR)
+    report = compare(tokenizer, files, thresholds=(C.MATCH_RATIO_THRESHOLD, 95))
+
+    speedup = report['nltk_secs'] / report['secs'] if report['secs'] else float('inf')
+    cprintif(f'  Identical token sets: {report["identical_sets"]} of {report["files"]}')
+    cprintif(f'  Token set similarity: {100 * report["mean_similarity"]:.2f}% mean, '
+             f'{100 * report["min_similarity"]:.2f}% worst')
+    cprintif(f'  Time: {report["nltk_secs"]:.2f}s nltk, {report["secs"]:.2f}s {tokenizer} ({speedup:.1f}x)')
+    for threshold, changes in report['placement_changes'].items():
+        color = WARN_MSG_COLOR if changes else REPORT_MSG_COLOR
+        cprintif(f'  Sort at {threshold}%: {changes} of {report["files"]} files placed differently', color)
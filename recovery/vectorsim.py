@@ -0,0 +1,99 @@
+import typing as t
+from pathlib import Path
+
+from lsh import token_hash
+
+# numpy, imported by require_numpy(). Only SIMILARITY_BACKEND 'numpy' needs it, and importing it
+#   is a good part of the app's startup time.
+np = None
+
+
+def require_numpy() -> t.Any:
+    """Import numpy if need be, and return it."""
+    global np
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            raise ImportError("SIMILARITY_BACKEND 'numpy' needs numpy. Install it with `pip3 install numpy`.") from None
+    return np
+
+
+def token_array(tokens: t.Iterable[str]) -> 'np.ndarray':
+    """Sorted, unique 64-bit hashes of tokens."""
+    require_numpy()
+    return np.unique(np.fromiter((token_hash(tok) for tok in tokens), dtype=np.uint64))
+
+
+def array_similarity(a: 'np.ndarray', b: 'np.ndarray') -> float:
+    """pseudo_jaccard_similarity() of two token arrays."""
+    if len(a) and len(b):
+        return len(np.intersect1d(a, b, assume_unique=True)) / min(len(a), len(b))
+    return 0
+
+
+class RepresentativeMatrix():
+    """
+    NumPy backend for pseudo_jaccard_similarity() against every cluster representative at once.
+
+    Tokens are interned as 64-bit hashes (see lsh.token_hash), and each token set is a sorted array
+    of unique uint64. That's 8 bytes per token, against roughly 60 for a str in a Python set. The
+    arrays are packed end to end, CSR style, so one incoming file is scored against every
+    representative in a single batched operation. Changes are cheap. The packed array is rebuilt
+    on the next scores() after a change.
+
+    Tolerance: scores equal the set-based ones (both are a ratio of exact integer counts in float64),
+    except when two distinct tokens share a 64-bit hash. The chance of that is about n**2 / 2**65
+    for a vocabulary of n tokens, i.e. below 1e-5 even for 10 million distinct tokens.
+    """
+
+    def __init__(self):
+        require_numpy()
+        self._arrays: dict[Path, np.ndarray] = {}
+        self._dirs: list[Path] = []
+        self._indices = np.empty(0, dtype=np.uint64)  # All arrays, end to end
+        self._starts = np.empty(0, dtype=np.int64)  # Where each dir's array starts in _indices
+        self._sizes = np.empty(0, dtype=np.int64)
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._arrays)
+
+    def arrays(self) -> dict[Path, 'np.ndarray']:
+        """Token array of each representative. For copying the matrix to another process."""
+        return dict(self._arrays)
+
+    def load(self, arrays: dict[Path, 'np.ndarray']) -> None:
+        """Take on arrays() from another matrix, without hashing any tokens."""
+        self._arrays.update(arrays)
+        self._dirty = True
+
+    def set(self, dir: Path, tokens: t.Iterable[str]) -> None:
+        self._arrays[dir] = token_array(tokens)
+        self._dirty = True
+
+    def remove(self, dir: Path) -> None:
+        if self._arrays.pop(dir, None) is not None:
+            self._dirty = True
+
+    def _pack(self) -> None:
+        # Empty arrays would confuse np.add.reduceat() below. They always score 0, so leave them out.
+        self._dirs = [d for d, a in self._arrays.items() if len(a)]
+        arrays = [self._arrays[d] for d in self._dirs]
+        self._sizes = np.array([len(a) for a in arrays], dtype=np.int64)
+        self._starts = np.concatenate(([0], np.cumsum(self._sizes)[:-1])).astype(np.int64) if arrays else self._sizes
+        self._indices = np.concatenate(arrays) if arrays else np.empty(0, dtype=np.uint64)
+        self._dirty = False
+
+    def scores(self, query: 'np.ndarray') -> tuple[list[Path], 'np.ndarray']:
+        """Similarity (0 to 1) of the query token array to every representative, as (dirs, scores)."""
+        if self._dirty:
+            self._pack()
+        if not len(query) or not len(self._dirs):
+            return self._dirs, np.zeros(len(self._dirs))
+
+        # Each representative token is in the query if it's where searchsorted() would put it
+        pos = np.searchsorted(query, self._indices)
+        hits = query[np.minimum(pos, len(query) - 1)] == self._indices
+        overlap = np.add.reduceat(hits.astype(np.int64), self._starts)
+        return self._dirs, overlap / np.minimum(self._sizes, len(query))
@@ -0,0 +1,139 @@
+"""
+Notices files arriving in a directory. Uses inotify on Linux, through ctypes so there's nothing to
+install, and falls back to listing the directory every poll_secs where inotify isn't available:
+on a macOS host, say, or a network mount that doesn't pass events on.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+import typing as t
+from pathlib import Path
+
+# From <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; then len bytes of name
+
+
+def _inotify(dir: Path) -> t.Optional[int]:
+    """A non-blocking inotify fd watching dir for files finished or moved in, or None if there's no inotify."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return None
+    if add_watch(fd, os.fsencode(dir), _IN_CLOSE_WRITE | _IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class DirWatcher():
+    """
+    Hands out the files that arrive in dir, a burst at a time. list_files() says which files are
+    waiting. It's called to start with, when events were lost, and at every poll in polling mode.
+
+    Files are only handed out once they're complete: with inotify, when the writer closes them or
+    they're moved in; when polling, when they haven't changed for settle_secs.
+    """
+
+    def __init__(self, dir: Path, poll_secs: float, list_files: t.Callable[[], t.Iterable[Path]], force_poll: bool = False):
+        self.dir = dir
+        self.poll_secs = poll_secs
+        self.list_files = list_files
+        self._fd = None if force_poll else _inotify(dir)
+        self._relist = True  # List dir on the next wait, rather than trusting events
+        self._young: set[Path] = set()  # Listed but still being written
+        self._carry: set[Path] = set()  # Arrived, but didn't fit in the last batch
+
+    @property
+    def mode(self) -> str:
+        return 'polling' if self._fd is None else 'inotify'
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _events(self, timeout: t.Optional[float]) -> set[Path]:
+        """Files that inotify says arrived, after waiting up to timeout seconds for the first."""
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return set()
+        files = set()
+        try:
+            data = os.read(self._fd, 1 << 16)
+        except BlockingIOError:
+            return files
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            if mask & _IN_Q_OVERFLOW:
+                self._relist = True  # Lost some. Go by the listing instead.
+            elif mask & _IN_IGNORED:
+                # The watch is gone, e.g. dir was deleted. Carry on by polling.
+                self.close()
+                self._relist = True
+                break
+            elif name and not mask & _IN_ISDIR:
+                files.add(self.dir / os.fsdecode(name))
+        return files
+
+    def _settled(self, files: t.Iterable[Path], settle_secs: float) -> set[Path]:
+        """Those of files that haven't changed in settle_secs. The rest are checked again next time."""
+        now = time.time()
+        settled = set()
+        self._young.clear()
+        for f in files:
+            try:
+                if now - f.stat().st_mtime >= settle_secs:
+                    settled.add(f)
+                else:
+                    self._young.add(f)
+            except FileNotFoundError:
+                pass
+        return settled
+
+    def next_batch(self, settle_secs: float, max_files: int, timeout: t.Optional[float] = None) -> list[Path]:
+        """
+        Wait up to timeout seconds (forever if None) for files to arrive, then keep collecting until
+        none arrive for settle_secs or there are max_files. Returns them in name order, or [] if
+        none came.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        batch, self._carry = self._carry, set()
+        while len(batch) < max_files:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if self._relist:
+                self._relist = False
+                found = self._settled(self.list_files(), settle_secs)
+            elif self._fd is None:
+                wait = self.poll_secs if remaining is None else min(self.poll_secs, remaining)
+                time.sleep(settle_secs if batch else wait)
+                found = self._settled(self.list_files(), settle_secs) - batch
+            else:
+                if self._young:
+                    # Come back to check on the files that were still changing
+                    remaining = settle_secs if remaining is None else min(settle_secs, remaining)
+                found = self._events(settle_secs if batch else remaining)
+                found |= self._settled(list(self._young - found), settle_secs)
+
+            batch |= found
+            if batch and not found:
+                break  # The burst is over
+            if not batch and deadline is not None and time.monotonic() >= deadline:
+                break
+
+        files = sorted(f for f in batch if f.is_file())
+        self._carry = set(files[max_files:])
+        return files[:max_files]
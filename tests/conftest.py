@@ -0,0 +1,37 @@
+import contextlib
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'recovery'))  # The apps import each other as top-level modules
+
+from common import Config as C
+
+
+@contextlib.contextmanager
+def workspace_at(root: Path):
+    """Config pointed at an empty SOURCE_DIR and SORTING_DIR under root. Put back afterwards."""
+    saved = dict(vars(C))
+    C.set_app_dir(root / 'app')
+    C.set_run_quiet(True)
+    C.set_tokenizer('regex')  # Needs no nltk data
+    C.set_metrics_interval(0)
+    C.SOURCE_DIR.mkdir(parents=True)
+    C.SORTING_DIR.mkdir()
+    try:
+        yield root
+    finally:
+        vars(C).clear()
+        vars(C).update(saved)
+
+
+@pytest.fixture
+def workspace(tmp_path: Path) -> Path:
+    with workspace_at(tmp_path) as root:
+        yield root
+
+
+def write_rtf(path: Path, text: str) -> Path:
+    path.write_text('{\\rtf1\\ansi{\\fonttbl\\f0 Times;}\\f0 ' + text + '}')
+    return path
@@ -0,0 +1,43 @@
+from pathlib import Path
+
+import pytest
+import sift
+from common import Config as C
+from conftest import workspace_at, write_rtf
+
+
+def _corpus() -> None:
+    """Two documents, a shorter draft of each, and a file with no text at all."""
+    first = ' '.join(f'first{i}' for i in range(120))
+    second = ' '.join(f'second{i}' for i in range(120))
+    write_rtf(C.SOURCE_DIR / 'File Name Lost (1).rtf', first)
+    write_rtf(C.SOURCE_DIR / 'File Name Lost (2).rtf', first[:len(first) * 3 // 4])
+    write_rtf(C.SOURCE_DIR / 'File Name Lost (3).rtf', second)
+    write_rtf(C.SOURCE_DIR / 'File Name Lost (4).rtf', second[:len(second) * 3 // 4])
+    write_rtf(C.SOURCE_DIR / 'File Name Lost (5).rtf', '')
+
+
+def _tree(root: Path) -> list[tuple[str, bytes]]:
+    """Every file under SOURCE_DIR and SORTING_DIR, by path relative to root, with its contents."""
+    return sorted((str(f.relative_to(root)), f.read_bytes())
+                  for d in (C.SOURCE_DIR, C.SORTING_DIR) for f in d.rglob('*') if f.is_file())
+
+
+def _sift(workspace: Path) -> list[tuple[str, bytes]]:
+    _corpus()
+    assert sift.sift(mp=False)
+    return _tree(workspace)
+
+
+@pytest.fixture
+def real(tmp_path_factory) -> list[tuple[str, bytes]]:
+    """The tree a sift that moves files leaves."""
+    with workspace_at(tmp_path_factory.mktemp('real')) as root:
+        return _sift(root)
+
+
+@pytest.mark.parametrize('engine', ['sort', 'graph'])
+def test_virtual_sift_matches_real(workspace, real, engine):
+    C.set_virtual_sort(True)
+    C.set_sift_engine(engine)
+    assert _sift(workspace) == real
@@ -0,0 +1,26 @@
+import pytest
+import sort
+from common import Config as C
+from conftest import write_rtf
+from layout import cluster_dirs
+
+
+def _prefix_pair() -> list:
+    """
+    Two files where b is all in a, but a's first 500 characters barely overlap b. Without the token
+    cache, compare_to_rtf() stops at the prefix, so b doesn't join a's cluster.
+    """
+    shared = ' '.join(f'alpha{i}' for i in range(20)) + ' ' + ' '.join(f'beta{i}' for i in range(60))
+    filler = ' '.join(f'filler{i}' for i in range(80))  # Well over 500 characters
+    a = write_rtf(C.SOURCE_DIR / 'a.rtf', f'alpha0 {filler} {shared}')
+    b = write_rtf(C.SOURCE_DIR / 'b.rtf', shared)
+    return [a, b]
+
+
+@pytest.mark.parametrize('run', [sort.run_single, lambda files: sort.run_multi(2, files=files)],
+                         ids=['single', 'multi'])
+def test_prefix_check_without_token_cache(workspace, run):
+    C.set_token_cache(False)
+    C.set_match_ratio_threshold(80)
+    run(files=_prefix_pair())
+    assert len(cluster_dirs()) == 2